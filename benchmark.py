@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of hashsync against a local storage backend.
+
+A synthetic tree is generated, then each stage of an upload and a download
+is timed separately. Results are output as JSON so they can be compared
+between versions.
+"""
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import hashsync
+from hashsync.compression import maybe_compress
+from hashsync.connection import connect_url
+from hashsync.manifest import Manifest
+from hashsync.metrics import METRICS, collect, result
+from hashsync.schedule import schedule
+from hashsync.synthetic import generate_tree
+from hashsync.transfer import upload_directory
+from hashsync.utils import traverse_directory
+from hashsync.hashing import ALGORITHMS, get_algorithm
+from hashsync import config
+
+from download import download_key, touch, FileCache
+
+import logging
+log = logging.getLogger(__name__)
+
+STAGES = ["traverse", "hash", "compress", "upload", "reupload", "manifest_save", "manifest_load",
+          "download", "materialize"]
+
+
+class Timer(object):
+    """
+    Records how long each stage takes, along with how many files and bytes
+    it processed
+    """
+    def __init__(self):
+        self.results = {}
+
+    def run(self, stage, func, files=0, nbytes=0):
+        log.info("running %s", stage)
+        start = time.time()
+        retval = func()
+        elapsed = time.time() - start
+        self.results[stage] = {
+            "seconds": elapsed,
+            "files": files,
+            "bytes": nbytes,
+            "files_per_sec": files / elapsed if elapsed and files else None,
+            "bytes_per_sec": nbytes / elapsed if elapsed and nbytes else None,
+        }
+        log.info("%s took %.3fs", stage, elapsed)
+        return retval
+
+
+def compress_all(filenames):
+    compressed = 0
+    for filename in filenames:
+        fobj, was_compressed = maybe_compress(filename)
+        with fobj:
+            if was_compressed:
+                fobj.seek(0, 2)
+                compressed += fobj.tell()
+    return compressed
+
+
+def compare_hashes(filenames, nfiles, nbytes):
+    """
+    Times hashing every file with each available algorithm
+
+    Returns:
+        dict of algorithm name to timings, as for Timer
+    """
+    timer = Timer()
+    for name, algorithm in sorted(ALGORITHMS.items()):
+        timer.run(name, lambda: [algorithm.hash_file(f) for f in filenames], nfiles, nbytes)
+    return timer.results
+
+
+def download_all(hashes, cache, jobs, algorithm, largest_first=True):
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = schedule([(size, h) for h, size in hashes.items()], jobs, largest_first)
+        results = [pool.apply_async(collect, (download_key, algorithm.key(h), cache.makepath(h)))
+                   for _, h in tasks]
+        for r in results:
+            result(r)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def materialize_all(files, cache, destdir, algorithm):
+    for h, filename, perms in files:
+        dest = os.path.join(destdir, filename)
+        if h == algorithm.zero:
+            touch(dest)
+        else:
+            cache.copy_from_cache(h, dest)
+
+
+def run_benchmark(workdir, args):
+    """
+    Runs the benchmark in workdir
+
+    Returns:
+        dict of results per stage
+    """
+    srcdir = os.path.join(workdir, "src")
+    destdir = os.path.join(workdir, "dest")
+    algorithm = get_algorithm(args.algorithm)
+    cache = FileCache(os.path.join(workdir, "cache"), algorithm=algorithm.name)
+
+    nfiles, nbytes = generate_tree(srcdir, files=args.files, mean_size=args.mean_size,
+                                   distribution=args.distribution, duplication=args.duplication,
+                                   compressibility=args.compressibility, seed=args.seed)
+
+    url = "file://{}?latency={}&bandwidth={}".format(os.path.join(workdir, "store"), args.latency, args.bandwidth)
+    connect_url(url)
+
+    timer = Timer()
+    stages = args.stages
+    METRICS.reset()
+    hash_algorithms = None
+
+    filenames = timer.run("traverse", lambda: [f for f, _ in traverse_directory(srcdir, lambda f: None)], nfiles)
+    if "hash" in stages:
+        timer.run("hash", lambda: [algorithm.hash_file(f) for f in filenames], nfiles, nbytes)
+        hash_algorithms = compare_hashes(filenames, nfiles, nbytes)
+    if "compress" in stages:
+        timer.run("compress", lambda: compress_all(filenames), nfiles, nbytes)
+
+    manifest = timer.run("upload", lambda: upload_directory(srcdir, args.jobs, largest_first=args.largest_first,
+                                                            algorithm=algorithm.name),
+                         nfiles, nbytes)
+    if "reupload" in stages:
+        timer.run("reupload", lambda: upload_directory(srcdir, args.jobs, largest_first=args.largest_first,
+                                                       algorithm=algorithm.name), nfiles, nbytes)
+
+    data = BytesIO()
+    timer.run("manifest_save", lambda: manifest.save(data), nfiles)
+    data.seek(0)
+    timer.run("manifest_load", lambda: Manifest().load(data), nfiles)
+
+    # Size of each unique object
+    unique = {}
+    for h, filename, _ in manifest.files:
+        if h != algorithm.zero and h not in unique:
+            unique[h] = os.path.getsize(os.path.join(srcdir, filename))
+    if "download" in stages or "materialize" in stages:
+        timer.run("download", lambda: download_all(unique, cache, args.jobs, algorithm, args.largest_first), len(unique), sum(unique.values()))
+    if "materialize" in stages:
+        timer.run("materialize", lambda: materialize_all(manifest.files, cache, destdir, algorithm), nfiles, nbytes)
+
+    return {
+        "hashsync_version": hashsync.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "params": {
+            "files": nfiles,
+            "bytes": nbytes,
+            "unique_objects": len(unique),
+            "mean_size": args.mean_size,
+            "distribution": args.distribution,
+            "duplication": args.duplication,
+            "compressibility": args.compressibility,
+            "seed": args.seed,
+            "hash": args.algorithm,
+            "jobs": args.jobs,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "largest_first": args.largest_first,
+        },
+        "stages": dict((s, timer.results[s]) for s in STAGES if s in timer.results),
+        "hash_algorithms": hash_algorithms,
+        "metrics": METRICS.to_dict(),
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const=logging.WARN, default=logging.INFO)
+    parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const=logging.DEBUG)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="how many simultaneous transfers to do", default=8)
+    parser.add_argument("-o", "--output", dest="output", help="where to write results, use '-' for stdout", default="-")
+    parser.add_argument("--files", dest="files", type=int, default=1000, help="number of files to generate")
+    parser.add_argument("--mean-size", dest="mean_size", type=int, default=65536, help="mean file size in bytes")
+    parser.add_argument("--distribution", dest="distribution", choices=["fixed", "uniform", "lognormal"],
+                        default="lognormal", help="file size distribution")
+    parser.add_argument("--duplication", dest="duplication", type=float, default=0.1,
+                        help="fraction of files that duplicate another file")
+    parser.add_argument("--compressibility", dest="compressibility", type=float, default=0.5,
+                        help="fraction of each file that is compressible")
+    parser.add_argument("--hash", dest="algorithm", choices=sorted(ALGORITHMS), default=config.HASH_ALGORITHM,
+                        help="how to identify objects")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="random seed for the generated tree")
+    parser.add_argument("--latency", dest="latency", type=float, default=0,
+                        help="seconds of simulated latency per request")
+    parser.add_argument("--bandwidth", dest="bandwidth", default="0",
+                        help="simulated bandwidth per request, e.g. 10M; 0 means unlimited")
+    parser.add_argument("--no-schedule", dest="largest_first", action="store_false", default=True,
+                        help="transfer files in walk order rather than largest first, to compare wall times")
+    parser.add_argument("--stages", dest="stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="stages to run; traverse, upload and manifest save/load always run")
+    parser.add_argument("--workdir", dest="workdir",
+                        help="directory to generate the tree and store objects in; defaults to a temporary directory "
+                        "that is removed afterwards")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s - %(message)s")
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="hashsync-bench")
+
+    # The object list caches itself in the current directory
+    olddir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run_benchmark(workdir, args)
+    finally:
+        os.chdir(olddir)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.output == '-':
+        output_file = sys.stdout
+    else:
+        output_file = open(args.output, 'w')
+    json.dump(results, output_file, indent=2, sort_keys=True)
+    output_file.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asks a running daemon.py to upload or download
+
+This only uses the standard library, so it starts much faster than
+upload.py or download.py, and the daemon has everything else loaded
+already. Paths are made absolute before they're sent, since the daemon has
+its own working directory.
+
+The protocol is one JSON object per line. The client sends
+{"command": ..., "args": {...}}, and the daemon sends back {"log": message}
+for each message logged while it works, then {"ok": true, "result": ...} or
+{"ok": false, "error": message}.
+"""
+import json
+import os
+import socket
+import sys
+import tempfile
+
+
+def default_socket():
+    "Returns where the daemon listens unless told otherwise"
+    return os.environ.get("HASHSYNC_SOCKET") or \
+        os.path.join(tempfile.gettempdir(), "hashsync-{}.sock".format(os.getuid()))
+
+
+class DaemonError(Exception):
+    "The daemon couldn't do what it was asked"
+
+
+def request(path, command, args=None, log=None):
+    """
+    Sends a request to the daemon listening on path and waits for it to
+    finish
+
+    Arguments:
+        path (str): the daemon's socket
+        command (str): what to do, e.g. "upload"
+        args (dict): the command's arguments
+        log (callable): called with each message the daemon logs
+
+    Returns:
+        the command's result. Raises DaemonError if it failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({"command": command, "args": args or {}}).encode("utf8") + b"\n")
+        for line in sock.makefile('rb'):
+            reply = json.loads(line.decode("utf8"))
+            if "log" in reply:
+                if log:
+                    log(reply["log"])
+            elif reply["ok"]:
+                return reply.get("result")
+            else:
+                raise DaemonError(reply["error"])
+    finally:
+        sock.close()
+    raise DaemonError("the daemon hung up")
+
+
+def _abspath(path):
+    return path if path is None or path == '-' else os.path.abspath(path)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", dest="socket", default=default_socket(),
+                        help="the daemon's socket; defaults to $HASHSYNC_SOCKET or %(default)s")
+    parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const="WARNING", default="INFO")
+    parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const="DEBUG")
+    parser.add_argument("--metrics-json", dest="metrics_json", help="write transfer metrics to this file as JSON")
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        help="write transfer metrics to this file in the Prometheus text format")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    up = commands.add_parser("upload", help="upload a directory, like upload.py")
+    up.add_argument("-o", "--output", dest="output", default="manifest.gz", help="where to write the manifest")
+    up.add_argument("--manifest-format", dest="manifest_format", type=int, choices=[1, 2],
+                    help="manifest format to write; defaults to the daemon's default")
+    up.add_argument("--no-compress-manifest", dest="compress_manifest", action="store_false", default=True,
+                    help="don't compress the manifest")
+    up.add_argument("--no-publish", dest="publish", action="store_false", default=True,
+                    help="don't publish new objects to the object list")
+    up.add_argument("--no-refresh", dest="refresh", action="store_false", default=True,
+                    help="don't refresh old objects")
+    up.add_argument("--no-schedule", dest="largest_first", action="store_false", default=True,
+                    help="upload files in directory order rather than largest first")
+    up.add_argument("--chunked", dest="chunked", action="store_true", default=False,
+                    help="store large files as content-defined chunks")
+    up.add_argument("--hash", dest="algorithm", help="how to identify objects; defaults to the bucket's algorithm")
+    up.add_argument("--journal", dest="journal",
+                    help="record progress here; defaults to the output file plus .journal")
+    up.add_argument("--no-journal", dest="use_journal", action="store_false", default=True,
+                    help="don't keep a journal")
+    up.add_argument("dirname", help="directory to upload")
+
+    down = commands.add_parser("download", help="populate directories from manifests, like download.py")
+    down.add_argument("--include", dest="include", action="append", metavar="PATTERN",
+                      help="only materialize paths matching PATTERN; may be given more than once")
+    down.add_argument("--exclude", dest="exclude", action="append", metavar="PATTERN",
+                      help="don't materialize, or remove, paths matching PATTERN; may be given more than once")
+    down.add_argument("--no-schedule", dest="largest_first", action="store_false", default=True,
+                      help="download objects in manifest order rather than largest first")
+    down.add_argument("manifest", help="manifest to load")
+    down.add_argument("destdir", help="target directory to populate")
+    down.add_argument("more", nargs="*", metavar="MANIFEST DESTDIR",
+                      help="more manifests and the directories to populate from them")
+
+    commands.add_parser("status", help="show what the daemon has loaded")
+    commands.add_parser("stop", help="stop the daemon")
+
+    args = parser.parse_args()
+    request_args = {"loglevel": args.loglevel, "metrics_json": _abspath(args.metrics_json),
+                    "metrics_prom": _abspath(args.metrics_prom)}
+    if args.command == "upload":
+        journal = None
+        if args.use_journal:
+            journal = _abspath(args.journal or args.output + ".journal")
+        request_args.update(dirname=_abspath(args.dirname), output=_abspath(args.output),
+                            compress=args.compress_manifest, publish=args.publish, refresh=args.refresh,
+                            largest_first=args.largest_first, chunked=args.chunked, algorithm=args.algorithm,
+                            journal=journal, manifest_format=args.manifest_format)
+    elif args.command == "download":
+        if len(args.more) % 2:
+            parser.error("each extra manifest needs a destination directory")
+        names = [args.manifest, args.destdir] + args.more
+        request_args.update(pairs=[(_abspath(m), _abspath(d)) for m, d in zip(names[::2], names[1::2])],
+                            include=args.include, exclude=args.exclude, largest_first=args.largest_first)
+
+    def log(message):
+        sys.stderr.write(message + "\n")
+
+    try:
+        result = request(args.socket, args.command, request_args, log)
+    except socket.error as e:
+        sys.exit("couldn't talk to the daemon at {}: {}".format(args.socket, e))
+    except DaemonError as e:
+        sys.exit(str(e))
+    if args.command == "status":
+        print(json.dumps(result, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Serves uploads and downloads over a Unix socket, for client.py
+
+Starting upload.py or download.py means importing everything, connecting,
+loading the object list and starting worker processes before any work is
+done; for small syncs that's most of the time they take. The daemon does
+all that once and keeps it:
+
+* the connection, and the worker processes, which are started after
+  connecting so they each keep their own connection open between requests
+* the object list of each hash algorithm, reloaded once it's
+  config.DAEMON_OBJECTLIST_TTL seconds old, or after an upload fails
+* the hashes of files it's uploaded, reused while their size, mtime and
+  inode are unchanged
+* the FileCache of each hash algorithm, with its record of verified objects
+
+Requests are handled one at a time, in the order they arrive. The socket is
+only accessible to the user that started the daemon. See client.py for the
+protocol.
+"""
+import errno
+import json
+import os
+import socket
+import time
+from collections import OrderedDict
+
+from hashsync.connection import connect, connect_url, get_bucket
+from hashsync.hashing import get_algorithm, repository_algorithm
+from hashsync.objectlist import ShardedObjectList
+from hashsync.transfer import upload_directory, _init_worker
+from hashsync.pathfilter import PathFilter
+from hashsync.metrics import METRICS
+from hashsync.retry import TransferPolicy
+from hashsync.journal import UploadJournal
+from hashsync import config
+
+from client import default_socket
+from download import DownloadPlan, download_manifests
+from upload import write_manifest
+
+import logging
+log = logging.getLogger(__name__)
+
+
+COMMANDS = ("upload", "download", "status", "stop")
+LOGLEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+class HashCache(object):
+    """
+    Hashes of the files most recently hashed, by absolute filename. A hash
+    is only used while the file's size, mtime and inode are the same as when
+    it was hashed.
+
+    Arguments:
+        size (int): most files to remember
+    """
+    def __init__(self, size=config.DAEMON_HASH_CACHE_SIZE):
+        self.size = size
+        # Filename to ((size, mtime_ns, inode), hash), least recently used
+        # first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hasher(self, hash_file):
+        """
+        Returns a wrapper around hash_file that reuses the hashes of files
+        that haven't changed
+        """
+        def wrapper(filename):
+            path = os.path.abspath(filename)
+            # Stat before hashing, so a file that changes while it's hashed
+            # is hashed again next time
+            st = os.stat(path)
+            stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+            entry = self.entries.pop(path, None)
+            if entry and entry[0] == stat:
+                METRICS.incr("hashsync_hash_skipped_total")
+                self.entries[path] = entry
+                return entry[1]
+            h = hash_file(filename)
+            self.entries[path] = (stat, h)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return h
+        return wrapper
+
+
+class _ClientHandler(logging.Handler):
+    "Sends log messages to the client a request came from"
+    def __init__(self, send, level):
+        logging.Handler.__init__(self, level)
+        self.send = send
+        self.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+
+    def emit(self, record):
+        try:
+            self.send({"log": self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+
+def _parse_request(request):
+    """
+    Returns the command, its arguments, the log level and the metrics files
+    of a request, or raises ValueError if it isn't a valid request
+    """
+    if not isinstance(request, dict):
+        raise ValueError("requests must be JSON objects")
+    command = request.get("command")
+    if command not in COMMANDS:
+        raise ValueError("unknown command {!r}".format(command))
+    args = request.get("args") or {}
+    if not isinstance(args, dict):
+        raise ValueError("args must be a JSON object")
+    args = dict(args)
+    loglevel = args.pop("loglevel", None) or "INFO"
+    if loglevel not in LOGLEVELS:
+        raise ValueError("unknown log level {!r}".format(loglevel))
+    metrics_json = args.pop("metrics_json", None)
+    metrics_prom = args.pop("metrics_prom", None)
+    return command, args, getattr(logging, loglevel), metrics_json, metrics_prom
+
+
+class Daemon(object):
+    """
+    What's kept between requests, and the requests themselves
+
+    Arguments:
+        pool (multiprocessing.Pool): workers to hash and transfer with,
+                                     started after connecting
+        jobs (int): how many transfers to do at once; with adaptive, the most
+                    to do at once
+        cache_dir (str): where to cache downloaded objects
+        verify (bool): check downloaded and cached objects against their
+                       hashes
+        adaptive (bool): adjust how many transfers are in flight based on
+                         throughput, latency and throttling
+        min_jobs (int): fewest transfers to have in flight with adaptive
+        segment_jobs (int): how many byte ranges of each large object to
+                            download at once
+        objectlist_ttl (float): seconds to keep using an object list before
+                                loading it again
+        hash_cache_size (int): most file hashes to remember for each
+                               algorithm
+    """
+    def __init__(self, pool, jobs, cache_dir, verify=True, adaptive=False, min_jobs=1,
+                 segment_jobs=config.SEGMENT_JOBS, objectlist_ttl=config.DAEMON_OBJECTLIST_TTL,
+                 hash_cache_size=config.DAEMON_HASH_CACHE_SIZE):
+        self.pool = pool
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.verify = verify
+        self.adaptive = adaptive
+        self.min_jobs = min_jobs
+        self.segment_jobs = segment_jobs
+        self.objectlist_ttl = objectlist_ttl
+        self.hash_cache_size = hash_cache_size
+        # Algorithm name to (time loaded, ShardedObjectList)
+        self.object_lists = {}
+        # Algorithm name to HashCache
+        self.hash_caches = {}
+        # Algorithm name to download.FileCache, shared by every DownloadPlan
+        self.caches = {}
+        # (time read, name) of the bucket's algorithm
+        self.default_algorithm = None
+        self.started = time.time()
+        self.requests = 0
+        self.running = True
+
+    def _algorithm(self, name):
+        if name:
+            return get_algorithm(name)
+        now = time.time()
+        if not self.default_algorithm or now - self.default_algorithm[0] > self.objectlist_ttl:
+            self.default_algorithm = (now, repository_algorithm(get_bucket()))
+        return get_algorithm(self.default_algorithm[1])
+
+    def object_list(self, algorithm):
+        "Returns the object list of algorithm's objects, loading it if it's stale"
+        now = time.time()
+        loaded = self.object_lists.get(algorithm.name)
+        if loaded and now - loaded[0] <= self.objectlist_ttl:
+            METRICS.incr("hashsync_daemon_objectlist_total", state="warm")
+            return loaded[1]
+        METRICS.incr("hashsync_daemon_objectlist_total", state="loaded")
+        object_list = ShardedObjectList(get_bucket(), algorithm.objectlist_keyname)
+        object_list.load()
+        self.object_lists[algorithm.name] = (now, object_list)
+        return object_list
+
+    def upload(self, dirname, output, compress=True, journal=None, publish=True, refresh=True,
+               largest_first=True, chunked=False, algorithm=None, manifest_format=None):
+        """
+        Uploads dirname and writes its manifest to output in
+        manifest_format, like upload.py
+
+        Returns:
+            a dict with the number of files in the manifest
+        """
+        algorithm = self._algorithm(algorithm)
+        if algorithm.name not in self.hash_caches:
+            self.hash_caches[algorithm.name] = HashCache(self.hash_cache_size)
+        if journal:
+            journal = UploadJournal(journal)
+        try:
+            manifest = upload_directory(dirname, self.jobs, publish=publish, refresh=refresh,
+                                        adaptive=self.adaptive, min_jobs=self.min_jobs,
+                                        largest_first=largest_first, chunked=chunked, algorithm=algorithm.name,
+                                        journal=journal, pool=self.pool,
+                                        object_list=self.object_list(algorithm),
+                                        hasher=self.hash_caches[algorithm.name].hasher)
+        except Exception:
+            # Whatever the upload added to the object list may not have been
+            # uploaded
+            self.object_lists.pop(algorithm.name, None)
+            raise
+        write_manifest(manifest, output, compress, manifest_format)
+        if journal:
+            journal.remove()
+        return {"files": len(manifest.files)}
+
+    def download(self, pairs, include=None, exclude=None, largest_first=True):
+        """
+        Brings each directory up to date with its manifest, like download.py
+
+        Arguments:
+            pairs (list): (manifest filename, directory) pairs
+
+        Returns:
+            a dict with the number of objects downloaded
+        """
+        destdirs = [os.path.abspath(d) for _, d in pairs]
+        if len(set(destdirs)) != len(destdirs):
+            raise ValueError("each destination directory can only be given once")
+        plan = DownloadPlan(self.cache_dir, verify=self.verify, caches=self.caches)
+        download_manifests(pairs, plan, self.pool, self.jobs, PathFilter(include, exclude),
+                           adaptive=self.adaptive, min_jobs=self.min_jobs, largest_first=largest_first,
+                           segment_jobs=self.segment_jobs)
+        return {"objects": len(plan.tasks)}
+
+    def status(self):
+        "Returns what's been loaded, and how long ago"
+        now = time.time()
+        return {
+            "pid": os.getpid(),
+            "uptime": now - self.started,
+            "requests": self.requests,
+            "object_lists": dict((name, {"objects": len(l.objects), "age": now - t})
+                                 for name, (t, l) in self.object_lists.items()),
+            "hash_caches": dict((name, len(c)) for name, c in self.hash_caches.items()),
+            "file_caches": dict((name, len(c.verified)) for name, c in self.caches.items()),
+        }
+
+    def stop(self):
+        "Stops serving once this request is done"
+        self.running = False
+
+    def handle(self, request, send):
+        """
+        Handles one request, sending the client its log messages as it goes
+        and then the result
+
+        Arguments:
+            request (dict): {"command": name, "args": {...}}
+            send (callable): sends a message to the client
+        """
+        self.requests += 1
+        METRICS.reset()
+        try:
+            command, args, level, metrics_json, metrics_prom = _parse_request(request)
+        except ValueError as e:
+            send({"ok": False, "error": str(e)})
+            return
+
+        handler = _ClientHandler(send, level)
+        root = logging.getLogger()
+        old_level = root.level
+        root.addHandler(handler)
+        root.setLevel(min(level, old_level))
+        start = time.time()
+        try:
+            retval = getattr(self, command)(**args)
+            if command in ("upload", "download"):
+                METRICS.log_summary()
+                METRICS.write(metrics_json, metrics_prom)
+        except Exception as e:
+            log.exception("%s failed", command)
+            reply = {"ok": False, "error": str(e) or type(e).__name__}
+        else:
+            reply = {"ok": True, "result": retval}
+        finally:
+            root.removeHandler(handler)
+            root.setLevel(old_level)
+        log.debug("%s took %.2fs", command, time.time() - start)
+        send(reply)
+
+    def serve(self, path):
+        """
+        Handles requests on the Unix socket at path until asked to stop. The
+        socket is created so that only this user can connect to it.
+        """
+        sock = listen(path)
+        log.info("listening on %s", path)
+        try:
+            while self.running:
+                conn, _ = sock.accept()
+                try:
+                    self._serve_connection(conn)
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.unlink(path)
+
+    def _serve_connection(self, conn):
+        def send(message):
+            conn.sendall(json.dumps(message).encode("utf8") + b"\n")
+
+        def send_quietly(message):
+            # If the client has gone away, finish the request anyway
+            try:
+                send(message)
+            except socket.error:
+                pass
+
+        try:
+            line = conn.makefile('rb').readline()
+        except socket.error:
+            return
+        try:
+            request = json.loads(line.decode("utf8"))
+        except ValueError:
+            send_quietly({"ok": False, "error": "couldn't parse request"})
+            return
+        self.handle(request, send_quietly)
+
+
+def listen(path):
+    """
+    Returns a socket listening at path, which only this user can connect to.
+    A socket left behind by a daemon that's no longer running is replaced.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+            log.info("removing stale socket %s", path)
+            os.unlink(path)
+        else:
+            raise IOError("a daemon is already listening on {}".format(path))
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    return sock
+
+
+def main():
+    import multiprocessing
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--region", dest="region")
+    parser.add_argument("-b", "--bucket", dest="bucket_name")
+    parser.add_argument("-u", "--url", dest="url",
+                        help="storage backend URL to use instead of --region and --bucket, "
+                        "e.g. s3://bucket?region=us-east-1 or file:///path")
+    parser.add_argument("-s", "--socket", dest="socket", default=default_socket(),
+                        help="where to listen; defaults to $HASHSYNC_SOCKET or %(default)s")
+    parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const=logging.WARN, default=logging.INFO)
+    parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const=logging.DEBUG)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="how many simultaneous transfers to do", default=8)
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=False,
+                        help="adjust how many transfers are in flight, up to --jobs, based on throughput, latency "
+                        "and throttling")
+    parser.add_argument("--min-jobs", dest="min_jobs", type=int, default=1,
+                        help="with --adaptive, the fewest transfers to keep in flight")
+    parser.add_argument("--segment-jobs", dest="segment_jobs", type=int, default=config.SEGMENT_JOBS,
+                        help="how many byte ranges of each large object to download at once; 1 downloads "
+                        "objects whole")
+    parser.add_argument("--cache-dir", dest="cache_dir", help="where to cache downloaded objects locally",
+                        required=True)
+    parser.add_argument("--no-verify", dest="verify", action="store_false", default=True,
+                        help="don't check downloaded and cached objects against their hashes")
+    parser.add_argument("--objectlist-ttl", dest="objectlist_ttl", type=float, default=config.DAEMON_OBJECTLIST_TTL,
+                        help="seconds to keep using an object list before loading it again")
+    parser.add_argument("--hash-cache-size", dest="hash_cache_size", type=int, default=config.DAEMON_HASH_CACHE_SIZE,
+                        help="how many file hashes to remember")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=config.REQUEST_TIMEOUT,
+                        help="seconds to wait for each request before retrying it; 0 waits forever")
+    parser.add_argument("--attempts", dest="attempts", type=int, default=config.REQUEST_MAX_ATTEMPTS,
+                        help="how many times to try each request")
+    parser.add_argument("--hedge", dest="hedge", action="store_true", default=False,
+                        help="send a duplicate request for reads that are slower than almost all recent reads")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s - %(message)s")
+    # Make boto shut up
+    # TODO: Add -v -v support to set this to DEBUG?
+    logging.getLogger('boto').setLevel(logging.INFO)
+
+    policy = TransferPolicy(timeout=args.timeout or None, max_attempts=args.attempts, hedge=args.hedge)
+
+    if args.url:
+        connect_url(args.url, policy)
+    elif args.region and args.bucket_name:
+        connect(args.region, args.bucket_name, policy)
+    else:
+        parser.error("either --url or --region and --bucket are required")
+
+    # Workers inherit the connection, and keep it between requests
+    pool = multiprocessing.Pool(args.jobs, initializer=_init_worker)
+    daemon = Daemon(pool, args.jobs, args.cache_dir, verify=args.verify, adaptive=args.adaptive,
+                    min_jobs=args.min_jobs, segment_jobs=args.segment_jobs, objectlist_ttl=args.objectlist_ttl,
+                    hash_cache_size=args.hash_cache_size)
+    try:
+        daemon.serve(args.socket)
+    except KeyboardInterrupt:
+        log.info("stopped")
+    pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
 import os
 import shutil
 import tempfile
+import time
+from collections import defaultdict
 
-from hashsync.utils import traverse_directory, sha1sum, copy_stream, strip_leading, SHA1SUM_ZERO
+from hashsync.utils import traverse_directory, strip_leading, copy_stream
+from hashsync.hashing import get_algorithm
 from hashsync.manifest import Manifest
+from hashsync.pathfilter import PathFilter
 from hashsync.compression import decompress_stream
-from hashsync.connection import connect, get_bucket
+from hashsync.connection import connect, connect_url, get_bucket
+from hashsync.metrics import METRICS, result, timed
+from hashsync.transfer import JobSubmitter, make_concurrency
+from hashsync.retry import TransferPolicy
+from hashsync.segments import download_ranges, download_gzip_segments
+from hashsync.schedule import schedule
+from hashsync.chunking import assemble, chunk_offsets
+from hashsync.materialize import Materializer
+from hashsync.verify import CorruptObject, HashingWriter, OrderedHasher, KnownFiles
+from hashsync import config, profiling
 
 import logging
 log = logging.getLogger(__name__)
@@ -15,146 +29,645 @@ log = logging.getLogger(__name__)
 
 def mkdirs(d):
     if not os.path.exists(d):
-        os.makedirs(d)
+        try:
+            os.makedirs(d)
+        except OSError:
+            # Another worker may have created it first
+            if not os.path.isdir(d):
+                raise
 
 
-def touch(filename):
-    dirname = os.path.dirname(filename)
-    mkdirs(dirname)
+def touch(filename, makedirs=True):
+    if makedirs:
+        mkdirs(os.path.dirname(filename))
     with open(filename, 'wb'):
         os.utime(filename, None)
 
 
 class FileCache(object):
-    def __init__(self, cachedir, verify=False):
+    """
+    Objects kept locally, named by their hash
+
+    Arguments:
+        cachedir (str): where the objects are kept
+        verify (bool): check objects against their hash as they're written
+                       to or copied out of the cache. Objects that pass are
+                       recorded as verified, and aren't checked again.
+        algorithm (str): hash algorithm of the objects
+
+    Chunked files are assembled in the cache, after which their chunks are
+    read from the assembled file rather than kept as well.
+    """
+    def __init__(self, cachedir, verify=False, algorithm="sha1"):
         self.cachedir = os.path.abspath(cachedir)
         self.verify = verify
+        self.algorithm = algorithm
+        # sha1 objects stay where they always were
+        if algorithm == "sha1":
+            self.root = self.cachedir
+        else:
+            self.root = os.path.join(self.cachedir, algorithm)
+        self._verified = None
+        self._chunk_index = None
 
     def makepath(self, h):
-        bits = "{0}/{1}/{2}".format(h[0], h[1], h)
-        return os.path.join(self.cachedir, bits)
+        return os.path.join(self.root, h[0], h[1], h)
+
+    @property
+    def verified(self):
+        "Hashes of the cached objects that have been checked"
+        if self._verified is None:
+            self._verified = set()
+            try:
+                with open(os.path.join(self.root, "verified"), 'rb') as f:
+                    self._verified.update(line.strip().decode('ascii') for line in f)
+            except IOError:
+                pass
+        return self._verified
+
+    def record_verified(self, h):
+        "Records that the cached object h matches its hash"
+        if h in self.verified:
+            return
+        self.verified.add(h)
+        mkdirs(self.root)
+        # One write per hash, so other processes using the cache can append
+        # at the same time
+        fd = os.open(os.path.join(self.root, "verified"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, h.encode('ascii') + b'\n')
+        finally:
+            os.close(fd)
 
     def __contains__(self, h):
         p = self.makepath(h)
         return os.path.exists(p)
 
-    def copy_from_cache(self, h, dest):
-        log.info("Copying %s to %s", h, dest)
-        dirname = os.path.dirname(dest)
-        mkdirs(dirname)
-
+    @property
+    def chunk_index(self):
+        "Chunk hash to the (hash, offset) of an assembled file that holds it"
+        if self._chunk_index is None:
+            self._chunk_index = {}
+            try:
+                with open(os.path.join(self.root, "chunks"), 'rb') as f:
+                    for line in f:
+                        bits = line.decode('ascii').split()
+                        if len(bits) == 3:
+                            self._chunk_index[bits[0]] = (bits[1], int(bits[2]))
+            except IOError:
+                pass
+        return self._chunk_index
+
+    def record_chunks(self, h, chunks):
+        "Records that the cached file h holds chunks, a list of (hash, size)"
+        lines = []
+        for offset, ch, size in chunk_offsets(chunks):
+            self.chunk_index[ch] = (h, offset)
+            lines.append("{} {} {}\n".format(ch, h, offset))
+        mkdirs(self.root)
+        # One write per file, like record_verified
+        fd = os.open(os.path.join(self.root, "chunks"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(lines).encode('ascii'))
+        finally:
+            os.close(fd)
+
+    def find_chunk(self, ch, size):
+        """
+        Returns where to read chunk ch of size bytes from: the path of the
+        cached object ch, or the (path, offset, size) of the chunk within an
+        assembled file in the cache. Returns None if we have neither.
+        """
+        if ch in self:
+            return self.makepath(ch)
+        held = self.chunk_index.get(ch)
+        if held and held[0] in self:
+            return (self.makepath(held[0]), held[1], size)
+        return None
+
+    def drop_chunks(self, hashes):
+        "Removes the cached objects of chunks that assembled files hold"
+        dropped = 0
+        for ch in hashes:
+            held = self.chunk_index.get(ch)
+            if held and held[0] != ch and held[0] in self and ch in self:
+                try:
+                    os.unlink(self.makepath(ch))
+                    dropped += 1
+                except OSError:
+                    pass
+        if dropped:
+            log.debug("dropped %i chunks held by assembled files", dropped)
+
+    def check(self, h):
+        """
+        With verify, hashes the cached object h if it hasn't been verified
+        yet, removing it if it's corrupt
+
+        Returns:
+            False if the object was corrupt, otherwise True
+        """
+        if not self.verify or h in self.verified:
+            return True
         src = self.makepath(h)
-        shutil.copyfile(src, dest)
+        actual = get_algorithm(self.algorithm).hash_file(src)
+        if actual != h:
+            log.warning("%s", CorruptObject(src, h, actual))
+            METRICS.incr("hashsync_corrupt_objects_total")
+            os.unlink(src)
+            return False
+        self.record_verified(h)
+        return True
+
+    def copy_from_cache(self, h, dest, makedirs=True):
+        """
+        Copies the cached object h to dest, creating its directory unless
+        makedirs is False. With verify, objects that haven't been verified
+        yet are hashed on their way to dest; a corrupt one is removed from
+        the cache and CorruptObject is raised.
+        """
+        log.info("Copying %s to %s", h, dest)
+        with METRICS.stage("materialize"):
+            if makedirs:
+                mkdirs(os.path.dirname(dest))
+
+            src = self.makepath(h)
+            if not self.verify or h in self.verified:
+                shutil.copyfile(src, dest)
+                return
+
+            with open(src, 'rb') as f, open(dest, 'wb') as out:
+                out = HashingWriter(out, get_algorithm(self.algorithm).hasher)
+                copy_stream(f, out)
+            if out.hexdigest() != h:
+                os.unlink(src)
+                os.unlink(dest)
+                METRICS.incr("hashsync_corrupt_objects_total")
+                raise CorruptObject(src, h, out.hexdigest())
+            self.record_verified(h)
+
+    def assemble(self, h, chunks):
+        """
+        Puts a chunked file into the cache from its cached chunks
+
+        Arguments:
+            h (str): hash of the file
+            chunks (list): (hash, size) of each chunk
+        """
+        log.info("Assembling %s from %i chunks", h, len(chunks))
+        with METRICS.stage("materialize"):
+            dst = self.makepath(h)
+            mkdirs(os.path.dirname(dst))
+            tmpname = "{}.tmp{}".format(dst, os.getpid())
+            try:
+                with open(tmpname, 'wb') as f:
+                    if self.verify:
+                        f = HashingWriter(f, get_algorithm(self.algorithm).hasher)
+                    assemble([self.find_chunk(ch, size) for ch, size in chunks], f)
+                if self.verify:
+                    if f.hexdigest() != h:
+                        METRICS.incr("hashsync_corrupt_objects_total")
+                        raise CorruptObject(dst, h, f.hexdigest())
+                    self.record_verified(h)
+                os.rename(tmpname, dst)
+                self.record_chunks(h, chunks)
+            finally:
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
+
+
+def _download_to(bucket, keyname, info, tmpname, segment_jobs, algorithm):
+    """
+    Downloads keyname to tmpname
+
+    Returns:
+        the hash of what was written if algorithm is given, otherwise None
+    """
+    new_hasher = algorithm.hasher if algorithm else None
+    if segment_jobs > 1:
+        hasher = OrderedHasher(new_hasher(), tmpname) if algorithm else None
+        if info.content_encoding != 'gzip' and info.size >= config.SEGMENTED_MINSIZE:
+            download_ranges(bucket, keyname, tmpname, info.size, jobs=segment_jobs, hasher=hasher)
+            return hasher and hasher.hexdigest()
+        # Large files compress to much smaller objects; anything bigger
+        # than a segment might have been split up
+        if info.content_encoding == 'gzip' and info.size > config.SEGMENT_SIZE and \
+                download_gzip_segments(bucket, keyname, tmpname, info.size, jobs=segment_jobs, hasher=hasher):
+            return hasher and hasher.hexdigest()
+
+    with open(tmpname, 'wb') as f:
+        if algorithm:
+            f = HashingWriter(f, new_hasher)
+        if info.content_encoding == 'gzip':
+            # Download to a tmpfile first
+            tmp = tempfile.TemporaryFile()
+            bucket.get_to_file(keyname, tmp)
+            tmp.seek(0)
+            with METRICS.stage("decompress"):
+                decompress_stream(tmp, f)
+        else:
+            bucket.get_to_file(keyname, f)
+    return f.hexdigest() if algorithm else None
 
 
 # This is a standalone function rather than an instance method above so that it
 # can be called via multiprocessing more easily
-def download_key(keyname, dst):
+def download_key(keyname, dst, segment_jobs=config.SEGMENT_JOBS, algorithm=None):
+    """
+    Downloads keyname to dst
+
+    Arguments:
+        keyname (str): object to download
+        dst (str): where to put it, usually a path in a FileCache
+        segment_jobs (int): how many byte ranges of large objects to
+                            download at once
+        algorithm (str): if given, the object is hashed with this algorithm
+                         as it's written, and downloaded again if it doesn't
+                         match the hash at the end of keyname. dst is only
+                         written once it matches.
+    """
     log.info("Downloading %s to %s", keyname, dst)
     bucket = get_bucket()
-    k = bucket.get_key(keyname)
+    info = bucket.head(keyname)
 
-    if not k:
+    if not info:
         log.error("couldn't find %s", keyname)
         raise ValueError("couldn't find %s" % keyname)
 
     dirname = os.path.dirname(dst)
     mkdirs(dirname)
-
-    with open(dst, 'wb') as f:
-        if k.content_encoding == 'gzip':
-            # Download to a tmpfile first
-            tmp = tempfile.TemporaryFile()
-            copy_stream(k, tmp)
-            tmp.seek(0)
-            decompress_stream(tmp, f)
+    if algorithm:
+        algorithm = get_algorithm(algorithm)
+        expected = keyname.rsplit("/", 1)[-1]
+    else:
+        expected = None
+
+    # Write to a temporary name so a failed download doesn't leave a partial
+    # file behind in the cache
+    tmpname = "{}.tmp{}".format(dst, os.getpid())
+    try:
+        for attempt in range(1, config.VERIFY_ATTEMPTS + 1):
+            h = _download_to(bucket, keyname, info, tmpname, segment_jobs, algorithm)
+            if h == expected:
+                break
+            METRICS.incr("hashsync_corrupt_objects_total")
+            log.warning("%s is corrupt: its contents hash to %s (attempt %i of %i)",
+                        keyname, h, attempt, config.VERIFY_ATTEMPTS)
         else:
-            copy_stream(k, f)
+            raise CorruptObject(keyname, expected, h)
+        os.rename(tmpname, dst)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+class DownloadPlan(object):
+    """
+    What needs fetching and copying into place to bring one or more
+    directories up to date with their manifests. Objects are keyed by their
+    key name, so an object needed by several manifests, or several times by
+    one, is fetched once and copied to every file that needs it.
+
+    Arguments:
+        cache_dir (str): where objects are cached locally
+        verify (bool): check objects against their hashes; see FileCache.
+                       Files copied from verified objects are remembered,
+                       so they don't need hashing next time.
+        caches (dict): algorithm name to FileCache, to share caches between
+                       plans; by default the plan has its own
+
+    Attributes:
+        tasks (list): (size, key name) of each object to download
+        objects (dict): key name to the (FileCache, hash) of each object
+                        that's being downloaded or assembled
+        files (dict): key name to the (filename, KnownFiles) of each file to
+                      copy the object to once it's in the cache
+        to_assemble (dict): key name to the (hash, size) of the chunks of
+                            each chunked file to assemble once its chunks
+                            have been downloaded
+        materializer (hashsync.materialize.Materializer): creates the
+                                                          directories files
+                                                          go in and sets
+                                                          their permissions
+    """
+    def __init__(self, cache_dir, verify=False, caches=None):
+        self.cache_dir = cache_dir
+        self.verify = verify
+        self.caches = {} if caches is None else caches
+        # Destination directory to its KnownFiles
+        self.known = {}
+        self.materializer = Materializer()
+        self.tasks = []
+        self.queued = set()
+        self.objects = {}
+        self.files = defaultdict(list)
+        self.to_assemble = {}
+
+    def cache(self, algorithm):
+        "Returns the FileCache for objects hashed with algorithm"
+        if algorithm.name not in self.caches:
+            self.caches[algorithm.name] = FileCache(self.cache_dir, self.verify, algorithm.name)
+        return self.caches[algorithm.name]
+
+    def _known_files(self, destdir, algorithm):
+        destdir = os.path.abspath(destdir)
+        name = hashlib.sha1(destdir.encode('utf8')).hexdigest()
+        known = KnownFiles(os.path.join(self.cache_dir, "known", name), algorithm.name)
+        known.load()
+        self.known[destdir] = known
+        return known
+
+    def _fetch(self, cache, algorithm, h, size):
+        keyname = algorithm.key(h)
+        if keyname not in self.queued and not (h in cache and cache.check(h)):
+            self.queued.add(keyname)
+            self.objects[keyname] = (cache, h)
+            self.tasks.append((size, keyname))
+
+    def add(self, m, destdir, paths=None):
+        """
+        Plans bringing destdir up to date with a manifest. Files in destdir
+        that aren't in the manifest are removed, the directories for new
+        files are created, and files already in the cache are copied into
+        place straight away. Permissions are set by finish().
+
+        Arguments:
+            m (hashsync.manifest.Manifest): the files destdir should have
+            destdir (str): directory to populate
+            paths (hashsync.pathfilter.PathFilter): the part of the manifest
+                                                    and destdir to work on;
+                                                    by default all of it
+        """
+        paths = paths or PathFilter()
+        algorithm = get_algorithm(m.algorithm)
+        cache = self.cache(algorithm)
+        known = self._known_files(destdir, algorithm)
+        # Only the selected part of the manifest and of destdir are looked at
+        selected = paths.select(m)
+        if paths:
+            log.info("%i of %i files selected", len(selected), len(m.files))
+        manifest_files = {(h, filename) for (h, filename, perms) in selected}
+        perms = dict((filename, p) for (h, filename, p) in selected)
+        materializer = self.materializer
+
+        # Set of (h, filename) objects we have locally
+        local_files = set()
+
+        if os.path.exists(destdir):
+            materializer.exists(destdir)
+            # Files copied from verified objects last time don't need hashing
+            # again if they haven't changed
+            hash_file = known.hasher(timed("hash", algorithm.hash_file))
+            if paths:
+                local = paths.traverse(destdir, hash_file)
+            else:
+                local = traverse_directory(destdir, hash_file)
+            for filename, h in local:
+                materializer.exists(os.path.dirname(filename))
+                stripped = strip_leading(destdir, filename)
+                local_files.add((h, stripped))
+
+        # Remove files that aren't in the manifest
+        to_remove = local_files - manifest_files
+        for h, filename in to_remove:
+            log.info("Removing %s %s", h, filename)
+            os.unlink(os.path.join(destdir, filename))
+            known.discard(os.path.join(destdir, filename))
+
+        ok = local_files & manifest_files
+        for h, filename in ok:
+            log.debug("OK %s %s", h, filename)
+            # Files whose permissions are all that changed just need a chmod
+            materializer.existing(os.path.join(destdir, filename), perms[filename])
+
+        to_add = manifest_files - local_files
+        # Every directory the new files need, made once up front
+        materializer.make_dirs([os.path.join(destdir, filename) for h, filename in to_add])
+
+        for h, filename in to_add:
+            dest = os.path.join(destdir, filename)
+            materializer.created(dest, perms[filename])
+            keyname = algorithm.key(h)
+            if keyname in self.files:
+                # We're already fetching this, make a note of the additional
+                # filename
+                self.files[keyname].append((dest, known))
+            elif h == algorithm.zero:
+                # Zero byte file!
+                with METRICS.stage("materialize"):
+                    touch(dest, makedirs=False)
+                known.add(dest, h)
+            elif h not in cache or not self._copy(cache, h, dest, known):
+                # Not cached, or the cached copy was corrupt
+                self.files[keyname].append((dest, known))
+                self.objects[keyname] = (cache, h)
+                if h in m.chunks:
+                    # Only fetch the chunks we don't have yet
+                    self.to_assemble[keyname] = m.chunks[h]
+                    for ch, size in m.chunks[h]:
+                        if ch not in cache and cache.find_chunk(ch, size):
+                            # Held by a file assembled before
+                            continue
+                        self._fetch(cache, algorithm, ch, size)
+                else:
+                    # Older manifests don't record sizes; those downloads keep
+                    # their order after the ones we know the size of
+                    self._fetch(cache, algorithm, h, m.sizes.get(h, 0))
+
+    def _copy(self, cache, h, dest, known):
+        try:
+            cache.copy_from_cache(h, dest, makedirs=False)
+        except CorruptObject as e:
+            log.warning("%s; downloading it again", e)
+            return False
+        if cache.verify and h in cache.verified:
+            known.add(dest, h)
+        return True
+
+    def downloaded(self, keyname):
+        """
+        Records that the object keyname has been downloaded to the cache,
+        verified if the cache verifies objects, and copies it into place
+        """
+        cache, h = self.objects[keyname]
+        if cache.verify:
+            cache.record_verified(h)
+        self.materialize(keyname)
+
+    def materialize(self, keyname):
+        "Copies the object keyname from the cache to every file that needs it"
+        cache, h = self.objects[keyname]
+        for dest, known in self.files.get(keyname, []):
+            cache.copy_from_cache(h, dest, makedirs=False)
+            if cache.verify and h in cache.verified:
+                known.add(dest, h)
+
+    def drop_chunks(self):
+        """
+        Removes the chunks of the files that have been assembled from the
+        cache, apart from any that are files in their own right
+        """
+        for keyname, chunks in self.to_assemble.items():
+            cache, h = self.objects[keyname]
+            algorithm = get_algorithm(cache.algorithm)
+            cache.drop_chunks([ch for ch, _ in chunks if algorithm.key(ch) not in self.files])
+
+    def finish(self):
+        """
+        Sets the permissions of the files that need it, once everything has
+        been copied into place, and saves the hashes of the files that won't
+        need hashing next time
+        """
+        self.materializer.apply()
+        for known in self.known.values():
+            known.save()
+
+
+def download_manifests(pairs, plan, pool, jobs, paths=None, adaptive=False, min_jobs=1, largest_first=True,
+                       segment_jobs=config.SEGMENT_JOBS):
+    """
+    Brings directories up to date with their manifests
+
+    Arguments:
+        pairs (list): (manifest filename, directory) tuples
+        plan (DownloadPlan): plan to add the manifests to
+        pool (multiprocessing.Pool): workers to download with; it's left
+                                     running
+        jobs (int): how many downloads to do at once; with adaptive, the
+                    most to do at once
+        paths (hashsync.pathfilter.PathFilter): the part of each manifest
+                                                and directory to work on
+        adaptive (bool): adjust how many downloads are in flight based on
+                         throughput, latency and throttling
+        min_jobs (int): fewest downloads to have in flight with adaptive
+        largest_first (bool): start the biggest downloads first
+        segment_jobs (int): how many byte ranges of each large object to
+                            download at once
+    """
+    for manifest, destdir in pairs:
+        m = Manifest()
+        with open(manifest, 'rb') as f:
+            m.load(f)
+        plan.add(m, destdir, paths)
+    tasks = plan.tasks
+    if len(pairs) > 1:
+        log.info("%i objects to fetch for %i destinations", len(tasks), len(pairs))
+
+    submitter = JobSubmitter(pool, make_concurrency(jobs, adaptive, min_jobs))
+    download_jobs = []
+
+    # Start the biggest downloads first so the run doesn't end with one big
+    # file downloading on its own
+    start = time.time()
+    for size, keyname in schedule(tasks, jobs, largest_first):
+        cache, h = plan.objects[keyname]
+        job = submitter.submit(download_key, (keyname, cache.makepath(h), segment_jobs,
+                                              cache.algorithm if cache.verify else None), nbytes=size)
+        download_jobs.append((job, keyname))
+
+    for job, keyname in download_jobs:
+        result(job)
+        plan.downloaded(keyname)
+
+    for keyname, chunks in plan.to_assemble.items():
+        cache, h = plan.objects[keyname]
+        cache.assemble(h, chunks)
+        plan.materialize(keyname)
+    plan.drop_chunks()
+
+    plan.finish()
+    if tasks:
+        log.info("transfers took %.2fs", time.time() - start)
 
 
 def main():
     import multiprocessing
     import argparse
-    from collections import defaultdict
 
     parser = argparse.ArgumentParser()
     # TODO: These aren't required if no-upload is set
-    parser.add_argument("-r", "--region", dest="region", required=True)
-    parser.add_argument("-b", "--bucket", dest="bucket_name", required=True)
+    parser.add_argument("-r", "--region", dest="region")
+    parser.add_argument("-b", "--bucket", dest="bucket_name")
+    parser.add_argument("-u", "--url", dest="url",
+                        help="storage backend URL to use instead of --region and --bucket, "
+                        "e.g. s3://bucket?region=us-east-1 or file:///path")
     parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const=logging.WARN, default=logging.INFO)
     parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const=logging.DEBUG)
     parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="how many simultaneous downloads to do", default=8)
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=False,
+                        help="adjust how many downloads are in flight, up to --jobs, based on throughput, latency "
+                        "and throttling")
+    parser.add_argument("--min-jobs", dest="min_jobs", type=int, default=1,
+                        help="with --adaptive, the fewest downloads to keep in flight")
+    parser.add_argument("--segment-jobs", dest="segment_jobs", type=int, default=config.SEGMENT_JOBS,
+                        help="how many byte ranges of each large object to download at once; 1 downloads "
+                        "objects whole")
+    parser.add_argument("--no-schedule", dest="largest_first", action="store_false", default=True,
+                        help="download objects in manifest order rather than largest first")
     parser.add_argument("-o", "--output", dest="output", help="where to output manifet, use '-' for stdout")
     parser.add_argument("--cache-dir", dest="cache_dir", help="where to cache objects locally", required=True)
+    parser.add_argument("--no-verify", dest="verify", action="store_false", default=True,
+                        help="don't check downloaded and cached objects against their hashes")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=config.REQUEST_TIMEOUT,
+                        help="seconds to wait for each request before retrying it; 0 waits forever")
+    parser.add_argument("--attempts", dest="attempts", type=int, default=config.REQUEST_MAX_ATTEMPTS,
+                        help="how many times to try each request")
+    parser.add_argument("--hedge", dest="hedge", action="store_true", default=False,
+                        help="send a duplicate request for reads that are slower than almost all recent reads")
+    parser.add_argument("--metrics-json", dest="metrics_json", help="write transfer metrics to this file as JSON")
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        help="write transfer metrics to this file in the Prometheus text format")
+    parser.add_argument("--profile", dest="profile", metavar="DIR",
+                        help="profile this process and its workers, writing the profiles and a merged report to DIR")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true", default=False,
+                        help="with --profile, also take tracemalloc snapshots")
+    parser.add_argument("--include", dest="include", action="append", metavar="PATTERN",
+                        help="only materialize paths matching PATTERN, e.g. a directory or a glob like '*.so'; "
+                        "may be given more than once. Files outside the selected paths are left alone")
+    parser.add_argument("--exclude", dest="exclude", action="append", metavar="PATTERN",
+                        help="don't materialize, or remove, paths matching PATTERN; may be given more than once")
     parser.add_argument("manifest", help="manifest to load")
     parser.add_argument("destdir", help="target directory to populate")
+    parser.add_argument("more", nargs="*", metavar="MANIFEST DESTDIR",
+                        help="more manifests and the directories to populate from them; objects they have in "
+                        "common are only downloaded once")
 
     args = parser.parse_args()
+    if len(args.more) % 2:
+        parser.error("each extra manifest needs a destination directory")
+    pairs = [(args.manifest, args.destdir)] + list(zip(args.more[::2], args.more[1::2]))
+    destdirs = [os.path.abspath(d) for _, d in pairs]
+    if len(set(destdirs)) != len(destdirs):
+        parser.error("each destination directory can only be given once")
+
     logging.basicConfig(level=args.loglevel, format="%(asctime)s - %(message)s")
     # Make boto shut up
     # TODO: Add -v -v support to set this to DEBUG?
     logging.getLogger('boto').setLevel(logging.INFO)
 
-    connect(args.region, args.bucket_name)
-
-    m = Manifest()
-    m.load(open(args.manifest, 'rb'))
-    manifest_files = {(h, filename) for (h, filename, perms) in m.files}
-
-    # Set of (h, filename) objects we have locally
-    local_files = set()
-
-    destdir = args.destdir
-
-    if os.path.exists(destdir):
-        for filename, h in traverse_directory(destdir, sha1sum):
-            stripped = strip_leading(destdir, filename)
-            local_files.add((h, stripped))
+    if args.profile:
+        profiling.start(args.profile, memory=args.profile_memory)
 
-    # Remove files that aren't in the manifest
-    to_remove = local_files - manifest_files
-    for h, filename in to_remove:
-        log.info("Removing %s %s", h, filename)
-        os.unlink(os.path.join(destdir, filename))
+    policy = TransferPolicy(timeout=args.timeout or None, max_attempts=args.attempts, hedge=args.hedge)
 
-    ok = local_files & manifest_files
-    for h, filename in ok:
-        log.debug("OK %s %s", h, filename)
-
-    # TODO: Handle updating permissions
-    to_add = manifest_files - local_files
-    cache = FileCache(args.cache_dir)
-
-    pool = multiprocessing.Pool(args.jobs)
-
-    download_jobs = []
-    files_by_hash = defaultdict(list)
-
-    for h, filename in to_add:
-        dest = os.path.join(destdir, filename)
-        if h in files_by_hash:
-            # We're already fetching this, make a note of the additional
-            # filename
-            files_by_hash[h].append(dest)
-        elif h == SHA1SUM_ZERO:
-            # Zero byte file!
-            touch(dest)
-        elif h not in cache:
-            cache_filename = cache.makepath(h)
-            keyname = "objects/{}".format(h)
-            job = pool.apply_async(download_key, (keyname, cache_filename))
-            files_by_hash[h].append(dest)
-            download_jobs.append((job, h))
-        else:
-            cache.copy_from_cache(h, dest)
-
-    for job, h in download_jobs:
-        job.get()
-        for dest in files_by_hash[h]:
-            cache.copy_from_cache(h, dest)
+    if args.url:
+        connect_url(args.url, policy)
+    elif args.region and args.bucket_name:
+        connect(args.region, args.bucket_name, policy)
+    else:
+        parser.error("either --url or --region and --bucket are required")
 
+    paths = PathFilter(args.include, args.exclude)
+    plan = DownloadPlan(args.cache_dir, verify=args.verify)
+    pool = multiprocessing.Pool(args.jobs, initializer=profiling.init_worker)
+    download_manifests(pairs, plan, pool, args.jobs, paths, adaptive=args.adaptive, min_jobs=args.min_jobs,
+                       largest_first=args.largest_first, segment_jobs=args.segment_jobs)
     pool.close()
     pool.join()
 
+    METRICS.log_summary()
+    METRICS.write(args.metrics_json, args.metrics_prom)
+    profiling.stop()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content-defined chunking of large files
+
+Large files can be stored as a series of chunk objects, so that a small
+change to a big file only means uploading and downloading the chunks around
+the change. Chunk boundaries are picked FastCDC style: a "gear" rolling hash
+is computed over the data, and a chunk ends where the hash's top bits are
+all zero. Because boundaries depend on the content rather than on offsets,
+inserting or removing data only moves the boundaries near the edit.
+
+Following FastCDC, no boundary is looked for in the first min_size bytes of
+a chunk, a stricter mask is used before avg_size and a looser one after it
+so that chunk sizes cluster around avg_size, and chunks are cut at max_size
+regardless.
+
+Chunks are stored as ordinary objects named after their hash, so they're
+deduplicated, listed, refreshed and garbage collected like any other object.
+The list of a file's chunks is stored next to them as an object named after
+the file's hash plus CHUNKLIST_SUFFIX, so uploading the file again doesn't
+mean chunking it again.
+"""
+import hashlib
+import json
+import struct
+
+from hashsync.utils import iterfile
+from hashsync.hashing import get_algorithm
+from hashsync.metrics import METRICS
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Gear table of one 64 bit value per byte value. Chunk boundaries depend on
+# these, so they must never change
+GEAR = [struct.unpack('>Q', hashlib.sha1(struct.pack('B', i)).digest()[:8])[0] for i in range(256)]
+MASK64 = 0xffffffffffffffff
+
+# Suffix of the names of stored chunk lists, after the file's hash
+CHUNKLIST_SUFFIX = ".chunks"
+
+
+def _mask(bits):
+    # The top bits of the gear hash depend on the most bytes, so use those
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _cut(data, start, end, min_size, avg_size, max_size, mask_s, mask_l):
+    """
+    Finds where the chunk starting at data[start] ends
+
+    Returns:
+        the offset just past the chunk, or end if no boundary was found
+        before end
+    """
+    n = min(end, start + max_size)
+    i = start + min_size
+    if i >= n:
+        return n
+    normal = min(start + avg_size, n)
+    gear = GEAR
+    h = 0
+    # Iterating over a slice is a good deal faster than indexing
+    for i, c in enumerate(data[i:normal], i + 1):
+        h = ((h << 1) + gear[c]) & MASK64
+        if not h & mask_s:
+            return i
+    for i, c in enumerate(data[normal:n], normal + 1):
+        h = ((h << 1) + gear[c]) & MASK64
+        if not h & mask_l:
+            return i
+    return n
+
+
+def iter_chunks(fobj, min_size=config.CHUNK_MIN_SIZE, avg_size=config.CHUNK_AVG_SIZE,
+                max_size=config.CHUNK_MAX_SIZE):
+    """
+    Splits the data read from fobj into content-defined chunks
+
+    Arguments:
+        fobj (file object): stream to read data from
+        min_size (int): smallest chunk, except for the last one
+        avg_size (int): target average chunk size; should be a power of 2
+        max_size (int): largest chunk
+
+    Yields:
+        chunks of data as bytes
+    """
+    bits = avg_size.bit_length() - 1
+    mask_s = _mask(bits + 1)
+    mask_l = _mask(bits - 1)
+
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            block = fobj.read(max_size)
+            if not block:
+                eof = True
+            buf.extend(block)
+        if not buf:
+            break
+        # Unless we're at the end, buf holds at least max_size bytes, so a
+        # chunk can always be cut
+        end = _cut(buf, 0, len(buf), min_size, avg_size, max_size, mask_s, mask_l)
+        yield bytes(buf[:end])
+        del buf[:end]
+
+
+def chunk_file(filename, algorithm="sha1", **kwargs):
+    """
+    Splits a file into content-defined chunks
+
+    Arguments:
+        filename (str): path to local file
+        algorithm (str): name of the hashsync.hashing algorithm to identify
+                         chunks with
+        kwargs: passed on to iter_chunks
+
+    Returns:
+        a list of (hash, size) for each chunk, in order
+    """
+    algorithm = get_algorithm(algorithm)
+    retval = []
+    with METRICS.stage("chunk"), open(filename, 'rb') as f:
+        for chunk in iter_chunks(f, **kwargs):
+            retval.append((algorithm.hash_data(chunk), len(chunk)))
+    log.debug("%s has %i chunks", filename, len(retval))
+    return retval
+
+
+def chunk_offsets(chunks):
+    """
+    Yields (offset, hash, size) for each chunk in a list from chunk_file
+    """
+    offset = 0
+    for h, size in chunks:
+        yield offset, h, size
+        offset += size
+
+
+def chunklist_name(h):
+    "Returns the object name the chunk list of the file with hash h is stored under"
+    return h + CHUNKLIST_SUFFIX
+
+
+def encode_chunklist(chunks):
+    "Encodes a list of (hash, size) from chunk_file to store it"
+    return json.dumps([[h, size] for h, size in chunks], separators=(',', ':')).encode('ascii')
+
+
+def decode_chunklist(data):
+    "Decodes a chunk list stored with encode_chunklist"
+    return [(h, size) for h, size in json.loads(data.decode('ascii'))]
+
+
+def assemble(chunk_files, dst):
+    """
+    Concatenates chunks into dst
+
+    Arguments:
+        chunk_files (list): the chunks, in order; either paths to files
+                            holding each chunk, or (path, offset, size) of
+                            the chunk within a bigger file
+        dst (file object): where to write the data
+    """
+    for source in chunk_files:
+        if isinstance(source, tuple):
+            filename, offset, size = source
+        else:
+            filename, offset, size = source, 0, None
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            for block in iterfile(f):
+                if size is not None:
+                    block = block[:size]
+                    size -= len(block)
+                dst.write(block)
+                if size == 0:
+                    break
+        if size:
+            raise IOError("{} ends {} bytes before the chunk at {}".format(filename, size, offset))
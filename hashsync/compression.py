@@ -6,8 +6,10 @@ compression module for hashsync
 
 import gzip
 import os
-from io import BytesIO
+import struct
 import tempfile
+import zlib
+from io import BytesIO
 
 from hashsync.utils import iterfile
 from hashsync import config
@@ -18,6 +20,15 @@ log = logging.getLogger(__name__)
 
 GZIP_MAGIC = b'\x1f\x8b'
 
+# Subfield ID of the segment index in the gzip header's extra field
+SEGMENT_INDEX_ID = b'HS'
+# Version, uncompressed size, segment size and number of segments, followed by
+# the offset of each gzip member
+SEGMENT_INDEX_HEADER = '<BQQI'
+SEGMENT_INDEX_VERSION = 1
+# The extra field can be at most 65535 bytes
+MAX_SEGMENTS = (65535 - 4 - struct.calcsize(SEGMENT_INDEX_HEADER)) // 8
+
 
 def compress_stream(src, dst):
     """
@@ -37,6 +48,125 @@ def compress_stream(src, dst):
             gz.write(block)
 
 
+def _gzip_header(extra=None):
+    # mtime is 0 and the OS unknown so the output only depends on the input
+    flags = 4 if extra is not None else 0
+    header = GZIP_MAGIC + struct.pack('<BBIBB', 8, flags, 0, 0, 255)
+    if extra is not None:
+        header += struct.pack('<H', len(extra)) + extra
+    return header
+
+
+def _segment_index(size, segment_size, offsets):
+    data = struct.pack(SEGMENT_INDEX_HEADER, SEGMENT_INDEX_VERSION, size, segment_size, len(offsets))
+    data += struct.pack('<{}Q'.format(len(offsets)), *offsets)
+    return SEGMENT_INDEX_ID + struct.pack('<H', len(data)) + data
+
+
+def compress_segmented(src, dst, size, segment_size=config.SEGMENT_SIZE):
+    """
+    Compresses data from file object src into dst as a series of gzip
+    members, each covering segment_size bytes of the input. The header of
+    the first member records where every member starts, so ranges of the
+    compressed data can be fetched and decompressed independently; see
+    read_segment_index. The result is still an ordinary gzip stream.
+
+    Arguments:
+        src (file object): stream to read data from
+        dst (file object): seekable stream to write compressed data to
+        size (int): expected size of the input; any data past this goes in
+                    the last member
+        segment_size (int): bytes of input per member; raised if needed to
+                            keep the number of members under MAX_SEGMENTS
+
+    Returns:
+        None
+    """
+    segment_size = max(segment_size, -(-size // MAX_SEGMENTS))
+    n = max(1, -(-size // segment_size))
+    start = dst.tell()
+    # Reserve room for the index; it's filled in at the end
+    dst.write(_gzip_header(_segment_index(0, 0, [0] * n)))
+
+    offsets = []
+    total = 0
+    for i in range(n):
+        if i > 0:
+            offsets.append(dst.tell() - start)
+            dst.write(_gzip_header())
+        else:
+            offsets.append(0)
+        c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = 0
+        length = 0
+        while True:
+            if i < n - 1:
+                blocksize = min(1024 ** 2, segment_size - length)
+                if blocksize == 0:
+                    break
+            else:
+                blocksize = 1024 ** 2
+            block = src.read(blocksize)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            length += len(block)
+            dst.write(c.compress(block))
+        dst.write(c.flush())
+        dst.write(struct.pack('<II', crc & 0xffffffff, length & 0xffffffff))
+        total += length
+
+    end = dst.tell()
+    dst.seek(start)
+    dst.write(_gzip_header(_segment_index(total, segment_size, offsets)))
+    dst.seek(end)
+
+
+def read_segment_index(header):
+    """
+    Reads the segment index written by compress_segmented
+
+    Arguments:
+        header (bytes): the start of the compressed data; must include the
+                        whole gzip header
+
+    Returns:
+        (size, segment_size, offsets), where size is the size of the
+        uncompressed data, and offsets are where each gzip member starts.
+        None if the data isn't segmented.
+    """
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not struct.unpack('<B', header[3:4])[0] & 4:
+        return None
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        sid = extra[pos:pos + 2]
+        length = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        data = extra[pos + 4:pos + 4 + length]
+        pos += 4 + length
+        if sid != SEGMENT_INDEX_ID:
+            continue
+        hsize = struct.calcsize(SEGMENT_INDEX_HEADER)
+        version, size, segment_size, n = struct.unpack(SEGMENT_INDEX_HEADER, data[:hsize])
+        if version != SEGMENT_INDEX_VERSION:
+            return None
+        offsets = list(struct.unpack('<{}Q'.format(n), data[hsize:hsize + 8 * n]))
+        return size, segment_size, offsets
+    return None
+
+
+def decompress_member(data):
+    """
+    Decompresses a single gzip member, checking its CRC
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    retval = d.decompress(data) + d.flush()
+    if d.unused_data or not d.eof:
+        raise ValueError("expected exactly one gzip member")
+    return retval
+
+
 def decompress_stream(src, dst):
     """
     Decompresses data from file object src and writes it to file object dst
@@ -78,7 +208,11 @@ def compress_file(filename, in_memsize=config.COMPRESS_INMEM_SIZE):
         else:
             dst = BytesIO()
 
-        compress_stream(src, dst)
+        if filesize >= config.SEGMENTED_MINSIZE:
+            # Large files are split up so they can be downloaded in parallel
+            compress_segmented(src, dst, filesize)
+        else:
+            compress_stream(src, dst)
         size = dst.tell()
         dst.seek(0)
         return size, dst
@@ -110,9 +244,11 @@ def maybe_compress(filename, compress_minsize=config.COMPRESS_MINSIZE):
     return compressed_fobj, True
 
 
-def gzip_compress(data):
+def gzip_compress(data, mtime=None):
     f = BytesIO()
-    gz = gzip.GzipFile(mode='wb', fileobj=f)
+    # Passing mtime=0 makes the output depend only on data, so the result can
+    # be compared against a remote ETag
+    gz = gzip.GzipFile(mode='wb', fileobj=f, mtime=mtime)
     gz.write(data)
     gz.close()
     return f.getvalue()
@@ -15,11 +15,157 @@ COMPRESS_INMEM_SIZE = 104857600
 # Minimum time before refreshing the last_modified time of the key
 REFRESH_MINTIME = 86400
 
-# one out of every N objects should be randomly refreshed per upload
-REFRESH_EVERY_NTH_OBJECTS = 10000
+# objects in the object list are refreshed some time between REFRESH_MINTIME
+# and REFRESH_MINTIME + REFRESH_WINDOW after they were last modified,
+# depending on their hash. this should finish before make_manifest.py drops
+# them from the object list (a week by default)
+REFRESH_WINDOW = 86400 * 5
+
+# maximum number of objects in the object list to refresh per upload
+REFRESH_MAX_PER_RUN = 1000
 
 # how long we'll wait before giving up on an upload
 MAX_UPLOAD_TIME = 3600
 
 # time to wait before actually deleting old objects from the bucket
 PURGE_TIME = 86400 * 30
+
+# number of leading hex digits of the hash used to split the object list into
+# shards; 2 gives 256 shards
+OBJECTLIST_SHARD_WIDTH = 2
+
+# multi-object delete requests per second to start reaping at; the rate
+# adjusts itself between the min and max depending on whether we're being
+# throttled
+DELETE_RATE = 1.0
+DELETE_MIN_RATE = 0.1
+DELETE_MAX_RATE = 50.0
+
+# how many times to try deleting a key before giving up
+DELETE_MAX_ATTEMPTS = 5
+
+# when deleting objects that aren't referenced by any manifest, objects
+# modified less than this long ago are kept, so uploads that haven't written
+# their manifest yet don't lose their objects
+GC_GRACE_TIME = 86400 * 7
+
+# an interrupted make_manifest.py run is only resumed from its checkpoints
+# if it started less than this long ago; after that the objects it found may
+# have been deleted since
+CHECKPOINT_MAX_AGE = 86400
+
+# how long a request to the store may go without making progress before it
+# is abandoned and tried again. requests that stream a file count each read
+# or write as progress; others get another second for every REQUEST_MIN_RATE
+# bytes of their body, so large parts and ranges aren't cut off
+REQUEST_TIMEOUT = 300
+REQUEST_MIN_RATE = 64 * 1024
+
+# how many times to try each request to the store
+REQUEST_MAX_ATTEMPTS = 5
+
+# failed requests are retried after a random delay of up to
+# REQUEST_BACKOFF * 2 ** (attempt - 1) seconds, capped at REQUEST_MAX_BACKOFF
+REQUEST_BACKOFF = 0.5
+REQUEST_MAX_BACKOFF = 30
+
+# when hedging is on, reads that are slower than this quantile of recent reads
+# get a duplicate request, and whichever finishes first is used. hedging
+# starts once we've seen HEDGE_MIN_SAMPLES reads
+HEDGE_QUANTILE = 0.99
+HEDGE_MIN_SAMPLES = 20
+
+# objects at least this big are downloaded as several byte ranges in
+# parallel, and compressed as a series of independent gzip members so that
+# compressed objects can be split up too
+SEGMENTED_MINSIZE = 64 * 1024 * 1024
+
+# size of each range, and how much uncompressed data goes into each gzip
+# member
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# how many ranges of one object to download at once
+SEGMENT_JOBS = 4
+
+# transfers are started largest first; transfers smaller than
+# SMALL_TRANSFER_SIZE are interleaved SMALL_TRANSFER_BATCH at a time between
+# the remaining large ones
+SMALL_TRANSFER_SIZE = 1024 * 1024
+SMALL_TRANSFER_BATCH = 16
+
+# fixed cost of each transfer when estimating how long a schedule takes, in
+# bytes; roughly one round trip's worth of bandwidth
+TRANSFER_OVERHEAD = 256 * 1024
+
+# with chunking on, files at least this big are stored as content-defined
+# chunks, so changing part of a file only transfers the chunks that changed
+CHUNKED_MINSIZE = 64 * 1024 * 1024
+
+# smallest, average and largest chunk size. chunk boundaries depend on these,
+# so changing them means files are chunked differently and nothing dedupes
+# against chunks uploaded before
+CHUNK_MIN_SIZE = 512 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+# manifest format uploads write by default; see Manifest.save. format 1 can
+# be read by every download.py. format 2 adds file sizes, so downloads can
+# start the largest first, but download.py from before it can't read it, so
+# only switch once every consumer of the manifests has been upgraded.
+# manifests with chunks or hashes other than sha1 are always format 2
+MANIFEST_FORMAT = 1
+
+# how objects are identified; see hashsync.hashing. existing buckets use sha1
+HASH_ALGORITHM = "sha1"
+
+# tree hashes hash each TREE_HASH_LEAF_SIZE bytes of a file separately, using
+# up to TREE_HASH_JOBS threads; None uses one per CPU. the leaf size is part
+# of the hash, so changing it changes every object's name
+TREE_HASH_LEAF_SIZE = 4 * 1024 * 1024
+TREE_HASH_JOBS = None
+
+# when uploading with a journal, objects of files at least this big are
+# uploaded in parts of MULTIPART_PART_SIZE bytes, so an interrupted upload can
+# carry on from the last finished part. resuming relies on the file
+# compressing to the same bytes every time, which compress_segmented
+# guarantees, so this should be no smaller than SEGMENTED_MINSIZE. parts are
+# made bigger if needed to stay within MULTIPART_MAX_PARTS
+MULTIPART_MINSIZE = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+
+# results in a journal older than this aren't trusted when resuming an upload,
+# since the objects may have been cleaned up or be due a refresh by now; those
+# files are checked against the bucket again
+JOURNAL_STATE_MAX_AGE = REFRESH_MINTIME
+
+# in watch mode, a file is uploaded once it has gone WATCH_DEBOUNCE seconds
+# without changing, and a new manifest is written at most every
+# WATCH_INTERVAL seconds while files are changing
+WATCH_DEBOUNCE = 2
+WATCH_INTERVAL = 10
+
+# watch mode keeps the object list it loaded between uploads, reloading it
+# once it's WATCH_OBJECTLIST_TTL seconds old so objects that have been cleaned
+# up since are noticed
+WATCH_OBJECTLIST_TTL = 3600
+
+# watch mode tries uploading a changed file again if it fails, up to
+# WATCH_MAX_ATTEMPTS times in a row, before giving up on it until it changes
+# again
+WATCH_MAX_ATTEMPTS = 5
+
+# downloads are checked against their hash as they're written. a corrupt
+# object is downloaded up to VERIFY_ATTEMPTS times before giving up. ranges of
+# a segmented download that finish ahead of those before them are kept in
+# memory, up to VERIFY_MAX_PENDING bytes, until they can be hashed in order;
+# past that they're read back from disk
+VERIFY_ATTEMPTS = 3
+VERIFY_MAX_PENDING = 64 * 1024 * 1024
+
+# the daemon reloads an object list once it's DAEMON_OBJECTLIST_TTL seconds
+# old, so it notices objects other uploaders have published and objects that
+# have been cleaned up. it remembers the hashes of up to DAEMON_HASH_CACHE_SIZE
+# files
+DAEMON_OBJECTLIST_TTL = 300
+DAEMON_HASH_CACHE_SIZE = 250000
@@ -2,34 +2,63 @@
 # -*- coding: utf-8 -*-
 import boto.s3
 
-# Global bucket we're using
+from hashsync.storage import BotoBackend, open_backend
+from hashsync.metrics import InstrumentedBackend
+from hashsync.retry import RetryingBackend
+
+# Global storage backend we're using
 # It's easiest to use a global object here so we can maintain one connection
 # pool per process
 BUCKET = None
 
 
-def connect(region, bucket_name):
+def connect(region, bucket_name, policy=None):
     """
     Connect to the specified bucket in the given region.
 
     Arguments:
         region (str): Amazon region name
         bucket_name(str): Name of bucket
+        policy (hashsync.retry.TransferPolicy): how to time out and retry
+               requests; defaults to TransferPolicy()
 
     Returns:
-        boto.s3.Bucket object
+        hashsync.storage.BotoBackend object, wrapped to record metrics and
+        retry failed requests
 
     Also sets the global BUCKET object in this module
     """
     global BUCKET
     conn = boto.s3.connect_to_region(region)
     conn.region_name = region
-    BUCKET = conn.get_bucket(bucket_name)
+    BUCKET = RetryingBackend(InstrumentedBackend(BotoBackend(conn.get_bucket(bucket_name))), policy)
+    return BUCKET
+
+
+def connect_url(url, policy=None):
+    """
+    Connect to the storage backend described by url. See
+    hashsync.storage.open_backend for the supported URLs.
+
+    Arguments:
+        url (str): storage backend URL
+        policy (hashsync.retry.TransferPolicy): how to time out and retry
+               requests; defaults to TransferPolicy()
+
+    Returns:
+        hashsync.storage.StorageBackend object, wrapped to record metrics and
+        retry failed requests
+
+    Also sets the global BUCKET object in this module
+    """
+    global BUCKET
+    BUCKET = RetryingBackend(InstrumentedBackend(open_backend(url)), policy)
     return BUCKET
 
 
 def get_bucket():
     """
-    Returns the bucket object previously conencted to with connect()
+    Returns the storage backend previously conencted to with connect() or
+    connect_url()
     """
     return BUCKET
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+How objects are identified by their contents
+
+Objects were originally named after the SHA-1 of their contents, and those
+names are kept as they are: objects/<sha1>. Other algorithms keep their
+objects under their own namespace, objects-<algorithm>/<hash>, with their
+own object list, so objects hashed different ways can live side by side in
+one bucket. The namespaces are kept out of objects/ so that listing the
+sha1 objects by hex prefix (e.g. objects/b) never picks them up. A manifest
+records which algorithm its hashes were made with, and each bucket can
+record which algorithm new uploads should use.
+
+Tree hashes split a file into fixed size leaves that are hashed in parallel,
+then hash the list of leaf digests, so hashing one huge file isn't limited
+to the speed of a single core.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+from hashsync.utils import iterfile
+from hashsync.storage import NotFound
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Key holding settings for the whole bucket
+REPOSITORY_CONFIG_KEY = "hashsync.json"
+
+
+class HashAlgorithm(object):
+    """
+    Identifies objects by the hash of their contents
+
+    Arguments:
+        name (str): name of the algorithm as recorded in manifests
+        hashname (str): name of the underlying hashlib algorithm
+        digest_size (int): digest size in bytes, for algorithms like BLAKE2
+                           with a variable digest size
+    """
+    def __init__(self, name, hashname, digest_size=None):
+        self.name = name
+        self.hashname = hashname
+        self.params = {'digest_size': digest_size} if digest_size else {}
+        self.zero = self.hash_data(b'')
+        self.digest_size = len(self.zero) // 2
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.name)
+
+    def new(self):
+        return hashlib.new(self.hashname, **self.params)
+
+    def hasher(self):
+        """
+        Returns an object to feed a file's contents to bit by bit, with
+        update(data) and hexdigest() methods like a hashlib object
+        """
+        return self.new()
+
+    def hash_data(self, data):
+        "Returns the hex hash of data"
+        h = self.new()
+        h.update(data)
+        return h.hexdigest()
+
+    def hash_file(self, filename):
+        "Returns the hex hash of a file's contents"
+        h = self.new()
+        with open(filename, 'rb') as fp:
+            for block in iterfile(fp):
+                h.update(block)
+        return h.hexdigest()
+
+    @property
+    def prefix(self):
+        "Prefix of the keys objects are stored under"
+        if self.name == "sha1":
+            return "objects/"
+        return "objects-{}/".format(self.name)
+
+    @property
+    def objectlist_keyname(self):
+        "Key name of the object list for this algorithm's objects"
+        if self.name == "sha1":
+            return "objectlist"
+        return "objectlist-{}".format(self.name)
+
+    def key(self, h):
+        "Returns the key name of the object with hash h"
+        return self.prefix + h
+
+
+class TreeHash(HashAlgorithm):
+    """
+    Hashes each leaf_size bytes of a file separately, using up to jobs
+    threads, then hashes the leaf digests together. Leaves and the root are
+    hashed with different leading bytes, so a file's tree hash can't be the
+    same as that of a file made of leaf digests.
+
+    Arguments:
+        leaf_size (int): bytes per leaf
+        jobs (int): how many leaves to hash at once; None uses one thread
+                    per CPU
+    """
+    def __init__(self, name, hashname, digest_size=None, leaf_size=config.TREE_HASH_LEAF_SIZE,
+                 jobs=config.TREE_HASH_JOBS):
+        self.leaf_size = leaf_size
+        self.jobs = jobs
+        HashAlgorithm.__init__(self, name, hashname, digest_size)
+
+    def _leaf(self, data):
+        h = self.new()
+        h.update(b'\x00')
+        h.update(data)
+        return h.digest()
+
+    def _root(self, digests):
+        h = self.new()
+        h.update(b'\x01')
+        h.update(struct.pack('>Q', self.leaf_size))
+        for d in digests:
+            h.update(d)
+        return h.hexdigest()
+
+    def hasher(self):
+        return _TreeHasher(self)
+
+    def hash_data(self, data):
+        n = self.leaf_size
+        return self._root([self._leaf(data[i:i + n]) for i in range(0, max(len(data), 1), n)])
+
+    def hash_file(self, filename):
+        size = os.path.getsize(filename)
+        nleaves = max(-(-size // self.leaf_size), 1)
+        jobs = min(self.jobs or multiprocessing.cpu_count(), nleaves)
+        if jobs <= 1:
+            with open(filename, 'rb') as f:
+                return self._root([self._leaf(f.read(self.leaf_size)) for _ in range(nleaves)])
+
+        def leaf(i):
+            # hashlib releases the GIL while hashing big buffers, so threads
+            # are enough to use several cores
+            with open(filename, 'rb') as f:
+                f.seek(i * self.leaf_size)
+                return self._leaf(f.read(self.leaf_size))
+
+        pool = ThreadPool(jobs)
+        try:
+            return self._root(pool.imap(leaf, range(nleaves)))
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class _TreeHasher(object):
+    "Builds a TreeHash from data fed to it in order"
+    def __init__(self, tree):
+        self.tree = tree
+        self.buf = bytearray()
+        self.digests = []
+
+    def update(self, data):
+        n = self.tree.leaf_size
+        self.buf += data
+        if len(self.buf) >= n:
+            whole = len(self.buf) - len(self.buf) % n
+            view = memoryview(self.buf)
+            self.digests.extend(self.tree._leaf(view[i:i + n]) for i in range(0, whole, n))
+            view.release()
+            del self.buf[:whole]
+
+    def hexdigest(self):
+        digests = list(self.digests)
+        if self.buf or not digests:
+            digests.append(self.tree._leaf(bytes(self.buf)))
+        return self.tree._root(digests)
+
+
+def _available(hashname):
+    try:
+        hashlib.new(hashname)
+        return True
+    except ValueError:
+        # e.g. BLAKE2 before Python 3.6
+        return False
+
+
+ALGORITHMS = dict((a.name, a) for a in [
+    HashAlgorithm("sha1", "sha1"),
+    TreeHash("sha1-tree", "sha1"),
+    HashAlgorithm("sha256", "sha256"),
+] + ([
+    HashAlgorithm("blake2b-256", "blake2b", 32),
+    TreeHash("blake2b-256-tree", "blake2b", 32),
+] if _available("blake2b") else []))
+
+
+def get_algorithm(name):
+    """
+    Returns the HashAlgorithm called name. Raises ValueError for unknown
+    algorithms.
+    """
+    try:
+        return ALGORITHMS[name]
+    except KeyError:
+        raise ValueError("unknown hash algorithm {!r}; expected one of {}".format(
+            name, ", ".join(sorted(ALGORITHMS))))
+
+
+def repository_algorithm(bucket, default=config.HASH_ALGORITHM):
+    """
+    Returns the name of the algorithm new uploads to bucket should use, as
+    set by set_repository_algorithm, or default if it hasn't been set
+    """
+    try:
+        settings = json.loads(bucket.get(REPOSITORY_CONFIG_KEY).decode("utf8"))
+    except NotFound:
+        return default
+    return settings.get("hash_algorithm", default)
+
+
+def set_repository_algorithm(bucket, name):
+    "Records the algorithm new uploads to bucket should use"
+    get_algorithm(name)
+    try:
+        settings = json.loads(bucket.get(REPOSITORY_CONFIG_KEY).decode("utf8"))
+    except NotFound:
+        settings = {}
+    settings["hash_algorithm"] = name
+    bucket.put(REPOSITORY_CONFIG_KEY, json.dumps(settings).encode("utf8"))
+    log.info("new uploads will use %s", name)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Recording the progress of an upload so an interrupted one can be resumed
+
+The journal is a file of JSON records, one per line, appended as work
+finishes: the hash of each file along with its size and mtime, the chunks
+each large file was split into, the result of each upload or refresh, and
+the upload id and finished parts of each multipart upload. Each record is
+written with a single append, so worker processes can add to the journal
+too, and a line cut short by a crash is ignored when the journal is read
+back.
+
+Rerunning an interrupted upload with the same journal skips hashing files
+that haven't changed, skips objects that were already uploaded, checked or
+refreshed, and carries on multipart uploads from the last finished part.
+Results older than a given age can be left out, since the objects may have
+been cleaned up or become due a refresh since. A journal that's thrown away
+has its unfinished multipart uploads aborted, so their parts don't linger
+in the store.
+"""
+import json
+import os
+import threading
+import time
+
+from hashsync.storage import NotFound, StorageError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class UploadJournal(object):
+    """
+    Progress of one upload, kept in filename
+
+    Attributes:
+        hashes (dict): absolute filename to (size, mtime, hash)
+        chunks (dict): hash to a list of (hash, size) of its chunks
+        states (dict): hash to how its upload or refresh went
+        state_times (dict): hash to when its state was recorded
+        multipart (dict): key name to a dict with the upload_id, part_size
+                          and finished parts ({part_number: etag}) of
+                          multipart uploads that haven't completed
+        published (set): hashes in states that have been published to the
+                         object list
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.settings = None
+        self.hashes = {}
+        self.chunks = {}
+        self.states = {}
+        self.state_times = {}
+        self.multipart = {}
+        self.published = set()
+
+    def _apply(self, record):
+        kind = record['type']
+        if kind == 'hash':
+            self.hashes[record['filename']] = (record['size'], record['mtime'], record['hash'])
+        elif kind == 'chunks':
+            self.chunks[record['hash']] = [tuple(c) for c in record['chunks']]
+        elif kind == 'state':
+            self.states[record['hash']] = record['state']
+            # Journals from before states were timed are treated as old
+            self.state_times[record['hash']] = record.get('time', 0)
+        elif kind == 'multipart':
+            self.multipart[record['key']] = {'upload_id': record['upload_id'], 'part_size': record['part_size'],
+                                             'parts': {}}
+        elif kind == 'part':
+            upload = self.multipart.get(record['key'])
+            if upload and upload['upload_id'] == record['upload_id']:
+                upload['parts'][record['part']] = record['etag']
+        elif kind == 'multipart_done':
+            self.multipart.pop(record['key'], None)
+        elif kind == 'published':
+            self.published.update(self.states)
+
+    def load(self):
+        """
+        Reads the journal back
+
+        Returns:
+            the settings it was begun with, or None if there's no journal
+        """
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return None
+        settings = None
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf8'))
+                except ValueError:
+                    # Cut short by a crash
+                    continue
+                if record['type'] == 'begin':
+                    settings = record['settings']
+                else:
+                    self._apply(record)
+        return settings
+
+    def begin(self, store=None, **settings):
+        """
+        Carries on from the journal if it was begun with the same settings,
+        otherwise starts a new one
+
+        Arguments:
+            store (hashsync.storage.StorageBackend): the bucket the upload is
+                  to; multipart uploads in a journal that's discarded are
+                  aborted there if it's the bucket they were started in
+            settings: what the upload is of, e.g. the directory and hash
+                      algorithm; must be JSON serializable
+
+        Returns:
+            True if the journal is being resumed
+        """
+        settings = json.loads(json.dumps(settings))
+        old = self.load()
+        if old == settings:
+            self.settings = settings
+            log.info("resuming from %s: %i files hashed, %i transfers done, %i multipart uploads in progress",
+                     self.filename, len(self.hashes), len(self.states), len(self.multipart))
+            return True
+
+        if old is not None:
+            log.info("%s is for a different upload; starting again", self.filename)
+            self.abort_multipart(store, old)
+        self._reset()
+        self.settings = settings
+        self.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        self._append({'type': 'begin', 'settings': settings})
+        return False
+
+    def _append(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf8')
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # One write per record keeps records from different processes
+            # from being interleaved
+            os.write(self.fd, line)
+
+    def hasher(self, hash_file):
+        """
+        Returns a wrapper around hash_file that reuses journaled hashes of
+        files whose size and mtime haven't changed, and journals new ones
+        """
+        def wrapper(filename):
+            path = os.path.abspath(filename)
+            st = os.stat(path)
+            cached = self.hashes.get(path)
+            if cached and cached[:2] == (st.st_size, st.st_mtime):
+                return cached[2]
+            h = hash_file(filename)
+            self.hashes[path] = (st.st_size, st.st_mtime, h)
+            self._append({'type': 'hash', 'filename': path, 'size': st.st_size, 'mtime': st.st_mtime, 'hash': h})
+            return h
+        return wrapper
+
+    def record_chunks(self, h, chunks):
+        "Records the (hash, size) of the chunks of the file with hash h"
+        self.chunks[h] = [tuple(c) for c in chunks]
+        self._append({'type': 'chunks', 'hash': h, 'chunks': chunks})
+
+    def record_state(self, h, state):
+        "Records how the upload or refresh of object h went"
+        now = time.time()
+        self.states[h] = state
+        self.state_times[h] = now
+        self._append({'type': 'state', 'hash': h, 'state': state, 'time': now})
+
+    def recent_states(self, max_age):
+        "Returns the states that were recorded less than max_age seconds ago"
+        cutoff = time.time() - max_age
+        return dict((h, state) for h, state in self.states.items() if self.state_times.get(h, 0) > cutoff)
+
+    def record_published(self):
+        "Records that the objects in states have been published"
+        self.published.update(self.states)
+        self._append({'type': 'published'})
+
+    def start_multipart(self, keyname, upload_id, part_size):
+        "Records that a multipart upload of keyname has been started"
+        self.multipart[keyname] = {'upload_id': upload_id, 'part_size': part_size, 'parts': {}}
+        self._append({'type': 'multipart', 'key': keyname, 'upload_id': upload_id, 'part_size': part_size})
+
+    def record_part(self, keyname, upload_id, part_number, etag):
+        "Records a finished part of a multipart upload"
+        self._append({'type': 'part', 'key': keyname, 'upload_id': upload_id, 'part': part_number, 'etag': etag})
+
+    def finish_multipart(self, keyname):
+        "Records that the multipart upload of keyname has been completed"
+        self.multipart.pop(keyname, None)
+        self._append({'type': 'multipart_done', 'key': keyname})
+
+    def abort_multipart(self, store, settings=None):
+        """
+        Aborts the unfinished multipart uploads in the journal, e.g. because
+        it's being discarded
+
+        Arguments:
+            store (hashsync.storage.StorageBackend): the bucket to abort them in;
+                  nothing is aborted if it's None, or isn't the bucket in the
+                  journal's settings
+            settings (dict): the settings the journal was begun with;
+                             defaults to the current ones
+        """
+        settings = self.settings if settings is None else settings
+        if not self.multipart:
+            return
+        if store is None or (settings or {}).get('bucket') != store.name:
+            log.warning("can't abort %i multipart uploads from %s in a bucket we aren't connected to",
+                        len(self.multipart), self.filename)
+            return
+        for keyname, upload in sorted(self.multipart.items()):
+            abort_upload(store, keyname, upload['upload_id'])
+
+    def discard(self, store):
+        "Aborts the unfinished multipart uploads in the journal in store, and deletes it"
+        settings = self.load()
+        if settings is not None:
+            self.abort_multipart(store, settings)
+        self._reset()
+        self.remove()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def remove(self):
+        "Deletes the journal, e.g. once the manifest has been written"
+        self.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+def abort_upload(store, keyname, upload_id):
+    "Aborts a multipart upload, if it's still there, so its parts are deleted"
+    log.info("aborting multipart upload %s of %s", upload_id, keyname)
+    try:
+        store.abort_multipart(keyname, upload_id)
+    except NotFound:
+        pass
+    except StorageError as e:
+        log.warning("couldn't abort multipart upload %s of %s: %s", upload_id, keyname, e)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for listing large buckets in parallel by splitting the key space up
+by hash prefix
+"""
+import itertools
+import json
+import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+
+from hashsync import config, profiling
+
+import logging
+log = logging.getLogger(__name__)
+
+HEX_DIGITS = "0123456789abcdef"
+
+
+def hex_prefixes(width):
+    """
+    Returns all hex prefixes of the given width, in order
+
+    Arguments:
+        width (int): number of hex digits in each prefix; 1 gives 16 prefixes,
+                     2 gives 256 prefixes
+
+    Returns:
+        list of prefix strings
+    """
+    return ["".join(p) for p in itertools.product(HEX_DIGITS, repeat=width)]
+
+
+class Checkpoint(object):
+    """
+    Records which prefixes of a listing have been completed, along with a
+    JSON serializable result for each, so an interrupted listing can resume
+    where it left off.
+
+    begin() ties the checkpoints to the parameters and start time of a run,
+    so that results recorded by a different run, or by one that started too
+    long ago for its results to still be true, aren't used.
+    """
+    run_file = "run.json"
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _path(self, prefix):
+        return os.path.join(self.dirname, prefix.replace("/", "_") + ".json")
+
+    def _write(self, path, data):
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+        # Rename so that a crash never leaves a partial checkpoint behind
+        os.rename(tmp, path)
+
+    def begin(self, params, max_age=config.CHECKPOINT_MAX_AGE):
+        """
+        Starts a run with params, or resumes it if the checkpoints are from
+        a run with the same params that started less than max_age seconds
+        ago. Any other checkpoints are removed.
+
+        Arguments:
+            params (dict): JSON serializable description of the run
+            max_age (float): how old a run can be and still be resumed
+
+        Returns:
+            the time the run started
+        """
+        # Compare params the way they'll be read back
+        params = json.loads(json.dumps(params))
+        path = os.path.join(self.dirname, self.run_file)
+        try:
+            with open(path, 'r') as fp:
+                run = json.load(fp)
+        except (IOError, ValueError):
+            run = None
+
+        now = time.time()
+        if run and run.get('params') == params and now - run.get('started', 0) <= max_age:
+            log.info("resuming run started at %s from %s", time.ctime(run['started']), self.dirname)
+            return run['started']
+        if os.path.isdir(self.dirname) and os.listdir(self.dirname):
+            log.warning("ignoring checkpoints in %s left by a different or older run", self.dirname)
+            self.clear()
+        self._write(path, {'params': params, 'started': now})
+        return now
+
+    def get(self, prefix):
+        """
+        Returns the result recorded for prefix, or None if prefix hasn't been
+        completed
+        """
+        try:
+            with open(self._path(prefix), 'r') as fp:
+                return json.load(fp)['result']
+        except IOError:
+            return None
+        except ValueError:
+            return None
+
+    def mark(self, prefix, result):
+        "Records prefix as completed with the given result"
+        self._write(self._path(prefix), {'prefix': prefix, 'result': result})
+
+    def clear(self):
+        "Removes all checkpoints"
+        if os.path.isdir(self.dirname):
+            shutil.rmtree(self.dirname)
+
+
+def map_prefixes(func, prefixes, jobs, checkpoint=None):
+    """
+    Calls func(prefix) for each prefix using a pool of threads.
+
+    Prefixes already completed in checkpoint aren't processed again; their
+    recorded results are returned instead. Each new result is recorded in
+    checkpoint as soon as it completes.
+
+    Arguments:
+        func (callable): function to call with each prefix; its return value
+                         must be JSON serializable if checkpoint is used
+        prefixes (list): prefixes to process
+        jobs (int): how many prefixes to process in parallel
+        checkpoint (Checkpoint): where to record completed prefixes; optional
+
+    Yields:
+        (prefix, result) tuples in the order they complete
+    """
+    todo = []
+    for prefix in prefixes:
+        result = checkpoint.get(prefix) if checkpoint else None
+        if result is not None:
+            log.info("%s already completed; skipping", prefix)
+            yield prefix, result
+        else:
+            todo.append(prefix)
+
+    if not todo:
+        return
+
+    def run(prefix):
+        return prefix, func(prefix)
+
+    pool = ThreadPool(min(jobs, len(todo)), initializer=profiling.init_thread)
+    try:
+        for i, (prefix, result) in enumerate(pool.imap_unordered(run, todo)):
+            if checkpoint:
+                checkpoint.mark(prefix, result)
+            log.info("finished listing %s (%i/%i)", prefix, i + 1, len(todo))
+            yield prefix, result
+    finally:
+        pool.close()
+        pool.join()
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
 import json
 import os
 from collections import defaultdict
 
 from hashsync.compression import GZIP_MAGIC, gzip_decompress
+from hashsync import config
 
 import logging
 log = logging.getLogger(__name__)
@@ -20,30 +22,123 @@ log = logging.getLogger(__name__)
 class Manifest(object):
     """
     A Manifest describes a set of files along with their hashes and permissions
+
+    Arguments:
+        algorithm (str): name of the hashsync.hashing algorithm the hashes
+                         were made with
     """
-    def __init__(self):
+    def __init__(self, algorithm="sha1"):
+        self.algorithm = algorithm
         # List of hash, filename, permission tuples
         self.files = []
+        # Mapping of hash to file size, where known
+        self.sizes = {}
+        # Mapping of hash to a list of (hash, size) of the chunks the file is
+        # stored as, for chunked files
+        self.chunks = {}
+        # Sorted filenames and the positions of their entries in files,
+        # built when first needed by under()
+        self._index = None
 
-    def add(self, h, filename, perms):
+    def add(self, h, filename, perms, size=None, chunks=None):
         """
         Adds a file to the manifest
 
         Arguments:
-            h (str): the sha1 has of the file
+            h (str): the hash of the file
             filename (str): the filename, usually relative to some top level directory
             perms (int): integer representation of file permissions
+            size (int): size of the file in bytes, if known. Used to schedule
+                        downloads
+            chunks (list): (hash, size) of each chunk, if the file is stored
+                           as chunks rather than a single object
         """
         self.files.append((h, filename, perms))
+        self._index = None
+        if size is not None:
+            self.sizes[h] = size
+        if chunks:
+            self.chunks[h] = [tuple(c) for c in chunks]
+
+    def under(self, prefix):
+        """
+        Returns the files whose filename is prefix or that are in the
+        directory prefix, looked up in a sorted index of filenames rather
+        than by going through every file
+
+        Arguments:
+            prefix (str): a relative filename or directory; "" for every
+                          file
+
+        Returns:
+            a list of (hash, filename, permission) tuples, in manifest order
+        """
+        if not prefix:
+            return list(self.files)
+        if self._index is None:
+            order = sorted(range(len(self.files)), key=lambda i: self.files[i][1])
+            self._index = ([self.files[i][1] for i in order], order)
+        names, order = self._index
 
-    def save(self, output_file):
+        found = []
+        # The file itself, if there is one...
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i] == prefix:
+            found.append(order[i])
+            i += 1
+        # ...and everything under it. Other names starting with prefix, like
+        # prefix.txt, can sort between the two, so look each up separately.
+        dirprefix = prefix + "/"
+        i = bisect.bisect_left(names, dirprefix)
+        while i < len(names) and names[i].startswith(dirprefix):
+            found.append(order[i])
+            i += 1
+        return [self.files[i] for i in sorted(found)]
+
+    def format_needed(self):
+        """
+        Returns the oldest manifest format that can describe this manifest:
+        2 if it has chunked files or hashes other than sha1, otherwise 1
+        """
+        return 2 if self.chunks or self.algorithm != "sha1" else 1
+
+    def save(self, output_file, version=None):
         """
         Outputs the manifest to a file object. Permissions are output in octal representation.
 
+        Format 1 is a list of [hash, filename, permissions], which every
+        version of download.py can read. Format 2 adds file sizes, chunks,
+        and the algorithm of manifests that don't use sha1; download.py
+        can't read it before this release. Manifests that need format 2 are
+        always written as format 2.
+
         Arguments:
             output_file (file object): the file object to write the manifest to
+            version (int): the manifest format to write; defaults to
+                           config.MANIFEST_FORMAT
         """
-        data = json.dumps(self.files, output_file, indent=2)
+        if version is None:
+            version = config.MANIFEST_FORMAT
+        version = max(version, self.format_needed())
+
+        files = []
+        written = set()
+        for h, filename, perms in self.files:
+            if version < 2:
+                files.append((h, filename, perms))
+            elif h in self.chunks and h not in written:
+                # Only list the chunks the first time we see a file
+                files.append((h, filename, perms, self.sizes.get(h), self.chunks[h]))
+                written.add(h)
+            elif h in self.sizes:
+                files.append((h, filename, perms, self.sizes[h]))
+            else:
+                files.append((h, filename, perms))
+        if self.algorithm != "sha1":
+            # Manifests of sha1 hashes are plain lists of files, as they
+            # always have been
+            files = {"algorithm": self.algorithm, "files": files}
+        data = json.dumps(files, indent=2)
         data = data.encode("utf8")
         output_file.write(data)
 
@@ -59,8 +154,14 @@ class Manifest(object):
             data = gzip_decompress(data)
         data = data.decode("utf8")
 
-        for h, filename, perms in json.loads(data):
-            self.add(h, filename, perms)
+        files = json.loads(data)
+        if isinstance(files, dict):
+            self.algorithm = files["algorithm"]
+            files = files["files"]
+
+        # Older manifests don't have sizes, and only chunked files have chunks
+        for entry in files:
+            self.add(*entry)
 
     def report_dupes(self):
         """
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Laying out files in a directory with as few system calls as we can
+
+Rather than checking for and creating the directory of each file as it's
+written, every directory the new files need is created up front, once
+each, parents first. Directories are remembered as they're seen or made, so
+nothing is checked twice.
+
+Permissions from the manifest are applied at the end, in one pass, and only
+to files whose mode is wrong: new files whose permissions aren't what the
+umask gives them, and existing files that were chmodded. A file whose
+permissions are all that changed needs no download.
+"""
+import errno
+import os
+
+from hashsync.metrics import METRICS
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def new_file_mode():
+    "Returns the permissions new files get, given the umask"
+    # The only way to read the umask is to change it
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class Materializer(object):
+    """
+    Creates the directories new files go in, and fixes up permissions
+
+    Attributes:
+        dirs (set): directories known to exist
+        chmods (dict): filename to the permissions to give it
+    """
+    def __init__(self):
+        self.dirs = set()
+        self.chmods = {}
+        self.new_mode = new_file_mode()
+
+    def exists(self, dirname):
+        "Notes that dirname, and so every directory above it, exists"
+        while dirname and dirname not in self.dirs:
+            self.dirs.add(dirname)
+            dirname = os.path.dirname(dirname)
+
+    def make_dirs(self, filenames):
+        "Creates the directories filenames will go in"
+        missing = set()
+        for filename in filenames:
+            d = os.path.dirname(filename)
+            while d and d not in self.dirs and d not in missing:
+                missing.add(d)
+                d = os.path.dirname(d)
+        # Parents sort before their children
+        with METRICS.stage("materialize"):
+            for d in sorted(missing):
+                try:
+                    os.mkdir(d)
+                    METRICS.incr("hashsync_mkdir_total")
+                except OSError as e:
+                    if e.errno != errno.EEXIST or not os.path.isdir(d):
+                        raise
+                self.dirs.add(d)
+
+    def created(self, filename, perms):
+        "Notes that filename is being written, and should have perms"
+        if perms != self.new_mode:
+            self.chmods[filename] = perms
+        else:
+            self.chmods.pop(filename, None)
+
+    def existing(self, filename, perms):
+        "Notes that filename is already there, and should have perms"
+        if os.stat(filename).st_mode & 0o777 != perms:
+            self.chmods[filename] = perms
+
+    def apply(self):
+        "Applies the permissions that need changing"
+        with METRICS.stage("materialize"):
+            for filename in sorted(self.chmods):
+                log.debug("chmod %o %s", self.chmods[filename], filename)
+                os.chmod(filename, self.chmods[filename])
+        METRICS.incr("hashsync_chmod_total", len(self.chmods))
+        self.chmods.clear()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Metrics for transfers
+
+Each process records metrics into the global METRICS registry: time spent in
+each stage (hashing, compressing, network requests, materializing), request
+and byte counters, queue depths and per-operation latency histograms.
+
+Work done in multiprocessing workers should be run via collect(), which
+returns the worker's metrics along with the result so the parent process can
+merge them with result().
+
+Metrics can be exported as JSON or in the Prometheus text format, e.g. for
+node_exporter's textfile collector.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from hashsync.storage import StorageBackend
+
+import logging
+log = logging.getLogger(__name__)
+
+# Histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Metrics(object):
+    """
+    A registry of counters, gauges and histograms. Each metric is identified
+    by a name and a set of labels.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.counters = defaultdict(float)
+            self.gauges = {}
+            # Maps keys to [bucket counts..., sum, count]
+            self.histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        "Increments a counter"
+        with self.lock:
+            self.counters[_key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        "Sets a gauge, and keeps track of its maximum as name_max"
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+            k = _key(name + "_max", labels)
+            self.gauges[k] = max(self.gauges.get(k, value), value)
+
+    def observe(self, name, value, **labels):
+        "Records a value in a histogram"
+        with self.lock:
+            k = _key(name, labels)
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = [0] * (len(BUCKETS) + 2)
+            for i, b in enumerate(BUCKETS):
+                if value <= b:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        "Records how long the enclosed block takes in a histogram"
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.observe(name, elapsed, **labels)
+            log.debug("%s %s took %.3fs", name, labels, elapsed)
+
+    def stage(self, stage):
+        "Records time spent in one stage of a transfer"
+        return self.timer("hashsync_stage_seconds", stage=stage)
+
+    def snapshot(self):
+        "Returns a picklable copy of the metrics"
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': dict((k, list(v)) for k, v in self.histograms.items()),
+            }
+
+    def merge(self, snapshot):
+        "Merges a snapshot from another process into these metrics"
+        with self.lock:
+            for k, v in snapshot['counters'].items():
+                self.counters[k] += v
+            for k, v in snapshot['gauges'].items():
+                if k[0].endswith("_max"):
+                    self.gauges[k] = max(v, self.gauges.get(k, v))
+                else:
+                    self.gauges.setdefault(k, v)
+            for k, v in snapshot['histograms'].items():
+                if k in self.histograms:
+                    self.histograms[k] = [a + b for a, b in zip(self.histograms[k], v)]
+                else:
+                    self.histograms[k] = list(v)
+
+    def to_dict(self):
+        """
+        Returns the metrics as a JSON serializable dict, including overall
+        request and byte rates
+        """
+        elapsed = time.time() - self.start
+        snap = self.snapshot()
+
+        def fmt(k):
+            name, labels = k
+            if not labels:
+                return name
+            return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(lk, lv) for lk, lv in labels))
+
+        histograms = {}
+        for k, h in snap['histograms'].items():
+            histograms[fmt(k)] = {
+                'buckets': dict((str(b), c) for b, c in zip(BUCKETS, h)),
+                'sum': h[-2],
+                'count': h[-1],
+            }
+
+        requests = sum(v for (name, _), v in snap['counters'].items() if name == "hashsync_requests_total")
+        nbytes = sum(v for (name, _), v in snap['counters'].items() if name == "hashsync_bytes_total")
+        return {
+            'elapsed': elapsed,
+            'requests_per_sec': requests / elapsed if elapsed else None,
+            'bytes_per_sec': nbytes / elapsed if elapsed else None,
+            'counters': dict((fmt(k), v) for k, v in snap['counters'].items()),
+            'gauges': dict((fmt(k), v) for k, v in snap['gauges'].items()),
+            'histograms': histograms,
+        }
+
+    def to_prometheus(self):
+        "Returns the metrics in the Prometheus text exposition format"
+        snap = self.snapshot()
+        lines = []
+
+        def labelstr(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+        def by_name(d):
+            names = defaultdict(list)
+            for (name, labels), v in sorted(d.items()):
+                names[name].append((labels, v))
+            return sorted(names.items())
+
+        for name, values in by_name(snap['counters']):
+            lines.append("# TYPE {} counter".format(name))
+            for labels, v in values:
+                lines.append("{}{} {}".format(name, labelstr(labels), v))
+        for name, values in by_name(snap['gauges']):
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, v in values:
+                lines.append("{}{} {}".format(name, labelstr(labels), v))
+        for name, values in by_name(snap['histograms']):
+            lines.append("# TYPE {} histogram".format(name))
+            for labels, h in values:
+                cumulative = 0
+                for b, c in zip(BUCKETS, h):
+                    cumulative += c
+                    lines.append("{}_bucket{} {}".format(name, labelstr(labels, [('le', b)]), cumulative))
+                lines.append("{}_bucket{} {}".format(name, labelstr(labels, [('le', '+Inf')]), h[-1]))
+                lines.append("{}_sum{} {}".format(name, labelstr(labels), h[-2]))
+                lines.append("{}_count{} {}".format(name, labelstr(labels), h[-1]))
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        "Logs how much time was spent in each stage, and how many requests were retried or hedged"
+        snap = self.snapshot()
+        for (name, labels), h in sorted(snap['histograms'].items()):
+            if name == "hashsync_stage_seconds":
+                log.info("stage %s: %.3fs in %i calls", dict(labels)['stage'], h[-2], h[-1])
+        for (name, labels), v in sorted(snap['counters'].items()):
+            if name in ("hashsync_retries_total", "hashsync_timeouts_total", "hashsync_hedges_total",
+                        "hashsync_hedge_wins_total"):
+                log.info("%s %s: %i", name, dict(labels)['op'], v)
+        d = self.to_dict()
+        log.info("%.1f requests/s, %.0f bytes/s", d['requests_per_sec'] or 0, d['bytes_per_sec'] or 0)
+
+    def write(self, json_file=None, prometheus_file=None):
+        """
+        Writes the metrics out as JSON and/or in the Prometheus text format.
+        The Prometheus file is written atomically, as the textfile collector
+        requires.
+        """
+        if json_file:
+            with open(json_file, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        if prometheus_file:
+            tmp = prometheus_file + ".tmp"
+            with open(tmp, 'w') as f:
+                f.write(self.to_prometheus())
+            os.rename(tmp, prometheus_file)
+
+
+# Global registry for this process
+METRICS = Metrics()
+
+
+def collect(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) in a worker process with a fresh metrics
+    registry, and returns (result, metrics snapshot). Only use this with
+    process pools, since it resets the process's global metrics.
+    """
+    METRICS.reset()
+    retval = func(*args, **kwargs)
+    return retval, METRICS.snapshot()
+
+
+def result(job, timeout=None):
+    """
+    Gets the result of a job started with collect(), merging its metrics
+    into ours
+    """
+    retval, snapshot = job.get(timeout)
+    METRICS.merge(snapshot)
+    return retval
+
+
+def total(snapshot, name):
+    "Returns the sum of the counters called name in snapshot, over all labels"
+    return sum(v for (n, _), v in snapshot['counters'].items() if n == name)
+
+
+def timed(stage, func):
+    """
+    Returns a wrapper around func that records the time it takes as stage,
+    e.g. for passing to traverse_directory
+    """
+    def wrapper(*args, **kwargs):
+        with METRICS.stage(stage):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class QueueDepth(object):
+    """
+    Tracks how many jobs are outstanding in a pool as a gauge. Call
+    submitted() when a job is queued, and pass done as the job's callback.
+    """
+    def __init__(self, name="hashsync_queue_depth"):
+        self.name = name
+        self.depth = 0
+        self.lock = threading.Lock()
+
+    def submitted(self):
+        with self.lock:
+            self.depth += 1
+            METRICS.set_gauge(self.name, self.depth)
+
+    def done(self, _result=None):
+        with self.lock:
+            self.depth -= 1
+            METRICS.set_gauge(self.name, self.depth)
+
+
+class _CountingWriter(object):
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fobj.write(data)
+
+
+class InstrumentedBackend(StorageBackend):
+    """
+    Wraps a storage backend, recording the number of requests, bytes
+    transferred and latency of each operation in METRICS
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @contextmanager
+    def _request(self, op):
+        METRICS.incr("hashsync_requests_total", op=op)
+        try:
+            with METRICS.timer("hashsync_request_seconds", op=op), METRICS.stage("network"):
+                yield
+        except Exception:
+            METRICS.incr("hashsync_request_errors_total", op=op)
+            raise
+
+    def head(self, name):
+        with self._request("head"):
+            return self.backend.head(name)
+
+    def get(self, name):
+        with self._request("get"):
+            data = self.backend.get(name)
+        METRICS.incr("hashsync_bytes_total", len(data), direction="in")
+        return data
+
+    def get_to_file(self, name, fobj):
+        w = _CountingWriter(fobj)
+        try:
+            with self._request("get"):
+                return self.backend.get_to_file(name, w)
+        finally:
+            METRICS.incr("hashsync_bytes_total", w.count, direction="in")
+
+    def get_range(self, name, start, end):
+        with self._request("get_range"):
+            data = self.backend.get_range(name, start, end)
+        METRICS.incr("hashsync_bytes_total", len(data), direction="in")
+        return data
+
+    def put(self, name, data, **kwargs):
+        if isinstance(data, bytes):
+            size = len(data)
+        else:
+            try:
+                pos = data.tell()
+                data.seek(0, 2)
+                size = data.tell() - pos
+                data.seek(pos)
+            except (AttributeError, IOError, OSError):
+                size = 0
+        with self._request("put"):
+            retval = self.backend.put(name, data, **kwargs)
+        METRICS.incr("hashsync_bytes_total", size, direction="out")
+        return retval
+
+    def copy(self, name, **kwargs):
+        with self._request("copy"):
+            return self.backend.copy(name, **kwargs)
+
+    def start_multipart(self, name, **kwargs):
+        with self._request("start_multipart"):
+            return self.backend.start_multipart(name, **kwargs)
+
+    def put_part(self, name, upload_id, part_number, data):
+        with self._request("put_part"):
+            retval = self.backend.put_part(name, upload_id, part_number, data)
+        METRICS.incr("hashsync_bytes_total", len(data), direction="out")
+        return retval
+
+    def complete_multipart(self, name, upload_id, parts):
+        with self._request("complete_multipart"):
+            return self.backend.complete_multipart(name, upload_id, parts)
+
+    def abort_multipart(self, name, upload_id):
+        with self._request("abort_multipart"):
+            return self.backend.abort_multipart(name, upload_id)
+
+    def _timed_iter(self, op, it):
+        METRICS.incr("hashsync_requests_total", op=op)
+        elapsed = 0
+        n = 0
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            n += 1
+            yield item
+        METRICS.observe("hashsync_request_seconds", elapsed, op=op)
+        METRICS.observe("hashsync_stage_seconds", elapsed, stage="network")
+        METRICS.incr("hashsync_listed_total", n, op=op)
+
+    def list(self, prefix=''):
+        return self._timed_iter("list", iter(self.backend.list(prefix)))
+
+    def list_versions(self, prefix=''):
+        return self._timed_iter("list_versions", iter(self.backend.list_versions(prefix)))
+
+    def delete(self, keys):
+        with self._request("delete"):
+            return self.backend.delete(keys)
@@ -1,23 +1,69 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import json
+import os
+import time
+import uuid
+import hashlib
+from collections import defaultdict
 
 from hashsync.compression import gzip_decompress, gzip_compress, GZIP_MAGIC
+from hashsync.storage import as_backend
+from hashsync import config
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def decode_objects(data, content_encoding=None):
+    """
+    Decodes the contents of an object list key into a list of lines, one per
+    object
+
+    Arguments:
+        data (bytes): raw contents of the key
+        content_encoding (str): Content-Encoding of the key, if known
+
+    Returns:
+        list of lines
+    """
+    if content_encoding == 'gzip' or data.startswith(GZIP_MAGIC):
+        data = gzip_decompress(data)
+    data = data.decode("ascii")
+    return [h for h in data.split("\n") if h]
+
+
+def encode_objects(objects):
+    """
+    Encodes a collection of lines, one per object, into the compressed format
+    used for object list keys. The output is deterministic for a given set of
+    lines.
+
+    Arguments:
+        objects (iterable): lines to encode
+
+    Returns:
+        gzip compressed bytes
+    """
+    data = "\n".join(sorted(objects)).encode("ascii")
+    return gzip_compress(data, mtime=0)
+
+
+def strip_etag(etag):
+    "Returns an ETag without its surrounding quotes"
+    return etag.strip('"') if etag else etag
+
+
 class ObjectList(object):
     """
-    Handle getting/uploading list of objects from s3 bucket
+    Handle getting/uploading list of objects from a storage backend
     """
     cache_file = ".objectlist"
 
     def __init__(self, bucket, keyname="objectlist"):
         # Set of object hashes we know about
         self.objects = set()
-        self.bucket = bucket
+        self.bucket = as_backend(bucket)
         self.keyname = keyname
 
     def load_cache(self, etag):
@@ -34,18 +80,14 @@ class ObjectList(object):
         except ValueError:
             return False
 
-    def load_remote(self, key):
-        data = key.get_contents_as_string()
-        if key.content_encoding == 'gzip' or data.startswith(GZIP_MAGIC):
-            data = gzip_decompress(data)
-        data = data.decode("ascii")
-
-        objects = data.split("\n")
+    def load_remote(self, info):
+        data = self.bucket.get(info.name)
+        objects = decode_objects(data, info.content_encoding)
         self.objects.update(objects)
         log.info("loaded %i old objects from %s/%s", len(objects), self.bucket.name, self.keyname)
 
     def load(self):
-        remote_objects = self.bucket.get_key(self.keyname)
+        remote_objects = self.bucket.head(self.keyname)
 
         if not remote_objects:
             return self.objects
@@ -70,9 +112,7 @@ class ObjectList(object):
         manifest_data = "\n".join(sorted(self.objects))
         manifest_data = manifest_data.encode("ascii")
 
-        manifest = self.bucket.new_key(self.keyname)
-        manifest.set_metadata('Content-Encoding', 'gzip')
-        manifest.set_contents_from_string(gzip_compress(manifest_data))
+        self.bucket.put(self.keyname, gzip_compress(manifest_data), content_encoding='gzip')
         log.info("wrote %i objects to manifest %s/%s", len(self.objects), self.bucket.name, self.keyname)
 
     def __contains__(self, h):
@@ -80,3 +120,264 @@ class ObjectList(object):
 
     def add(self, h):
         self.objects.add(h)
+
+
+class ShardedObjectList(ObjectList):
+    """
+    An ObjectList stored as one key per hash prefix ("shard"), plus an
+    append-only log of delta keys that uploaders publish new objects to.
+
+    The remote layout under keyname is:
+        <keyname>/shards/<prefix>   all objects whose hash starts with prefix
+        <keyname>/deltas/<name>     objects published since the last save()
+
+    Each line of a shard or delta is a hash, optionally followed by a space
+    and the object's last-modified time as an integer timestamp.
+
+    Each shard is cached locally with its ETag, so a refresh only downloads
+    the shards that changed. Deltas are never modified once written, so they
+    are cached the same way. save() folds the deltas into the shards.
+
+    If no shards exist yet, the single key used by ObjectList is loaded,
+    along with any deltas.
+    """
+    cache_dir = ".objectlist.d"
+
+    def __init__(self, bucket, keyname="objectlist", shard_width=config.OBJECTLIST_SHARD_WIDTH):
+        ObjectList.__init__(self, bucket, keyname)
+        self.shard_width = shard_width
+        # Names of the delta keys that have been folded into self.objects
+        self.deltas = set()
+        # Hashes added locally since we were loaded
+        self.added = set()
+        # Last-modified timestamps of objects, where known
+        self.last_modified = {}
+
+    @property
+    def shard_prefix(self):
+        return "{}/shards/".format(self.keyname)
+
+    @property
+    def delta_prefix(self):
+        return "{}/deltas/".format(self.keyname)
+
+    def shard_keyname(self, h):
+        "Returns the name of the shard key that h belongs in"
+        return self.shard_prefix + h[:self.shard_width]
+
+    def _cache_path(self, keyname):
+        return os.path.join(self.cache_dir, keyname.replace("/", "_"))
+
+    def load_cached_key(self, keyname, etag):
+        """
+        Returns the cached list of objects for keyname, or None if it isn't
+        cached or the cached copy doesn't match etag
+        """
+        try:
+            with open(self._cache_path(keyname), 'r') as fp:
+                cached = json.load(fp)
+                if cached['etag'] != strip_etag(etag):
+                    return None
+                return cached['objects']
+        except IOError:
+            return None
+        except ValueError:
+            return None
+
+    def save_cached_key(self, keyname, etag, objects):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(self._cache_path(keyname), 'w') as fp:
+                json.dump({'etag': strip_etag(etag), 'objects': list(objects)}, fp)
+                return True
+        except (IOError, OSError):
+            return False
+
+    def prune_cache(self, keynames):
+        "Removes cached keys that aren't in keynames"
+        if not os.path.isdir(self.cache_dir):
+            return
+        wanted = set(os.path.basename(self._cache_path(k)) for k in keynames)
+        for f in os.listdir(self.cache_dir):
+            if f not in wanted:
+                try:
+                    os.unlink(os.path.join(self.cache_dir, f))
+                except OSError:
+                    pass
+
+    def entries(self, hashes):
+        "Returns the lines to store for hashes in a shard or delta"
+        for h in hashes:
+            if h in self.last_modified:
+                yield "{} {}".format(h, self.last_modified[h])
+            else:
+                yield h
+
+    def add_entries(self, entries):
+        "Adds objects from the lines of a shard or delta"
+        for entry in entries:
+            h, _, last_modified = entry.partition(" ")
+            self.objects.add(h)
+            if last_modified:
+                last_modified = int(last_modified)
+                # The same object can show up in a shard and in deltas
+                if last_modified > self.last_modified.get(h, 0):
+                    self.last_modified[h] = last_modified
+
+    def load_key(self, info):
+        """
+        Loads objects from a shard or delta key, using the local cache if its
+        ETag still matches. Returns True if the key was downloaded.
+        """
+        entries = self.load_cached_key(info.name, info.etag)
+        if entries is not None:
+            self.add_entries(entries)
+            return False
+
+        entries = decode_objects(self.bucket.get(info.name))
+        self.add_entries(entries)
+        self.save_cached_key(info.name, info.etag, entries)
+        return True
+
+    def list_keys(self):
+        """
+        Lists the remote shards and deltas
+
+        Returns:
+            (shards, deltas): two dicts mapping key names to
+                              hashsync.storage.ObjectInfo objects
+        """
+        shards = {}
+        deltas = {}
+        for info in self.bucket.list(prefix=self.keyname + "/"):
+            if info.name.startswith(self.shard_prefix):
+                shards[info.name] = info
+            elif info.name.startswith(self.delta_prefix):
+                deltas[info.name] = info
+        return shards, deltas
+
+    def load(self):
+        shards, deltas = self.list_keys()
+
+        if not shards:
+            # Until the shards are first written, the unsharded list still
+            # has most of the objects, and deltas only have those published
+            # since
+            log.info("no shards found in %s/%s; loading unsharded object list", self.bucket.name, self.keyname)
+            ObjectList.load(self)
+            if not deltas:
+                return self.objects
+
+        fetched = 0
+        for name in sorted(shards):
+            fetched += self.load_key(shards[name])
+        for name in sorted(deltas):
+            fetched += self.load_key(deltas[name])
+        self.deltas.update(deltas)
+        self.prune_cache(list(shards) + list(deltas))
+
+        log.info("loaded %i objects from %i shards and %i deltas in %s/%s (%i downloaded)",
+                 len(self.objects), len(shards), len(deltas), self.bucket.name, self.keyname, fetched)
+        return self.objects
+
+    def publish(self, hashes=None):
+        """
+        Publishes objects as a new delta key, making them visible to anybody
+        loading the object list without rewriting any shards.
+
+        Arguments:
+            hashes (iterable): hashes to publish; defaults to the hashes that
+                               have been add()ed since loading
+
+        Returns:
+            name of the delta key written, or None if there was nothing to
+            publish
+        """
+        if hashes is None:
+            hashes = self.added
+        hashes = set(hashes)
+        if not hashes:
+            return None
+
+        keyname = "{}{}-{}".format(self.delta_prefix, time.strftime("%Y%m%dT%H%M%S", time.gmtime()), uuid.uuid4().hex)
+        self.bucket.put(keyname, encode_objects(self.entries(hashes)), content_encoding='gzip')
+        self.deltas.add(keyname)
+        self.objects.update(hashes)
+        self.added.difference_update(hashes)
+        log.info("published %i objects to %s/%s", len(hashes), self.bucket.name, keyname)
+        return keyname
+
+    def save(self, deltas=None):
+        """
+        Writes all objects out to the shards, uploading only the shards whose
+        contents changed, and then removes deltas that have been folded in.
+
+        Arguments:
+            deltas (iterable): names of delta keys to remove once the shards
+                               are written; defaults to the deltas loaded
+                               into this object list
+        """
+        if deltas is None:
+            deltas = self.deltas
+
+        by_shard = defaultdict(list)
+        for h in self.objects:
+            by_shard[self.shard_keyname(h)].append(h)
+
+        remote_shards, _ = self.list_keys()
+
+        written = 0
+        # Empty shards that exist remotely need to be overwritten too
+        for name in sorted(set(by_shard) | set(remote_shards)):
+            entries = list(self.entries(by_shard.get(name, [])))
+            data = encode_objects(entries)
+            etag = hashlib.md5(data).hexdigest()
+            if name in remote_shards and strip_etag(remote_shards[name].etag) == etag:
+                continue
+            self.bucket.put(name, data, content_encoding='gzip')
+            self.save_cached_key(name, etag, entries)
+            written += 1
+
+        log.info("wrote %i objects to %i of %i shards in %s/%s",
+                 len(self.objects), written, len(by_shard), self.bucket.name, self.keyname)
+
+        deltas = sorted(deltas)
+        # Multi-object deletes are limited to 1000 keys per request
+        for i in range(0, len(deltas), 1000):
+            self.bucket.delete(deltas[i:i + 1000])
+        if deltas:
+            log.info("removed %i deltas from %s/%s", len(deltas), self.bucket.name, self.keyname)
+        self.deltas.difference_update(deltas)
+
+        # Clients that only know about the unsharded list should stop trusting
+        # it; with no list at all they fall back to checking each object
+        if self.bucket.head(self.keyname):
+            self.bucket.delete([self.keyname])
+            log.info("removed unsharded object list %s/%s", self.bucket.name, self.keyname)
+
+    def forget_added(self):
+        """
+        Drops the objects add()ed since loading that haven't been published,
+        e.g. because the upload that added them failed and they might not
+        exist
+        """
+        self.objects.difference_update(self.added)
+        for h in self.added:
+            self.last_modified.pop(h, None)
+        self.added = set()
+
+    def add(self, h, last_modified=None):
+        """
+        Adds an object to the list
+
+        Arguments:
+            h (str): the object's hash
+            last_modified (int): timestamp the object was last modified at,
+                                 if known
+        """
+        if h not in self.objects:
+            self.added.add(h)
+        self.objects.add(h)
+        if last_modified is not None:
+            self.last_modified[h] = int(last_modified)
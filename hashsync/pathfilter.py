@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Choosing which paths of a manifest to work on, for sparse checkouts
+
+Patterns are relative to the top of the manifest and use / between
+directories. A pattern selects the files it matches and everything under
+the directories it matches, so "src" selects all of src/, and "*.txt"
+selects every .txt file along with anything in a directory ending in .txt.
+Patterns use fnmatch syntax, where * also matches /. With no include
+patterns everything is included; exclude patterns win over includes.
+
+Only the part of the manifest and of the destination directory that can
+match is ever looked at: each include pattern is looked up by its leading
+directories, the ones without wildcards, and only those directories are
+walked.
+"""
+import fnmatch
+import os
+import re
+
+_MAGIC = re.compile(r'[*?[]')
+
+
+def _normalize(pattern):
+    return pattern.strip("/")
+
+
+def literal_prefix(pattern):
+    """
+    Returns the leading directories of pattern that don't have any wildcards
+    in them, e.g. "src/lib" for "src/lib/*.c", or "" for "*.c"
+    """
+    parts = []
+    for part in pattern.split("/"):
+        if _MAGIC.search(part):
+            break
+        parts.append(part)
+    return "/".join(parts)
+
+
+def _ancestors(filename):
+    "Yields filename, then each directory containing it, innermost first"
+    while filename:
+        yield filename
+        filename = filename.rpartition("/")[0]
+
+
+class PathFilter(object):
+    """
+    Include and exclude patterns to apply to relative filenames
+
+    Arguments:
+        include (list): patterns of paths to include; everything is included
+                        if this is empty
+        exclude (list): patterns of paths to leave out
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = [_normalize(p) for p in include or []]
+        self.exclude = [_normalize(p) for p in exclude or []]
+        if "" in self.include:
+            # "/" or "." includes everything
+            self.include = []
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+    __nonzero__ = __bool__
+
+    def _matches(self, patterns, filename):
+        for path in _ancestors(filename):
+            for pattern in patterns:
+                if path == pattern or fnmatch.fnmatchcase(path, pattern):
+                    return True
+        return False
+
+    def excluded(self, filename):
+        "Returns True if filename, or a directory it's in, is excluded"
+        return self._matches(self.exclude, filename)
+
+    def matches(self, filename):
+        "Returns True if the relative filename is selected"
+        if self.include and not self._matches(self.include, filename):
+            return False
+        return not self.excluded(filename)
+
+    def roots(self):
+        """
+        Returns the relative paths that everything selected is at or under,
+        with any that are under others left out. [""] means the whole tree.
+        """
+        if not self.include:
+            return [""]
+        roots = []
+        for prefix in sorted(set(literal_prefix(p) for p in self.include)):
+            if not any(prefix == r or prefix.startswith(r + "/") or not r for r in roots):
+                roots.append(prefix)
+        return roots
+
+    def select(self, manifest):
+        """
+        Returns the (hash, filename, permission) tuples of the files in
+        manifest that are selected, in manifest order
+        """
+        if not self:
+            return list(manifest.files)
+        roots = self.roots()
+        selected = []
+        for root in roots:
+            selected.extend(e for e in manifest.under(root) if self.matches(e[1]))
+        if len(roots) > 1:
+            order = dict((f, i) for i, (_, f, _) in enumerate(manifest.files))
+            selected.sort(key=lambda e: order[e[1]])
+        return selected
+
+    def traverse(self, dirname, action):
+        """
+        Calls action() on the selected files under dirname, without walking
+        directories that can't have any. Like
+        hashsync.utils.traverse_directory, (filename, action(filename)) is
+        yielded for each file.
+        """
+        for root in self.roots():
+            top = os.path.join(dirname, root) if root else dirname
+            if os.path.isfile(top):
+                if self.matches(root):
+                    yield top, action(top)
+                continue
+            for d, dirs, files in os.walk(top):
+                rel = os.path.relpath(d, dirname).replace(os.sep, "/")
+                rel = "" if rel == "." else rel + "/"
+                # Nothing under an excluded directory can be selected
+                dirs[:] = sorted(x for x in dirs if not self.excluded(rel + x))
+                for f in sorted(files):
+                    if self.matches(rel + f):
+                        filename = os.path.join(d, f)
+                        yield filename, action(filename)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Profiling across the main process and its workers
+
+start() begins profiling the current thread with cProfile. Process pools
+should be created with init_worker() as (or called from) their initializer,
+and thread pools with init_thread(), so that work done in workers is
+profiled too. Each process writes its profile to the profile directory when
+it exits, and stop() merges them all into one report. File names start with
+an ID for the run, so only this run's profiles are merged when a directory
+is reused.
+
+Optionally, tracemalloc snapshots are taken of every process as well.
+"""
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+from multiprocessing import util
+
+import logging
+log = logging.getLogger(__name__)
+
+# The active Profiler, if any. Forked workers inherit it.
+PROFILER = None
+
+
+class Profiler(object):
+    """
+    Collects cProfile data (and optionally tracemalloc snapshots) for one
+    run, writing them into dirname. Workers share their parent's run_id.
+    """
+    def __init__(self, dirname, memory=False, run_id=None):
+        self.dirname = os.path.abspath(dirname)
+        self.memory = memory
+        self.run_id = run_id or "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self.profile = None
+        # Profiles of worker threads in this process
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def _path(self, name, ext):
+        return os.path.join(self.dirname, "{}-{}-{}.{}".format(self.run_id, name, os.getpid(), ext))
+
+    def _files(self, ext):
+        "Returns the files of this run ending in ext"
+        prefix = self.run_id + "-"
+        return sorted(os.path.join(self.dirname, f) for f in os.listdir(self.dirname)
+                      if f.startswith(prefix) and f.endswith(ext))
+
+    def start(self, name="main"):
+        "Starts profiling the current thread; name is used in file names"
+        self.name = name
+        if self.memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                # Forget allocations inherited from the parent process
+                tracemalloc.clear_traces()
+            else:
+                tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def start_thread(self):
+        "Starts profiling the current thread, which should be a pool worker"
+        p = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(p)
+        p.enable()
+
+    def dump(self):
+        """
+        Stops profiling and writes out this process's profile. Worker threads
+        must have finished by now.
+        """
+        self.profile.disable()
+        stats = pstats.Stats(self.profile)
+        for p in self.thread_profiles:
+            p.disable()
+            stats.add(p)
+        stats.dump_stats(self._path(self.name, "prof"))
+        if self.memory:
+            import tracemalloc
+            tracemalloc.take_snapshot().dump(self._path(self.name, "tracemalloc"))
+            # Tracing slows everything down, so don't leave it on
+            tracemalloc.stop()
+
+    def report(self, limit=50):
+        """
+        Merges the profiles of every process in this run into merged.prof,
+        and writes a text report to report.txt
+
+        Returns:
+            path to the report
+        """
+        files = self._files(".prof")
+        report = os.path.join(self.dirname, "report.txt")
+        with open(report, 'w') as f:
+            f.write("Profiles merged from {} processes\n\n".format(len(files)))
+            stats = pstats.Stats(*files, stream=f)
+            stats.dump_stats(os.path.join(self.dirname, "merged.prof"))
+            stats.sort_stats("cumulative").print_stats(limit)
+            stats.sort_stats("tottime").print_stats(limit)
+
+            if self.memory:
+                self._report_memory(f)
+        return report
+
+    def _report_memory(self, f, limit=10):
+        import tracemalloc
+        for path in self._files(".tracemalloc"):
+            snapshot = tracemalloc.Snapshot.load(path)
+            top = snapshot.statistics("lineno")
+            f.write("\nTop allocations in {} ({:.1f} KiB total)\n".format(
+                os.path.basename(path), sum(s.size for s in top) / 1024.0))
+            for s in top[:limit]:
+                f.write("  {}\n".format(s))
+
+
+def start(dirname, memory=False):
+    """
+    Starts profiling this process and any workers created with init_worker()
+    or init_thread()
+
+    Arguments:
+        dirname (str): directory to write profiles and the report to
+        memory (bool): take tracemalloc snapshots too
+    """
+    global PROFILER
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    PROFILER = Profiler(dirname, memory)
+    PROFILER.start()
+    log.info("profiling to %s", PROFILER.dirname)
+
+
+def stop():
+    """
+    Stops profiling, and writes the merged report. Worker pools must have
+    been shut down by now so that their profiles have been written.
+    """
+    global PROFILER
+    if not PROFILER:
+        return
+    PROFILER.dump()
+    log.info("wrote profile report to %s", PROFILER.report())
+    PROFILER = None
+
+
+def init_worker():
+    """
+    Initializer for process pool workers; starts profiling the worker if
+    profiling is on. The profile is written when the worker exits.
+    """
+    global PROFILER
+    if not PROFILER:
+        return
+    # Start over rather than adding to the copy of the parent's profile
+    if PROFILER.profile:
+        PROFILER.profile.disable()
+    PROFILER = Profiler(PROFILER.dirname, PROFILER.memory, PROFILER.run_id)
+    PROFILER.start("worker")
+    util.Finalize(None, PROFILER.dump, exitpriority=10)
+
+
+def init_thread():
+    "Initializer for thread pool workers; profiles the thread if profiling is on"
+    if PROFILER:
+        PROFILER.start_thread()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Finding which objects are reachable from a set of manifests
+"""
+import binascii
+import heapq
+
+from hashsync.manifest import Manifest
+from hashsync.hashing import get_algorithm
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class HashSet(object):
+    """
+    A compact set of hex hashes.
+
+    Hashes are stored as sorted byte strings of binary digests, which take
+    digest_size bytes per hash instead of the ~100 bytes per hash of a set
+    of strings. Hashes are added to a small pending set, which is sorted into
+    a new run every batch_size hashes. A run is merged into the one before it
+    once it's at least as big, so each hash is only merged O(log n) times,
+    and everything is merged into one run when the set is first queried.
+
+    Strings that aren't hex hashes of digest_size bytes are never in the
+    set; adding one logs a warning.
+
+    Arguments:
+        digest_size (int): size in bytes of each binary digest
+        batch_size (int): how many hashes to buffer before merging
+    """
+    def __init__(self, digest_size=20, batch_size=1000000):
+        self.digest_size = digest_size
+        self.batch_size = batch_size
+        # Sorted runs of digests, each no bigger than the one before
+        self.runs = []
+        self.pending = set()
+
+    def _digest(self, h):
+        "Returns the binary digest of h, or None if it isn't a hash"
+        try:
+            digest = binascii.unhexlify(h)
+        except (TypeError, ValueError):
+            return None
+        if len(digest) != self.digest_size:
+            return None
+        return digest
+
+    def valid(self, h):
+        "Returns True if h is a hex hash of the right size to be in the set"
+        return self._digest(h) is not None
+
+    def _records(self, run):
+        n = self.digest_size
+        for i in range(0, len(run), n):
+            yield bytes(run[i:i + n])
+
+    def _merge(self, a, b):
+        merged = bytearray()
+        last = None
+        for record in heapq.merge(self._records(a), self._records(b)):
+            if record != last:
+                merged += record
+                last = record
+        return merged
+
+    def _flush(self, compact=False):
+        if self.pending:
+            self.runs.append(bytearray(b''.join(sorted(self.pending))))
+            self.pending = set()
+        while len(self.runs) > 1 and (compact or len(self.runs[-1]) >= len(self.runs[-2])):
+            b = self.runs.pop()
+            a = self.runs.pop()
+            self.runs.append(self._merge(a, b))
+
+    @property
+    def data(self):
+        "The sorted digests of every hash in the set"
+        if self.pending or len(self.runs) > 1:
+            self._flush(compact=True)
+        return self.runs[0] if self.runs else bytearray()
+
+    def add(self, h):
+        digest = self._digest(h)
+        if digest is None:
+            log.warning("skipping %r; it isn't a hash", h)
+            return
+        self.pending.add(digest)
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+
+    def __len__(self):
+        return len(self.data) // self.digest_size
+
+    def __contains__(self, h):
+        digest = self._digest(h)
+        if digest is None:
+            return False
+        data = self.data
+        n = self.digest_size
+        lo, hi = 0, len(data) // n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = data[mid * n:(mid + 1) * n]
+            if record < digest:
+                lo = mid + 1
+            elif record > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+
+def mark_manifests(filenames):
+    """
+    Builds the set of objects reachable from a set of manifests
+
+    Arguments:
+        filenames (list): paths to manifest files, compressed or not
+
+    Returns:
+        a dict of hash algorithm name to a HashSet of every object
+        referenced by the manifests using that algorithm
+    """
+    sets = {}
+    for filename in filenames:
+        m = Manifest()
+        with open(filename, 'rb') as f:
+            m.load(f)
+        reachable = sets.get(m.algorithm)
+        if reachable is None:
+            reachable = sets[m.algorithm] = HashSet(get_algorithm(m.algorithm).digest_size)
+        for h, _, _ in m.files:
+            reachable.add(h)
+        # Chunked files are stored as their chunks
+        for chunks in m.chunks.values():
+            for h, _ in chunks:
+                reachable.add(h)
+        log.info("marked %i files from %s", len(m.files), filename)
+    # Merge any pending hashes before the sets are shared between threads
+    for name, reachable in sorted(sets.items()):
+        log.info("%i %s objects are reachable", len(reachable), name)
+    return sets
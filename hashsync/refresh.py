@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scheduling refreshes of objects' last-modified times
+"""
+import time
+
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def refresh_offset(h, window):
+    """
+    Returns a deterministic offset in [0, window) for an object, spreading
+    objects evenly over the window by their hash
+    """
+    return int(h[:8], 16) * window // 16 ** 8
+
+
+class RefreshScheduler(object):
+    """
+    Decides which objects to refresh based on their last-modified times.
+
+    Each object becomes due for a refresh once it is older than
+    mintime + refresh_offset(h, window). Objects that were uploaded together
+    are therefore refreshed over the course of the window rather than all at
+    once, and always before they drop out of the object list. At most
+    max_per_run objects are scheduled by one scheduler; anything left over is
+    still due on the next run.
+
+    Arguments:
+        last_modified (dict): maps hashes to last-modified timestamps; objects
+                              that aren't in here are never scheduled
+        now (float): current time; defaults to time.time()
+        mintime (int): minimum age of an object before it is refreshed
+        window (int): objects are refreshed between mintime and
+                      mintime + window seconds old
+        max_per_run (int): maximum number of objects to schedule
+    """
+    def __init__(self, last_modified, now=None, mintime=config.REFRESH_MINTIME,
+                 window=config.REFRESH_WINDOW, max_per_run=config.REFRESH_MAX_PER_RUN):
+        self.last_modified = last_modified
+        self.now = now if now is not None else time.time()
+        self.mintime = mintime
+        self.window = window
+        self.max_per_run = max_per_run
+
+        self.scheduled = set()
+        self.deferred = set()
+
+    def is_due(self, h):
+        "Returns True if h is due to be refreshed"
+        if h not in self.last_modified:
+            return False
+        age = self.now - self.last_modified[h]
+        return age >= self.mintime + refresh_offset(h, self.window)
+
+    def should_refresh(self, h):
+        """
+        Returns True if h should be refreshed by this run. Each object is
+        only scheduled once, and counts against max_per_run.
+        """
+        if h in self.scheduled or not self.is_due(h):
+            return False
+        if len(self.scheduled) >= self.max_per_run:
+            self.deferred.add(h)
+            return False
+        self.scheduled.add(h)
+        return True
+
+    def report(self):
+        log.info("scheduled %i refreshes; %i deferred to later runs", len(self.scheduled), len(self.deferred))
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Retries, timeouts and hedged requests for object transfers
+
+RetryingBackend wraps a storage backend so that each request is given a
+timeout, and retried with exponential backoff and jitter if it fails or
+times out. Optionally, reads that are slower than almost all recent reads
+get a duplicate "hedged" request, and whichever finishes first wins, so a
+few stalled requests don't hold up a whole transfer.
+
+The timeout is how long a request can go without making progress. Requests
+that stream to or from a file are timed from the last time they read or
+wrote it, so large objects take as long as they need while they're moving.
+Requests with a body we can't watch get an extra second for every min_rate
+bytes of it.
+
+Requests run in a separate thread so they can be abandoned when they time
+out. File objects passed to an abandoned request are guarded so it can't
+touch them once we've moved on.
+"""
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from hashsync.storage import StorageBackend, StorageError, NotFound
+from hashsync.metrics import METRICS
+from hashsync.utils import copy_stream
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Error codes that are worth retrying
+RETRY_CODES = ('SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout')
+# Error codes that mean we're going too fast
+THROTTLE_CODES = ('SlowDown', 'ServiceUnavailable')
+
+
+class RequestTimeout(StorageError):
+    def __init__(self, op, name, timeout):
+        StorageError.__init__(self, None, 'RequestTimeout',
+                              "{} {} made no progress for {:.0f}s".format(op, name, timeout))
+
+
+class AttemptCancelled(Exception):
+    "Raised in an abandoned request that tries to use its file object"
+
+
+def is_retryable(e):
+    "Returns True if the exception e is worth retrying the request for"
+    if isinstance(e, NotFound):
+        return False
+    if isinstance(e, StorageError):
+        return e.code in RETRY_CODES or (e.status or 0) >= 500
+    return isinstance(e, (IOError, OSError, socket.error))
+
+
+def is_throttled(e):
+    """
+    Returns True if the exception e means the store is overloaded, i.e. we
+    were throttled or the request timed out
+    """
+    return getattr(e, 'code', None) in THROTTLE_CODES + ('RequestTimeout',)
+
+
+class TransferPolicy(object):
+    """
+    How requests to the store are timed out, retried and hedged
+
+    Arguments:
+        timeout (float): seconds each attempt can go without making progress;
+                         None waits forever
+        max_attempts (int): how many times to try each request
+        backoff (float): base delay between attempts, in seconds
+        max_backoff (float): maximum delay between attempts
+        hedge (bool): send duplicate reads for slow requests
+        hedge_quantile (float): reads slower than this quantile of recent
+                                reads are hedged
+        hedge_min_samples (int): how many reads to see before hedging
+        min_rate (float): slowest rate, in bytes per second, to allow for
+                          bodies whose progress can't be watched
+    """
+    def __init__(self, timeout=config.REQUEST_TIMEOUT, max_attempts=config.REQUEST_MAX_ATTEMPTS,
+                 backoff=config.REQUEST_BACKOFF, max_backoff=config.REQUEST_MAX_BACKOFF, hedge=False,
+                 hedge_quantile=config.HEDGE_QUANTILE, hedge_min_samples=config.HEDGE_MIN_SAMPLES,
+                 min_rate=config.REQUEST_MIN_RATE):
+        self.timeout = timeout
+        self.min_rate = min_rate
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+
+    def delay(self, attempt):
+        "Returns how long to wait before trying again after attempt failed"
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the most recent requests so we can tell when a
+    request is unusually slow
+    """
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self.lock:
+            self.samples.append(elapsed)
+
+    def quantile(self, q, min_samples=1):
+        "Returns the qth quantile of recent latencies, or None if we haven't seen enough requests"
+        with self.lock:
+            if len(self.samples) < max(min_samples, 1):
+                return None
+            samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class Attempt(object):
+    """
+    One attempt at a request. Once cancelled, its guarded file objects raise
+    AttemptCancelled rather than being used. Using them counts as progress.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.cancelled = False
+        self.last_progress = time.time()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+
+
+class _GuardedFile(object):
+    def __init__(self, fobj, attempt):
+        self.fobj = fobj
+        self.attempt = attempt
+
+    def _call(self, method, *args):
+        with self.attempt.lock:
+            if self.attempt.cancelled:
+                raise AttemptCancelled()
+            self.attempt.last_progress = time.time()
+            return getattr(self.fobj, method)(*args)
+
+    def read(self, *args):
+        return self._call('read', *args)
+
+    def write(self, data):
+        return self._call('write', data)
+
+    def seek(self, *args):
+        return self._call('seek', *args)
+
+    def tell(self):
+        return self._call('tell')
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+
+class RetryingBackend(StorageBackend):
+    """
+    Wraps a storage backend, applying a TransferPolicy to its requests.
+    Listing and deleting are passed straight through; listings can be
+    resumed with checkpoints, and deletes are retried by the reaper.
+    """
+    def __init__(self, backend, policy=None):
+        self.backend = backend
+        self.name = backend.name
+        self.policy = policy or TransferPolicy()
+        self.latency = {}
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _tracker(self, op):
+        tracker = self.latency.get(op)
+        if tracker is None:
+            tracker = self.latency.setdefault(op, LatencyTracker())
+        return tracker
+
+    def _start(self, func, attempt, results):
+        def run():
+            start = time.time()
+            try:
+                results.put((attempt, True, func(attempt), time.time() - start))
+            except Exception as e:
+                results.put((attempt, False, e, time.time() - start))
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def _attempt(self, op, name, func, hedge, nbytes=0):
+        """
+        Makes one attempt at a request, possibly with a hedged duplicate.
+
+        Arguments:
+            func: called with an Attempt; performs the request and returns
+                  its result
+            hedge (bool): whether this request may be hedged
+            nbytes (int): size of a body that's sent or received without
+                          going through a guarded file
+
+        Returns:
+            (attempt, result) for the attempt that succeeded
+        """
+        policy = self.policy
+        if policy.timeout is None and not (hedge and policy.hedge):
+            # Nothing to give up on, so don't bother with a thread
+            attempt = Attempt(0)
+            start = time.time()
+            retval = func(attempt)
+            self._tracker(op).add(time.time() - start)
+            return attempt, retval
+
+        hedge_after = None
+        if hedge and policy.hedge:
+            hedge_after = self._tracker(op).quantile(policy.hedge_quantile, policy.hedge_min_samples)
+
+        timeout = policy.timeout
+        if timeout is not None and nbytes and policy.min_rate:
+            timeout += float(nbytes) / policy.min_rate
+
+        def deadline():
+            # Whichever attempt has made progress most recently
+            return max(a.last_progress for a in attempts) + timeout
+
+        results = queue.Queue()
+        start = time.time()
+        attempts = [Attempt(0)]
+        self._start(func, attempts[0], results)
+        failed = 0
+        try:
+            while True:
+                now = time.time()
+                wait = None
+                if timeout is not None:
+                    wait = deadline() - now
+                if hedge_after is not None and len(attempts) == 1:
+                    until_hedge = start + hedge_after - now
+                    wait = until_hedge if wait is None else min(wait, until_hedge)
+                try:
+                    attempt, ok, value, elapsed = results.get(timeout=max(wait, 0) if wait is not None else None)
+                except queue.Empty:
+                    now = time.time()
+                    alive = timeout is None or now < deadline()
+                    if alive and hedge_after is not None and len(attempts) == 1 and now >= start + hedge_after:
+                        log.info("%s %s is taking longer than %.3fs; hedging", op, name, hedge_after)
+                        METRICS.incr("hashsync_hedges_total", op=op)
+                        attempts.append(Attempt(1))
+                        self._start(func, attempts[1], results)
+                        continue
+                    if alive:
+                        # The request made progress while we were waiting
+                        continue
+                    METRICS.incr("hashsync_timeouts_total", op=op)
+                    raise RequestTimeout(op, name, timeout)
+
+                if ok:
+                    self._tracker(op).add(elapsed)
+                    if attempt.index == 1:
+                        METRICS.incr("hashsync_hedge_wins_total", op=op)
+                    return attempt, value
+                failed += 1
+                if failed == len(attempts):
+                    raise value
+        finally:
+            for a in attempts:
+                a.cancel()
+
+    def _call(self, op, name, func, hedge=False, reset=None, nbytes=0):
+        """
+        Calls func, retrying it according to the policy
+
+        Arguments:
+            reset: called before each retry, e.g. to rewind a file
+            nbytes: see _attempt
+        """
+        attempt = 1
+        while True:
+            try:
+                return self._attempt(op, name, func, hedge, nbytes)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.policy.max_attempts:
+                    raise
+                delay = self.policy.delay(attempt)
+                log.warning("%s %s failed (%s); retrying in %.2fs", op, name, e, delay)
+                METRICS.incr("hashsync_retries_total", op=op)
+                if getattr(e, 'code', None) in THROTTLE_CODES:
+                    METRICS.incr("hashsync_throttled_total", op=op)
+                time.sleep(delay)
+                attempt += 1
+                if reset:
+                    reset()
+
+    def head(self, name):
+        return self._call("head", name, lambda a: self.backend.head(name), hedge=True)[1]
+
+    def get(self, name):
+        return self._call("get", name, lambda a: self.backend.get(name), hedge=True)[1]
+
+    def get_range(self, name, start, end):
+        return self._call("get_range", name, lambda a: self.backend.get_range(name, start, end), hedge=True,
+                          nbytes=end - start + 1)[1]
+
+    def get_to_file(self, name, fobj):
+        pos = fobj.tell()
+
+        def reset():
+            fobj.seek(pos)
+            fobj.truncate()
+
+        def get(attempt):
+            if attempt.index == 0:
+                self.backend.get_to_file(name, _GuardedFile(fobj, attempt))
+                return None
+            # Hedged requests can't share fobj with the first attempt
+            tmp = tempfile.TemporaryFile()
+            try:
+                self.backend.get_to_file(name, _GuardedFile(tmp, attempt))
+            except Exception:
+                tmp.close()
+                raise
+            return tmp
+
+        attempt, tmp = self._call("get", name, get, hedge=True, reset=reset)
+        if tmp:
+            with tmp:
+                reset()
+                tmp.seek(0)
+                copy_stream(tmp, fobj)
+
+    def put(self, name, data, **kwargs):
+        if isinstance(data, bytes):
+            self._call("put", name, lambda a: self.backend.put(name, data, **kwargs), nbytes=len(data))
+            return
+
+        pos = data.tell()
+        self._call("put", name, lambda a: self.backend.put(name, _GuardedFile(data, a), **kwargs),
+                   reset=lambda: data.seek(pos))
+
+    def copy(self, name, **kwargs):
+        self._call("copy", name, lambda a: self.backend.copy(name, **kwargs))
+
+    def start_multipart(self, name, **kwargs):
+        return self._call("start_multipart", name, lambda a: self.backend.start_multipart(name, **kwargs))[1]
+
+    def put_part(self, name, upload_id, part_number, data):
+        return self._call("put_part", name,
+                          lambda a: self.backend.put_part(name, upload_id, part_number, data),
+                          nbytes=len(data) if isinstance(data, bytes) else 0)[1]
+
+    def complete_multipart(self, name, upload_id, parts):
+        self._call("complete_multipart", name, lambda a: self.backend.complete_multipart(name, upload_id, parts))
+
+    def abort_multipart(self, name, upload_id):
+        self._call("abort_multipart", name, lambda a: self.backend.abort_multipart(name, upload_id))
+
+    def list(self, prefix=''):
+        return self.backend.list(prefix)
+
+    def list_versions(self, prefix=''):
+        return self.backend.list_versions(prefix)
+
+    def delete(self, keys):
+        return self.backend.delete(keys)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Ordering transfers so a run isn't held up by one big file at the end
+
+Transfers are started largest first (LPT, longest processing time first), so
+the big ones overlap with everything else rather than starting last and
+running alone. Small transfers are mostly waiting on request latency rather
+than bandwidth, so once every worker has a large transfer, batches of small
+ones are interleaved between the remaining large ones to keep connections
+busy.
+"""
+import heapq
+
+from hashsync.metrics import METRICS
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def lpt_order(tasks, jobs, small_size=config.SMALL_TRANSFER_SIZE, batch_size=config.SMALL_TRANSFER_BATCH):
+    """
+    Orders tasks for submission to a pool of jobs workers
+
+    Arguments:
+        tasks (list): (size, task) tuples; tasks of equal size keep their
+                      order
+        jobs (int): how many transfers run at once
+        small_size (int): tasks smaller than this are interleaved in batches
+                          rather than left until the end
+        batch_size (int): how many small tasks to put between large ones
+
+    Returns:
+        a list of (size, task) tuples in the order they should be started
+    """
+    ordered = sorted(tasks, key=lambda t: t[0], reverse=True)
+    large = [t for t in ordered if t[0] >= small_size]
+    small = [t for t in ordered if t[0] < small_size]
+
+    retval = large[:jobs]
+    large = large[jobs:]
+    i = 0
+    for t in large:
+        retval.append(t)
+        retval.extend(small[i:i + batch_size])
+        i += batch_size
+    retval.extend(small[i:])
+    return retval
+
+
+def estimate_makespan(sizes, jobs, overhead=config.TRANSFER_OVERHEAD):
+    """
+    Estimates how long transfers of the given sizes take when started in
+    order on jobs workers, each worker taking the next transfer as soon as
+    it's free
+
+    Arguments:
+        sizes (list): size of each transfer, in the order they're started
+        jobs (int): how many transfers run at once
+        overhead (int): fixed cost of each transfer, in bytes
+
+    Returns:
+        the estimated time, in bytes' worth of transfer on one worker
+    """
+    workers = [0] * max(jobs, 1)
+    for size in sizes:
+        heapq.heappush(workers, heapq.heappop(workers) + size + overhead)
+    return max(workers)
+
+
+def schedule(tasks, jobs, largest_first=True):
+    """
+    Orders tasks with lpt_order, logging and recording how much shorter the
+    run should be than starting tasks in the order given
+
+    Arguments:
+        tasks (list): (size, task) tuples, in the order they were found
+        jobs (int): how many transfers run at once
+        largest_first (bool): if False, tasks are left in the order given
+
+    Returns:
+        a list of (size, task) tuples in the order they should be started
+    """
+    if not largest_first:
+        return tasks
+    ordered = lpt_order(tasks, jobs)
+    if tasks:
+        before = estimate_makespan([size for size, _ in tasks], jobs)
+        after = estimate_makespan([size for size, _ in ordered], jobs)
+        log.info("scheduled %i transfers largest first; estimated makespan is %.0f%% of walk order",
+                 len(tasks), 100.0 * after / before)
+        METRICS.set_gauge("hashsync_schedule_makespan_ratio", float(after) / before)
+    return ordered
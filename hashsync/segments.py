@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Downloading large objects as byte ranges in parallel
+
+Uncompressed objects are split into fixed size ranges. Compressed objects
+can be split up if they were written by compress_segmented, whose header
+says where each gzip member starts; each member is fetched and decompressed
+on its own. Either way, each range is written at its offset into a file
+preallocated to the final size.
+"""
+import os
+from multiprocessing.pool import ThreadPool
+
+from hashsync.compression import read_segment_index, decompress_member
+from hashsync.metrics import METRICS
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Enough to hold the largest possible gzip header with a segment index
+INDEX_HEADER_SIZE = 12 + 65535
+
+
+def plan_ranges(size, segment_size):
+    """
+    Splits an object of size bytes into ranges
+
+    Returns:
+        a list of (start, end) tuples; end is inclusive, as for get_range
+    """
+    return [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+
+def preallocate(filename, size):
+    "Creates filename with size bytes, reserving the space if we can"
+    with open(filename, 'wb') as f:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                # Not supported on this filesystem
+                pass
+        f.truncate(size)
+
+
+def _write_at(filename, offset, data):
+    with open(filename, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _run(tasks, jobs):
+    # Threads are enough here; the work is mostly waiting on the network, and
+    # we're often already running in a worker process
+    pool = ThreadPool(min(jobs, len(tasks)))
+    try:
+        for job in [pool.apply_async(task) for task in tasks]:
+            job.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def download_ranges(bucket, keyname, dst, size, segment_size=config.SEGMENT_SIZE, jobs=config.SEGMENT_JOBS,
+                    hasher=None):
+    """
+    Downloads an uncompressed object to dst as concurrent byte ranges
+
+    Arguments:
+        bucket (StorageBackend): where to download from
+        keyname (str): object to download
+        dst (str): filename to write to
+        size (int): size of the object
+        segment_size (int): bytes per range
+        jobs (int): how many ranges to download at once
+        hasher (hashsync.verify.OrderedHasher): hashes each range once it's
+                                                written
+    """
+    preallocate(dst, size)
+    ranges = plan_ranges(size, segment_size)
+    log.debug("Downloading %s as %i ranges", keyname, len(ranges))
+
+    def fetch(start, end):
+        def task():
+            data = bucket.get_range(keyname, start, end)
+            _write_at(dst, start, data)
+            if hasher:
+                hasher.update_at(start, data)
+            METRICS.incr("hashsync_segments_total", encoding="identity")
+        return task
+
+    if ranges:
+        _run([fetch(start, end) for start, end in ranges], jobs)
+
+
+def download_gzip_segments(bucket, keyname, dst, size, jobs=config.SEGMENT_JOBS, hasher=None):
+    """
+    Downloads a compressed object written by compress_segmented to dst,
+    fetching and decompressing its gzip members concurrently
+
+    Arguments:
+        bucket (StorageBackend): where to download from
+        keyname (str): object to download
+        dst (str): filename to write the decompressed data to
+        size (int): size of the compressed object
+        jobs (int): how many members to download at once
+        hasher (hashsync.verify.OrderedHasher): hashes each member's
+                                                decompressed data once it's
+                                                written
+
+    Returns:
+        True if the object was downloaded; False if it isn't segmented, in
+        which case nothing was written
+    """
+    index = read_segment_index(bucket.get_range(keyname, 0, min(size, INDEX_HEADER_SIZE) - 1))
+    if not index:
+        return False
+    total, segment_size, offsets = index
+    log.debug("Downloading %s as %i gzip members", keyname, len(offsets))
+    preallocate(dst, total)
+    ends = [o - 1 for o in offsets[1:]] + [size - 1]
+
+    def fetch(i, start, end):
+        def task():
+            data = bucket.get_range(keyname, start, end)
+            with METRICS.stage("decompress"):
+                data = decompress_member(data)
+            _write_at(dst, i * segment_size, data)
+            if hasher:
+                hasher.update_at(i * segment_size, data)
+            METRICS.incr("hashsync_segments_total", encoding="gzip")
+        return task
+
+    _run([fetch(i, start, end) for i, (start, end) in enumerate(zip(offsets, ends))], jobs)
+    return True
@@ -0,0 +1,793 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage backends for hashsync
+
+All access to the object store goes through a StorageBackend. There are
+implementations for S3 (via boto), for a directory on the local filesystem,
+and for memory. The local and in-memory backends can simulate network
+latency and bandwidth, which makes it possible to benchmark transfers
+without S3.
+
+Backends are usually created from a URL with open_backend():
+    s3://bucket?region=us-east-1
+    file:///path/to/directory?latency=0.05&bandwidth=10M
+    memory://name?latency=0.01
+
+memory:// backends only exist in the process that opened them, so they're
+for tests; the command line tools start worker processes that wouldn't see
+each other's objects.
+"""
+import binascii
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+from hashsync.utils import copy_stream, iterfile, parse_date
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class StorageError(Exception):
+    """
+    An error returned by a storage backend
+
+    Attributes:
+        status (int): HTTP style status code, e.g. 404 or 503
+        code (str): error code, e.g. "NoSuchKey" or "SlowDown"
+    """
+    def __init__(self, status, code, message=None):
+        Exception.__init__(self, status, code, message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class NotFound(StorageError):
+    def __init__(self, name):
+        StorageError.__init__(self, 404, 'NoSuchKey', name)
+
+
+class ObjectInfo(object):
+    """
+    Metadata about an object, or one version of an object
+
+    Attributes:
+        name (str): key name
+        size (int): size in bytes
+        etag (str): ETag, without quotes
+        last_modified (float): timestamp the object was last modified
+        content_encoding (str): Content-Encoding, if known
+        version_id (str): version id, for listings of versions
+        is_delete_marker (bool): True if this version is a delete marker
+    """
+    def __init__(self, name, size=None, etag=None, last_modified=None, content_encoding=None,
+                 version_id=None, is_delete_marker=False):
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_encoding = content_encoding
+        self.version_id = version_id
+        self.is_delete_marker = is_delete_marker
+
+    def __repr__(self):
+        return "<ObjectInfo {}>".format(self.name)
+
+
+class DeleteResult(object):
+    """
+    Result of a multi-object delete
+
+    Attributes:
+        deleted (list): (name, version_id) tuples that were deleted
+        errors (list): (name, version_id, code, message) tuples that failed
+    """
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+
+def _split_key(key):
+    if isinstance(key, tuple):
+        return key
+    return key, None
+
+
+def _multipart_etag(parts):
+    # S3 names multipart objects after the MD5 of their parts' MD5s
+    digests = b''.join(binascii.unhexlify(etag) for _, etag in parts)
+    return "{}-{}".format(hashlib.md5(digests).hexdigest(), len(parts))
+
+
+def _invalid_part(name, part_number):
+    return StorageError(400, 'InvalidPart', "{} part {}".format(name, part_number))
+
+
+class StorageBackend(object):
+    """
+    Interface for object stores
+    """
+    #: Name of the store, used in log messages
+    name = None
+
+    def head(self, name):
+        """
+        Returns an ObjectInfo for an object, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def get(self, name):
+        """
+        Returns the contents of an object as bytes. Raises NotFound if it
+        doesn't exist.
+        """
+        fobj = BytesIO()
+        self.get_to_file(name, fobj)
+        return fobj.getvalue()
+
+    def get_to_file(self, name, fobj):
+        """
+        Writes the contents of an object to the file object fobj. Raises
+        NotFound if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def get_range(self, name, start, end):
+        """
+        Returns bytes start through end (inclusive) of an object. Raises
+        NotFound if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def put(self, name, data, content_encoding=None, reduced_redundancy=False, public=False):
+        """
+        Stores an object
+
+        Arguments:
+            name (str): key name
+            data (bytes or file object): contents of the object
+            content_encoding (str): Content-Encoding to store with the object
+            reduced_redundancy (bool): use reduced redundancy storage, where
+                                       supported
+            public (bool): make the object publicly readable, where supported
+        """
+        raise NotImplementedError
+
+    def copy(self, name, reduced_redundancy=False):
+        """
+        Copies an object on top of itself to refresh its last-modified time.
+        Raises NotFound if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def start_multipart(self, name, content_encoding=None, reduced_redundancy=False, public=False):
+        """
+        Starts uploading an object in parts. The parts are uploaded with
+        put_part, and the object appears once complete_multipart is called.
+        Arguments are as for put.
+
+        Returns:
+            the upload id
+        """
+        raise NotImplementedError
+
+    def put_part(self, name, upload_id, part_number, data):
+        """
+        Uploads one part of a multipart upload. Raises NotFound if the
+        upload doesn't exist, e.g. because it was completed or aborted.
+
+        Arguments:
+            part_number (int): which part this is, starting from 1
+            data (bytes): contents of the part
+
+        Returns:
+            the part's ETag, without quotes
+        """
+        raise NotImplementedError
+
+    def complete_multipart(self, name, upload_id, parts):
+        """
+        Assembles the parts of a multipart upload into the object
+
+        Arguments:
+            parts (list): (part_number, etag) tuples for every part, in order
+        """
+        raise NotImplementedError
+
+    def abort_multipart(self, name, upload_id):
+        "Abandons a multipart upload, discarding its parts"
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """
+        Yields an ObjectInfo for each object whose name starts with prefix,
+        in name order
+        """
+        raise NotImplementedError
+
+    def list_versions(self, prefix=''):
+        """
+        Yields an ObjectInfo for each version of each object whose name
+        starts with prefix. All versions of an object are listed together.
+        Backends without versioning list one version per object.
+        """
+        for info in self.list(prefix):
+            info.version_id = 'null'
+            yield info
+
+    def delete(self, keys):
+        """
+        Deletes objects
+
+        Arguments:
+            keys (list): names, or (name, version_id) tuples, to delete
+
+        Returns:
+            a DeleteResult
+        """
+        raise NotImplementedError
+
+
+def as_backend(bucket):
+    """
+    Returns a StorageBackend for bucket, which may already be a backend, or a
+    boto Bucket. None is passed through.
+    """
+    if bucket is None or isinstance(bucket, StorageBackend):
+        return bucket
+    return BotoBackend(bucket)
+
+
+class BotoBackend(StorageBackend):
+    """
+    Storage backend for an S3 bucket, using boto
+
+    Arguments:
+        bucket (boto.s3.bucket.Bucket): bucket to use
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.name = bucket.name
+
+    def _error(self, e):
+        if e.status == 404:
+            return NotFound(e.message)
+        return StorageError(e.status, e.error_code, e.message)
+
+    def _info(self, key, version_id=None, is_delete_marker=False):
+        return ObjectInfo(
+            key.name,
+            size=getattr(key, 'size', None),
+            etag=key.etag.strip('"') if getattr(key, 'etag', None) else None,
+            last_modified=parse_date(key.last_modified) if key.last_modified else None,
+            content_encoding=getattr(key, 'content_encoding', None),
+            version_id=version_id,
+            is_delete_marker=is_delete_marker,
+        )
+
+    def _get_key(self, name):
+        from boto.exception import S3ResponseError
+        try:
+            key = self.bucket.get_key(name)
+        except S3ResponseError as e:
+            raise self._error(e)
+        if not key:
+            raise NotFound(name)
+        return key
+
+    def head(self, name):
+        try:
+            return self._info(self._get_key(name))
+        except NotFound:
+            return None
+
+    def get(self, name):
+        from boto.exception import S3ResponseError
+        try:
+            return self._get_key(name).get_contents_as_string()
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def get_to_file(self, name, fobj):
+        from boto.exception import S3ResponseError
+        try:
+            copy_stream(self._get_key(name), fobj)
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def get_range(self, name, start, end):
+        from boto.exception import S3ResponseError
+        key = self.bucket.new_key(name)
+        try:
+            return key.get_contents_as_string(headers={'Range': 'bytes={}-{}'.format(start, end)})
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def put(self, name, data, content_encoding=None, reduced_redundancy=False, public=False):
+        from boto.exception import S3ResponseError
+        key = self.bucket.new_key(name)
+        if content_encoding:
+            key.set_metadata('Content-Encoding', content_encoding)
+        kwargs = {'reduced_redundancy': reduced_redundancy}
+        if public:
+            kwargs['policy'] = 'public-read'
+        try:
+            if isinstance(data, bytes):
+                key.set_contents_from_string(data, **kwargs)
+            else:
+                key.set_contents_from_file(data, **kwargs)
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def copy(self, name, reduced_redundancy=False):
+        from boto.exception import S3ResponseError
+        try:
+            self.bucket.new_key(name).copy(self.bucket.name, name, reduced_redundancy=reduced_redundancy)
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def start_multipart(self, name, content_encoding=None, reduced_redundancy=False, public=False):
+        from boto.exception import S3ResponseError
+        headers = {'Content-Encoding': content_encoding} if content_encoding else None
+        kwargs = {'reduced_redundancy': reduced_redundancy}
+        if public:
+            kwargs['policy'] = 'public-read'
+        try:
+            return self.bucket.initiate_multipart_upload(name, headers=headers, **kwargs).id
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def put_part(self, name, upload_id, part_number, data):
+        from boto.exception import S3ResponseError
+        from boto.s3.multipart import MultiPartUpload
+        mp = MultiPartUpload(self.bucket)
+        mp.key_name = name
+        mp.id = upload_id
+        try:
+            key = mp.upload_part_from_file(BytesIO(data), part_number)
+        except S3ResponseError as e:
+            raise self._error(e)
+        if key is not None and key.etag:
+            return key.etag.strip('"')
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, name, upload_id, parts):
+        from boto.exception import S3ResponseError
+        xml = "".join('<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag></Part>'.format(n, etag)
+                      for n, etag in parts)
+        try:
+            self.bucket.complete_multipart_upload(
+                name, upload_id, "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format(xml))
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def abort_multipart(self, name, upload_id):
+        from boto.exception import S3ResponseError
+        try:
+            self.bucket.cancel_multipart_upload(name, upload_id)
+        except S3ResponseError as e:
+            raise self._error(e)
+
+    def list(self, prefix=''):
+        for key in self.bucket.list(prefix=prefix):
+            yield self._info(key)
+
+    def list_versions(self, prefix=''):
+        from boto.s3.deletemarker import DeleteMarker
+        for o in self.bucket.list_versions(prefix=prefix):
+            if isinstance(o, DeleteMarker):
+                yield ObjectInfo(o.name, version_id=o.version_id, is_delete_marker=True)
+            else:
+                yield self._info(o, version_id=o.version_id)
+
+    def delete(self, keys):
+        from boto.exception import S3ResponseError
+        try:
+            result = self.bucket.delete_keys(keys)
+        except S3ResponseError as e:
+            raise self._error(e)
+        retval = DeleteResult()
+        retval.deleted = [(d.key, d.version_id) for d in result.deleted]
+        retval.errors = [(e.key, e.version_id, e.code, e.message) for e in result.errors]
+        return retval
+
+
+def parse_size(s):
+    """
+    Parses a size like "100", "10K", "10M" or "1G" into a number of bytes
+    """
+    s = s.strip().upper()
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if s and s[-1] in multipliers:
+        return float(s[:-1]) * multipliers[s[-1]]
+    return float(s)
+
+
+class SimulatedBackend(StorageBackend):
+    """
+    Base class for backends that simulate a network connection to the store.
+    Every request waits for latency seconds, plus the time it would take to
+    send its data at bandwidth bytes per second.
+
+    Arguments:
+        latency (float): seconds each request takes
+        bandwidth (float): bytes per second per request; 0 means unlimited
+    """
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def _delay(self, nbytes=0):
+        delay = self.latency
+        if self.bandwidth and nbytes:
+            delay += nbytes / float(self.bandwidth)
+        if delay:
+            time.sleep(delay)
+
+    def _read_data(self, data):
+        if isinstance(data, bytes):
+            return data
+        return b''.join(iterfile(data))
+
+
+class LocalBackend(SimulatedBackend):
+    """
+    Storage backend that keeps objects as files under a local directory.
+
+    Object contents are stored under <root>/data/<name>, and metadata in
+    <root>/meta/<name>. The last-modified time is the mtime of the data
+    file. Parts of multipart uploads are kept under <root>/uploads/<id>/
+    until the upload is completed. Objects aren't versioned. Since names map onto paths, an object
+    can't have the same name as a prefix of other objects plus a trailing
+    "/".
+
+    Arguments:
+        root (str): directory to store objects in
+        latency, bandwidth: see SimulatedBackend
+    """
+    def __init__(self, root, latency=0, bandwidth=0):
+        SimulatedBackend.__init__(self, latency, bandwidth)
+        self.root = os.path.abspath(root)
+        self.name = self.root
+
+    def _path(self, kind, name):
+        return os.path.join(self.root, kind, name)
+
+    def _meta(self, name):
+        try:
+            with open(self._path('meta', name), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _info(self, name):
+        path = self._path('data', name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            # A "directory" of other objects
+            return None
+        meta = self._meta(name)
+        return ObjectInfo(name, size=st.st_size, etag=meta.get('etag'), last_modified=st.st_mtime,
+                          content_encoding=meta.get('content_encoding'))
+
+    def _upload_path(self, upload_id, *bits):
+        return os.path.join(self.root, 'uploads', upload_id, *bits)
+
+    def _upload_meta(self, name, upload_id):
+        try:
+            with open(self._upload_path(upload_id, 'meta'), 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            raise NotFound(name)
+        if meta.get('name') != name:
+            raise NotFound(name)
+        return meta
+
+    def _write(self, path, data):
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # Somebody else created it
+                pass
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def head(self, name):
+        self._delay()
+        return self._info(name)
+
+    def get_to_file(self, name, fobj):
+        info = self._info(name)
+        if not info:
+            self._delay()
+            raise NotFound(name)
+        self._delay(info.size)
+        with open(self._path('data', name), 'rb') as f:
+            copy_stream(f, fobj)
+
+    def get_range(self, name, start, end):
+        try:
+            with open(self._path('data', name), 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+        except IOError:
+            self._delay()
+            raise NotFound(name)
+        self._delay(len(data))
+        return data
+
+    def put(self, name, data, content_encoding=None, reduced_redundancy=False, public=False):
+        data = self._read_data(data)
+        self._delay(len(data))
+        meta = {'etag': hashlib.md5(data).hexdigest(), 'content_encoding': content_encoding}
+        self._write(self._path('meta', name), json.dumps(meta).encode('utf8'))
+        self._write(self._path('data', name), data)
+
+    def copy(self, name, reduced_redundancy=False):
+        self._delay()
+        try:
+            os.utime(self._path('data', name), None)
+        except OSError:
+            raise NotFound(name)
+
+    def start_multipart(self, name, content_encoding=None, reduced_redundancy=False, public=False):
+        self._delay()
+        upload_id = uuid.uuid4().hex
+        meta = {'name': name, 'content_encoding': content_encoding}
+        self._write(self._upload_path(upload_id, 'meta'), json.dumps(meta).encode('utf8'))
+        return upload_id
+
+    def put_part(self, name, upload_id, part_number, data):
+        data = self._read_data(data)
+        self._delay(len(data))
+        self._upload_meta(name, upload_id)
+        self._write(self._upload_path(upload_id, str(part_number)), data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, name, upload_id, parts):
+        self._delay()
+        meta = self._upload_meta(name, upload_id)
+        data = []
+        for part_number, etag in parts:
+            try:
+                with open(self._upload_path(upload_id, str(part_number)), 'rb') as f:
+                    data.append(f.read())
+            except IOError:
+                raise _invalid_part(name, part_number)
+            if hashlib.md5(data[-1]).hexdigest() != etag:
+                raise _invalid_part(name, part_number)
+        meta = {'etag': _multipart_etag(parts), 'content_encoding': meta['content_encoding']}
+        self._write(self._path('meta', name), json.dumps(meta).encode('utf8'))
+        self._write(self._path('data', name), b''.join(data))
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def abort_multipart(self, name, upload_id):
+        self._delay()
+        self._upload_meta(name, upload_id)
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def list(self, prefix=''):
+        datadir = os.path.join(self.root, 'data')
+        names = []
+        for root, dirs, files in os.walk(datadir):
+            for f in files:
+                if f.startswith('.tmp'):
+                    continue
+                name = os.path.relpath(os.path.join(root, f), datadir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        # One request per page of 1000 results
+        for i, name in enumerate(sorted(names)):
+            if i % 1000 == 0:
+                self._delay()
+            info = self._info(name)
+            if info:
+                yield info
+
+    def delete(self, keys):
+        self._delay()
+        result = DeleteResult()
+        for key in keys:
+            name, version_id = _split_key(key)
+            for kind in ('data', 'meta'):
+                try:
+                    os.unlink(self._path(kind, name))
+                except OSError:
+                    pass
+            result.deleted.append((name, version_id))
+        return result
+
+    def clear(self):
+        "Removes all objects"
+        for kind in ('data', 'meta', 'uploads'):
+            shutil.rmtree(os.path.join(self.root, kind), ignore_errors=True)
+
+
+class MemoryBackend(SimulatedBackend):
+    """
+    Storage backend that keeps objects in memory. Objects aren't versioned.
+
+    Objects are only visible within the process that stored them; with
+    multiprocessing, objects stored by worker processes are lost.
+
+    Arguments:
+        name (str): name of the store
+        latency, bandwidth: see SimulatedBackend
+    """
+    def __init__(self, name='memory', latency=0, bandwidth=0):
+        SimulatedBackend.__init__(self, latency, bandwidth)
+        self.name = name
+        # Maps names to (data, ObjectInfo)
+        self.objects = {}
+        # Maps upload ids to (name, content_encoding, {part_number: data})
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name):
+        with self.lock:
+            if name not in self.objects:
+                raise NotFound(name)
+            return self.objects[name]
+
+    def head(self, name):
+        self._delay()
+        with self.lock:
+            if name not in self.objects:
+                return None
+            info = self.objects[name][1]
+            return ObjectInfo(name, info.size, info.etag, info.last_modified, info.content_encoding)
+
+    def get_to_file(self, name, fobj):
+        try:
+            data, info = self._get(name)
+        except NotFound:
+            self._delay()
+            raise
+        self._delay(len(data))
+        fobj.write(data)
+
+    def get_range(self, name, start, end):
+        try:
+            data, info = self._get(name)
+        except NotFound:
+            self._delay()
+            raise
+        data = data[start:end + 1]
+        self._delay(len(data))
+        return data
+
+    def put(self, name, data, content_encoding=None, reduced_redundancy=False, public=False):
+        data = self._read_data(data)
+        self._delay(len(data))
+        info = ObjectInfo(name, size=len(data), etag=hashlib.md5(data).hexdigest(), last_modified=time.time(),
+                          content_encoding=content_encoding)
+        with self.lock:
+            self.objects[name] = (data, info)
+
+    def copy(self, name, reduced_redundancy=False):
+        self._delay()
+        with self.lock:
+            if name not in self.objects:
+                raise NotFound(name)
+            self.objects[name][1].last_modified = time.time()
+
+    def _get_upload(self, name, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload[0] != name:
+            raise NotFound(name)
+        return upload
+
+    def start_multipart(self, name, content_encoding=None, reduced_redundancy=False, public=False):
+        self._delay()
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = (name, content_encoding, {})
+        return upload_id
+
+    def put_part(self, name, upload_id, part_number, data):
+        data = self._read_data(data)
+        self._delay(len(data))
+        with self.lock:
+            self._get_upload(name, upload_id)[2][part_number] = data
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, name, upload_id, parts):
+        self._delay()
+        with self.lock:
+            _, content_encoding, uploaded = self._get_upload(name, upload_id)
+            for part_number, etag in parts:
+                if part_number not in uploaded or hashlib.md5(uploaded[part_number]).hexdigest() != etag:
+                    raise _invalid_part(name, part_number)
+            data = b''.join(uploaded[n] for n, _ in parts)
+            info = ObjectInfo(name, size=len(data), etag=_multipart_etag(parts), last_modified=time.time(),
+                              content_encoding=content_encoding)
+            self.objects[name] = (data, info)
+            del self.uploads[upload_id]
+
+    def abort_multipart(self, name, upload_id):
+        self._delay()
+        with self.lock:
+            self._get_upload(name, upload_id)
+            del self.uploads[upload_id]
+
+    def list(self, prefix=''):
+        with self.lock:
+            items = sorted((n, o[1]) for n, o in self.objects.items() if n.startswith(prefix))
+        for i, (name, info) in enumerate(items):
+            if i % 1000 == 0:
+                self._delay()
+            yield ObjectInfo(name, info.size, info.etag, info.last_modified, info.content_encoding)
+
+    def delete(self, keys):
+        self._delay()
+        result = DeleteResult()
+        with self.lock:
+            for key in keys:
+                name, version_id = _split_key(key)
+                self.objects.pop(name, None)
+                result.deleted.append((name, version_id))
+        return result
+
+
+# MemoryBackends opened by URL, so that opening the same URL twice in a
+# process gives the same objects. Other processes, including pool workers,
+# have their own
+_memory_backends = {}
+
+
+def open_backend(url):
+    """
+    Creates a storage backend from a URL.
+
+    Supported URLs are:
+        s3://<bucket>?region=<region>
+        file://<path>
+        memory://<name>
+
+    file:// and memory:// URLs accept latency (seconds per request) and
+    bandwidth (bytes per second, with an optional K, M or G suffix) query
+    parameters.
+
+    Returns:
+        a StorageBackend
+    """
+    parsed = urlparse(url)
+    params = dict((k, v[-1]) for k, v in parse_qs(parsed.query).items())
+    latency = float(params.get('latency', 0))
+    bandwidth = parse_size(params.get('bandwidth', '0'))
+
+    if parsed.scheme == 's3':
+        import boto.s3
+        region = params.get('region', 'us-east-1')
+        conn = boto.s3.connect_to_region(region)
+        conn.region_name = region
+        return BotoBackend(conn.get_bucket(parsed.netloc))
+    elif parsed.scheme == 'file':
+        return LocalBackend(parsed.netloc + parsed.path, latency, bandwidth)
+    elif parsed.scheme == 'memory':
+        name = parsed.netloc + parsed.path
+        if name not in _memory_backends:
+            _memory_backends[name] = MemoryBackend(name or 'memory', latency, bandwidth)
+        return _memory_backends[name]
+    raise ValueError("unsupported storage URL: {}".format(url))
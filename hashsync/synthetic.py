@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates reproducible synthetic directory trees for benchmarking
+"""
+import hashlib
+import math
+import os
+import random
+import struct
+
+import logging
+log = logging.getLogger(__name__)
+
+# Text used to fill the compressible part of files
+FILLER = b"hashsync synthetic benchmark data; this part of the file compresses well. "
+
+
+def random_bytes(rng, n):
+    """
+    Returns n pseudo-random bytes determined by the state of rng. These are
+    effectively incompressible.
+    """
+    seed = struct.pack("<Q", rng.getrandbits(64))
+    blocks = []
+    size = 0
+    counter = 0
+    while size < n:
+        block = hashlib.sha512(seed + struct.pack("<Q", counter)).digest()
+        blocks.append(block)
+        size += len(block)
+        counter += 1
+    return b"".join(blocks)[:n]
+
+
+def file_size(rng, distribution, mean):
+    """
+    Picks a file size
+
+    Arguments:
+        rng (random.Random): random number generator
+        distribution (str): "fixed", "uniform" (0 to 2*mean) or "lognormal"
+                            (heavy tailed, like real trees)
+        mean (int): mean file size in bytes
+
+    Returns:
+        size in bytes
+    """
+    if distribution == "fixed":
+        return mean
+    elif distribution == "uniform":
+        return rng.randint(0, 2 * mean)
+    elif distribution == "lognormal":
+        sigma = 1.5
+        # Pick mu so that the distribution has the requested mean
+        mu = math.log(max(mean, 1)) - sigma ** 2 / 2
+        return int(rng.lognormvariate(mu, sigma))
+    raise ValueError("unknown size distribution: {}".format(distribution))
+
+
+def file_contents(rng, size, compressibility):
+    """
+    Returns size bytes of data, of which about compressibility (0 to 1) is
+    easily compressible text and the rest random bytes
+    """
+    n_text = int(size * compressibility)
+    text = (FILLER * (n_text // len(FILLER) + 1))[:n_text]
+    return random_bytes(rng, size - n_text) + text
+
+
+def generate_tree(dirname, files=1000, mean_size=65536, distribution="lognormal",
+                  duplication=0.1, compressibility=0.5, files_per_dir=100, seed=0):
+    """
+    Generates a directory tree of synthetic files. The same arguments always
+    produce the same tree.
+
+    Arguments:
+        dirname (str): directory to create the tree in
+        files (int): number of files to create
+        mean_size (int): mean file size in bytes
+        distribution (str): file size distribution; see file_size()
+        duplication (float): fraction of files that are copies of an earlier
+                             file
+        compressibility (float): fraction of each file that is compressible
+        files_per_dir (int): how many files to put in each directory
+        seed (int): random seed
+
+    Returns:
+        (files, bytes): number of files and total bytes written
+    """
+    rng = random.Random(seed)
+    # Contents of the files written so far that can be duplicated; keep a
+    # bounded sample so huge trees don't use huge amounts of memory
+    originals = []
+    total = 0
+    for i in range(files):
+        if originals and rng.random() < duplication:
+            data = rng.choice(originals)
+        else:
+            size = file_size(rng, distribution, mean_size)
+            data = file_contents(rng, size, compressibility)
+            if len(originals) < 1000:
+                originals.append(data)
+            else:
+                originals[rng.randrange(len(originals))] = data
+
+        d = os.path.join(dirname, "d{:04d}".format(i // files_per_dir))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(os.path.join(d, "f{:06d}".format(i)), 'wb') as f:
+            f.write(data)
+        total += len(data)
+
+    log.info("generated %i files, %i bytes in %s", files, total, dirname)
+    return files, total
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Controllers for limiting how hard we hit the storage backend
+"""
+import threading
+import time
+
+from hashsync.metrics import METRICS
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket rate limiter whose rate is adjusted AIMD style: every
+    successful request raises the rate additively, and every throttled
+    request cuts it multiplicatively.
+
+    Arguments:
+        rate (float): initial number of requests per second
+        min_rate (float): the rate is never cut below this
+        max_rate (float): the rate is never raised above this
+        increase (float): requests per second to add after each success
+        decrease (float): factor to multiply the rate by after each throttle
+        burst (float): maximum number of tokens that can be saved up
+    """
+    def __init__(self, rate, min_rate, max_rate, increase=0.1, decrease=0.5, burst=1):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """
+        Blocks until a request can be made
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        "Records a successful request"
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        "Records a request that was throttled or failed due to load"
+        with self.lock:
+            self._refill(time.time())
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Don't let a burst through right after being throttled
+            self.tokens = min(self.tokens, 0)
+            log.debug("throttled; rate is now %.2f/s", self.rate)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits how many requests are in flight at once, adjusting the limit AIMD
+    style from what we observe.
+
+    Requests are judged a window at a time, a window being about as many
+    requests as the limit. After each window, if throughput didn't drop and
+    latency stayed within latency_tolerance times the best we've seen, the
+    limit is raised: doubled while in slow start, and by one after that. If
+    requests are throttled, or latency balloons, the limit is cut
+    multiplicatively.
+
+    Arguments:
+        limit (int): initial number of requests in flight
+        min_limit (int): the limit is never cut below this
+        max_limit (int): the limit is never raised above this
+        decrease (float): factor to multiply the limit by on congestion
+        latency_tolerance (float): how many times the best mean latency a
+                                   window's mean latency can be before
+                                   counting as congestion
+    """
+    def __init__(self, limit, min_limit, max_limit, decrease=0.5, latency_tolerance=2.0):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.slow_start = True
+        self.best_latency = None
+        self.last_throughput = None
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.window_count = 0
+        self.window_bytes = 0
+        self.window_latency = 0
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(limit) != int(self.limit):
+            log.debug("%s; concurrency limit is now %i", reason, limit)
+        self.limit = limit
+        METRICS.set_gauge("hashsync_concurrency_limit", int(limit))
+
+    def _congested(self, now, reason):
+        # Requests that were already in flight when we cut the limit will
+        # report the same congestion; only react to it once
+        if now - self.last_decrease < (self.best_latency or 0):
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self._set_limit(self.limit * self.decrease, reason)
+        self.last_throughput = None
+        self._reset_window(now)
+
+    def _evaluate(self, now):
+        latency = self.window_latency / self.window_count
+        # A window can't really be shorter than one request
+        elapsed = max(now - self.window_start, latency, 1e-6)
+        throughput = (self.window_count / elapsed, self.window_bytes / elapsed)
+        self._reset_window(now)
+
+        if self.best_latency is None:
+            self.best_latency = latency
+        elif latency > self.latency_tolerance * self.best_latency:
+            # Let the baseline creep up, in case the store has just got slower
+            self.best_latency *= 1.1
+            self._congested(now, "latency is up to %.3fs" % latency)
+            return
+        self.best_latency = min(self.best_latency, latency)
+
+        last = self.last_throughput
+        self.last_throughput = throughput
+        if last and throughput[0] < last[0] * 0.9 and throughput[1] < last[1] * 0.9:
+            # More requests in flight didn't help; stay here
+            self.slow_start = False
+            return
+
+        if self.slow_start:
+            self._set_limit(self.limit * 2, "slow start")
+        else:
+            self._set_limit(self.limit + 1, "throughput is %.1f requests/s" % throughput[0])
+
+    def acquire(self):
+        """
+        Blocks until another request can be made
+        """
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, nbytes=0, throttled=False):
+        """
+        Records that a request has finished
+
+        Arguments:
+            latency (float): how long the request took, if it succeeded
+            nbytes (int): how many bytes it transferred
+            throttled (bool): whether it was throttled, timed out or failed
+                              due to load
+        """
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if throttled:
+                self._congested(now, "throttled")
+            elif latency is not None:
+                self.window_count += 1
+                self.window_bytes += nbytes
+                self.window_latency += latency
+                if self.window_count >= int(self.limit):
+                    self._evaluate(now)
+            self.cond.notify_all()
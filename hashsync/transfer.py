@@ -2,22 +2,88 @@
 # -*- coding: utf-8 -*-
 import time
 import os
-import random
 import multiprocessing
 from collections import defaultdict
 
 from hashsync.connection import get_bucket
-from hashsync.utils import parse_date, traverse_directory, sha1sum, strip_leading
-from hashsync.compression import maybe_compress
-from hashsync.objectlist import ObjectList
+from hashsync.storage import NotFound, StorageError
+from hashsync.utils import traverse_directory, strip_leading
+from hashsync.hashing import get_algorithm, repository_algorithm
+from hashsync.compression import maybe_compress, gzip_compress
+from hashsync.chunking import chunk_file, chunk_offsets, chunklist_name, encode_chunklist, decode_chunklist
+from hashsync.objectlist import ShardedObjectList
+from hashsync.refresh import RefreshScheduler
+from hashsync.schedule import schedule
+from hashsync.journal import UploadJournal, abort_upload
 from hashsync.manifest import Manifest
-from hashsync import config
+from hashsync.metrics import METRICS, QueueDepth, collect, result, timed, total
+from hashsync.retry import is_retryable, is_throttled
+from hashsync.throttle import AdaptiveConcurrency
+from hashsync import config, profiling
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def upload_file(filename, keyname, reduced_redundancy=True):
+def _read_chunk(filename, chunk):
+    offset, size = chunk
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _put_multipart(bucket, keyname, fobj, content_encoding, reduced_redundancy, journal, resume=None):
+    """
+    Uploads the contents of fobj to keyname in parts, recording each
+    finished part in journal. If it fails in a way that trying again won't
+    fix, the upload is aborted rather than left to be resumed.
+
+    Arguments:
+        journal (hashsync.journal.UploadJournal): where to record progress
+        resume (dict): journaled progress of an earlier attempt to carry on
+                       from. If that upload has gone away, e.g. because it
+                       was aborted, the upload starts again.
+    """
+    fobj.seek(0, 2)
+    size = fobj.tell()
+    if resume:
+        upload_id, part_size = resume['upload_id'], resume['part_size']
+        parts = dict(resume['parts'])
+        log.info("resuming upload of %s with %i parts done", keyname, len(parts))
+    else:
+        part_size = max(config.MULTIPART_PART_SIZE, -(-size // config.MULTIPART_MAX_PARTS))
+        upload_id = bucket.start_multipart(keyname, content_encoding=content_encoding,
+                                           reduced_redundancy=reduced_redundancy, public=True)
+        journal.start_multipart(keyname, upload_id, part_size)
+        parts = {}
+
+    nparts = max(-(-size // part_size), 1)
+    try:
+        for n in range(1, nparts + 1):
+            if n in parts:
+                METRICS.incr("hashsync_parts_total", state="resumed")
+                continue
+            fobj.seek((n - 1) * part_size)
+            parts[n] = bucket.put_part(keyname, upload_id, n, fobj.read(part_size))
+            journal.record_part(keyname, upload_id, n, parts[n])
+            METRICS.incr("hashsync_parts_total", state="uploaded")
+        bucket.complete_multipart(keyname, upload_id, [(n, parts[n]) for n in range(1, nparts + 1)])
+    except StorageError as e:
+        if resume and (isinstance(e, NotFound) or e.code == 'InvalidPart'):
+            log.warning("couldn't resume upload of %s (%s); starting again", keyname, e.code)
+            if not isinstance(e, NotFound):
+                abort_upload(bucket, keyname, upload_id)
+            return _put_multipart(bucket, keyname, fobj, content_encoding, reduced_redundancy, journal)
+        if not is_retryable(e):
+            # Trying again won't help, so don't leave the parts behind
+            abort_upload(bucket, keyname, upload_id)
+            journal.finish_multipart(keyname)
+        raise
+    journal.finish_multipart(keyname)
+
+
+def upload_file(filename, keyname, reduced_redundancy=True, refresh=True, chunk=None, journal=None,
+                multipart=None):
     """
     Uploads the specified file to the bucket returned by hashsync.connection.get_bucket().
 
@@ -25,69 +91,319 @@ def upload_file(filename, keyname, reduced_redundancy=True):
         filename (str):    path to local file
         keyname  (str):    key name to store object
         reduced_redundancy (bool): whether to use reduced redundancy storage; defaults to True
+        refresh (bool):    whether to refresh the last-modified time of old
+                           objects that already exist; defaults to True
+        chunk (tuple):     (offset, size) of the part of the file to upload,
+                           for chunked files; defaults to the whole file
+        journal (str):     path to the hashsync.journal.UploadJournal of this
+                           upload; if given, files of config.MULTIPART_MINSIZE
+                           or more are uploaded in parts, and each finished
+                           part is recorded there
+        multipart (dict):  journaled progress of an earlier multipart upload
+                           of this object to carry on from
 
     Returns:
         state (str):       one of "skipped", "refreshed", "uploaded"
     """
-    filesize = os.path.getsize(filename)
+    filesize = chunk[1] if chunk else os.path.getsize(filename)
     # TODO: inline small files
     if filesize == 0:
         log.debug("skipping 0 byte file; no need to upload it")
         return "inlined"
 
     bucket = get_bucket()
-    key = bucket.get_key(keyname)
-    if key:
-        log.debug("we already have %s last-modified: %s", keyname, key.last_modified)
+    # An unfinished upload means the object wasn't there last time we looked
+    info = None if multipart else bucket.head(keyname)
+    if info:
+        log.debug("we already have %s last-modified: %s", keyname, info.last_modified)
         # If this was uploaded recently, we can skip uploading it again
         # If the last-modified is old enough, we copy the key on top of itself
         # to refresh the last-modified time.
-        if parse_date(key.last_modified) > time.time() - config.REFRESH_MINTIME:
+        if not refresh or info.last_modified > time.time() - config.REFRESH_MINTIME:
             log.debug("skipping %s since it was uploaded recently, but not in manifest", filename)
             return "checked"
         else:
             log.info("refreshing %s at %s", filename, keyname)
-            # TODO: This can fail if we've just deleted this key
-            key.copy(bucket.name, key.name, reduced_redundancy=reduced_redundancy)
-            return "refreshed"
-    else:
-        key = bucket.new_key(keyname)
+            try:
+                bucket.copy(keyname, reduced_redundancy=reduced_redundancy)
+                return "refreshed"
+            except NotFound:
+                # It was deleted since we checked
+                log.info("%s was deleted; uploading it again", keyname)
+
+    if chunk:
+        # Chunks are small enough to handle in memory
+        data = _read_chunk(filename, chunk)
+        content_encoding = None
+        if len(data) >= config.COMPRESS_MINSIZE:
+            with METRICS.stage("compress"):
+                compressed = gzip_compress(data, mtime=0)
+            if len(compressed) < len(data):
+                data = compressed
+                content_encoding = 'gzip'
+        log.info("uploading %i bytes of %s at %i to %s", chunk[1], filename, chunk[0], keyname)
+        bucket.put(keyname, data, content_encoding=content_encoding, reduced_redundancy=reduced_redundancy,
+                   public=True)
+        return "uploaded"
 
     log.debug("compressing %s", filename)
 
-    fobj, was_compressed = maybe_compress(filename)
-    if was_compressed:
-        key.set_metadata('Content-Encoding', 'gzip')
+    with METRICS.stage("compress"):
+        fobj, was_compressed = maybe_compress(filename)
+    content_encoding = 'gzip' if was_compressed else None
 
     log.info("uploading %s to %s", filename, keyname)
-    key.set_contents_from_file(fobj, policy='public-read', reduced_redundancy=reduced_redundancy)
+    with fobj:
+        if journal and filesize >= config.MULTIPART_MINSIZE:
+            journal = UploadJournal(journal)
+            try:
+                _put_multipart(bucket, keyname, fobj, content_encoding, reduced_redundancy, journal, multipart)
+            finally:
+                journal.close()
+        else:
+            bucket.put(keyname, fobj, content_encoding=content_encoding, reduced_redundancy=reduced_redundancy,
+                       public=True)
+    return "uploaded"
+
+
+def refresh_file(filename, keyname, reduced_redundancy=True, chunk=None):
+    """
+    Refreshes the last-modified time of an object we believe exists by
+    copying it on top of itself, without checking for it first. If it turns
+    out not to exist, the file is uploaded instead.
+
+    Arguments:
+        filename (str):    path to local file
+        keyname  (str):    key name of the object
+        reduced_redundancy (bool): whether to use reduced redundancy storage; defaults to True
+        chunk (tuple):     (offset, size) of the part of the file the object
+                           holds, for chunked files
+
+    Returns:
+        state (str):       "refreshed", or the result of upload_file
+    """
+    bucket = get_bucket()
+    log.info("refreshing %s at %s", filename, keyname)
+    try:
+        bucket.copy(keyname, reduced_redundancy=reduced_redundancy)
+    except NotFound:
+        log.info("%s is missing; uploading it", keyname)
+        return upload_file(filename, keyname, reduced_redundancy, chunk=chunk)
+    return "refreshed"
+
+
+def load_chunks(filename, keyname, algorithm="sha1"):
+    """
+    Returns the chunks of filename from the chunk list stored at keyname, or
+    if there isn't one, by splitting the file up with chunk_file
+
+    Returns:
+        (chunks, stored): the (hash, size) of each chunk, and whether they
+                          came from the stored chunk list
+    """
+    try:
+        chunks = decode_chunklist(get_bucket().get(keyname))
+        if sum(size for _, size in chunks) == os.path.getsize(filename):
+            return chunks, True
+        log.warning("%s doesn't match %s; chunking it again", keyname, filename)
+    except NotFound:
+        log.info("%s is missing; chunking %s", keyname, filename)
+    return chunk_file(filename, algorithm), False
+
+
+def store_chunklist(keyname, chunks, refresh=False):
+    """
+    Stores the chunk list of a chunked file at keyname, or with refresh,
+    refreshes the last-modified time of the one that's already there
+
+    Returns:
+        state (str): "uploaded" or "refreshed"
+    """
+    bucket = get_bucket()
+    if refresh:
+        try:
+            bucket.copy(keyname)
+            return "refreshed"
+        except NotFound:
+            log.info("%s is missing; storing it again", keyname)
+    bucket.put(keyname, encode_chunklist(chunks), public=True)
     return "uploaded"
 
 
 def _init_worker():
-    "Ignore SIGINT for process workers"
+    "Ignore SIGINT for process workers, and profile them if requested"
     import signal
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    profiling.init_worker()
 
 
-def upload_directory(dirname, jobs, dryrun=False):
+class SubmittedJob(object):
+    """
+    The AsyncResult of a job started by JobSubmitter, whose get() also raises
+    any exception from the job's callback
+    """
+    def __init__(self, job):
+        self.job = job
+        self.error = None
+
+    def get(self, timeout=None):
+        retval = self.job.get(timeout)
+        # The pool sets the result ready only once the callback has run
+        if self.error is not None:
+            raise self.error
+        return retval
+
+    def __getattr__(self, name):
+        return getattr(self.job, name)
+
+
+class JobSubmitter(object):
+    """
+    Starts jobs in a process pool via hashsync.metrics.collect, keeping track
+    of the queue depth. With a concurrency controller, submit() blocks until
+    the controller allows another job in flight, and the controller is told
+    how long each job took and whether it was throttled.
+
+    Arguments:
+        pool (multiprocessing.Pool): pool to run jobs in
+        concurrency (hashsync.throttle.AdaptiveConcurrency): optional
+                    controller for how many jobs are in flight
+    """
+    def __init__(self, pool, concurrency=None):
+        self.pool = pool
+        self.concurrency = concurrency
+        self.queue = QueueDepth()
+
+    def submit(self, func, args, kwargs=None, nbytes=0, callback=None):
+        """
+        Starts func(*args, **kwargs)
+
+        Arguments:
+            nbytes (int): roughly how many bytes the job will transfer
+            callback (callable): called with func's return value once it
+                                 finishes, from one of the pool's threads.
+                                 If it raises, getting the job's result
+                                 raises the same exception
+
+        Returns:
+            the SubmittedJob; use hashsync.metrics.result() to get the result
+        """
+        concurrency = self.concurrency
+        if concurrency:
+            concurrency.acquire()
+        self.queue.submitted()
+        start = time.time()
+        job = SubmittedJob(None)
+
+        def done(r):
+            # Exceptions escaping this kill the pool's result handler thread,
+            # so the bookkeeping has to happen whatever the callback does
+            try:
+                if callback:
+                    callback(r[0])
+            except Exception as e:
+                log.exception("callback for %s failed", func.__name__)
+                job.error = e
+            finally:
+                self.queue.done()
+                if concurrency:
+                    snapshot = r[1]
+                    throttled = total(snapshot, "hashsync_throttled_total") + total(snapshot, "hashsync_timeouts_total")
+                    concurrency.release(time.time() - start, nbytes, throttled > 0)
+
+        def failed(e):
+            self.queue.done()
+            if concurrency:
+                concurrency.release(throttled=is_throttled(e))
+
+        job.job = self.pool.apply_async(collect, (func,) + tuple(args), kwargs or {}, callback=done,
+                                        error_callback=failed)
+        return job
+
+
+def make_concurrency(jobs, adaptive=False, min_jobs=1):
+    """
+    Returns an AdaptiveConcurrency that keeps between min_jobs and jobs
+    transfers in flight if adaptive is True, otherwise None
+    """
+    if not adaptive:
+        return None
+    return AdaptiveConcurrency(min_jobs, min_jobs, jobs)
+
+
+def upload_directory(dirname, jobs, dryrun=False, publish=True, refresh=True, adaptive=False, min_jobs=1,
+                     largest_first=True, chunked=False, algorithm=None, journal=None, filenames=None, pool=None,
+                     object_list=None, hasher=None):
     """
     Uploads the specified directory to the bucket returned by hashsync.connection.get_bucket()
 
     Arguments:
         dirname (str): local directory name to upload
-        jobs (int): how many uploads to do in parallel
+        jobs (int): how many uploads to do in parallel; with adaptive, the
+                    most uploads to do in parallel
         dryrun (bool): if True, don't actually upload anything (default: False)
+        publish (bool): if True, publish the objects we've uploaded or found
+                        in the bucket to the object list so other uploaders
+                        can skip them (default: True)
+        refresh (bool): if True, refresh the last-modified time of objects
+                        so they aren't deleted for being old. Not needed if
+                        old objects are deleted based on which manifests
+                        reference them (default: True)
+        adaptive (bool): if True, adjust how many uploads are in flight
+                         between min_jobs and jobs depending on throughput,
+                         latency and throttling (default: False)
+        min_jobs (int): fewest uploads to have in flight with adaptive
+        largest_first (bool): if True, start the biggest uploads first
+                              rather than in directory order (default: True)
+        chunked (bool): if True, store files of config.CHUNKED_MINSIZE or
+                        more as content-defined chunks, so only the parts
+                        of large files that change are uploaded
+                        (default: False)
+        algorithm (str): name of the hashsync.hashing algorithm to identify
+                         objects with; defaults to the one recorded for the
+                         bucket, or config.HASH_ALGORITHM
+        journal (hashsync.journal.UploadJournal): where to record progress,
+                 so that if the upload is interrupted, running it again with
+                 the same journal carries on where it left off; ignored with
+                 dryrun (default: None)
+        filenames (list): upload just these files under dirname rather than
+                          everything in it; the manifest only lists these
+                          (default: None)
+        pool (multiprocessing.Pool): workers to hash and upload with, e.g.
+                                     to keep using the same ones between
+                                     uploads; it's left running. By default
+                                     a pool of jobs workers is started
+        object_list (hashsync.objectlist.ShardedObjectList): the already
+                    loaded object list of algorithm's objects, to use rather
+                    than loading it (default: None)
+        hasher (callable): takes the function to hash files with and
+                           returns a wrapper around it, e.g. one that
+                           caches hashes (default: None)
 
     Returns:
         A hashsync.manifest.Manifest object
     """
     if not dryrun:
         bucket = get_bucket()
-        object_list = ObjectList(bucket)
-        object_list.load()
+        algorithm = get_algorithm(algorithm or repository_algorithm(bucket))
+        if object_list is None:
+            object_list = ShardedObjectList(bucket, algorithm.objectlist_keyname)
+            object_list.load()
     else:
-        object_list = ObjectList(None)
+        algorithm = get_algorithm(algorithm or config.HASH_ALGORITHM)
+        object_list = ShardedObjectList(None, algorithm.objectlist_keyname)
+        journal = None
+
+    hash_file = timed("hash", algorithm.hash_file)
+    if hasher:
+        hash_file = hasher(hash_file)
+    # Objects an earlier run with this journal uploaded, checked or refreshed
+    done = {}
+    if journal:
+        journal.begin(bucket, dirname=os.path.abspath(dirname), bucket=bucket.name, algorithm=algorithm.name,
+                      chunked=chunked)
+        hash_file = journal.hasher(hash_file)
+        done = journal.recent_states(config.JOURNAL_STATE_MAX_AGE)
 
     # On my system generating the hashes serially over 86MB of data with a
     # cold disk cache finishes in 1.9s. With a warm cache it
@@ -100,39 +416,164 @@ def upload_directory(dirname, jobs, dryrun=False):
     #   4   0.66s   0.82
     # The only time parallelization wins is on a cold disk cache;
     # no need to try and parallize this part.
-    pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+    submitter = JobSubmitter(pool, make_concurrency(jobs, adaptive, min_jobs))
+    njobs = jobs
     jobs = []
-    for filename, h in traverse_directory(dirname, sha1sum):
-        # re-process some objects here to ensure that objects get their last
-        # modified date refreshed. this avoids all objects expiring out of the
-        # manifest at the same time
-        r = random.randint(0, config.REFRESH_EVERY_NTH_OBJECTS)
-        if h in object_list and r != 0:
-            log.debug("skipping %s - already in manifest", filename)
+    # Transfers to start once we've hashed everything, as (size, (index into
+    # jobs, func, args, kwargs)). Chunk uploads have the chunk's hash instead
+    # of an index, and chunk lists their name
+    tasks = []
+    # Jobs splitting large files into chunks, or loading their stored chunk
+    # lists, by hash
+    chunk_jobs = {}
+    # Objects in the object list are refreshed on a schedule based on their
+    # last modified time, so they don't all expire out of the object list at
+    # the same time
+    scheduler = RefreshScheduler(object_list.last_modified)
+    if filenames is None:
+        found = traverse_directory(dirname, hash_file)
+    else:
+        found = ((f, hash_file(f)) for f in filenames)
+    for filename, h in found:
+        if h in done:
+            log.debug("skipping %s - %s by an earlier run", filename, done[h])
+            jobs.append((None, filename, h))
+            continue
+
+        if h in object_list:
+            if refresh and not dryrun and scheduler.should_refresh(h):
+                keyname = algorithm.key(h)
+                tasks.append((0, (len(jobs), refresh_file, (filename, keyname), None)))
+                jobs.append((None, filename, h))
+            else:
+                log.debug("skipping %s - already in manifest", filename)
+                jobs.append((None, filename, h))
+            continue
+
+        if chunked and not dryrun and os.path.getsize(filename) >= config.CHUNKED_MINSIZE:
+            if h in chunk_jobs:
+                pass
+            elif journal and h in journal.chunks:
+                chunk_jobs[h] = (None, filename)
+            elif chunklist_name(h) in object_list:
+                # Chunked by an earlier upload
+                chunk_jobs[h] = (pool.apply_async(collect, (load_chunks, filename,
+                                                            algorithm.key(chunklist_name(h)), algorithm.name)),
+                                 filename)
+            else:
+                chunk_jobs[h] = (pool.apply_async(collect, (chunk_file, filename, algorithm.name)), filename)
             jobs.append((None, filename, h))
             continue
 
         # TODO: Handle packing together smaller files
         if not dryrun:
-            keyname = "objects/{}".format(h)
-            job = pool.apply_async(upload_file, (filename, keyname))
-            jobs.append((job, filename, h))
-        else:
-            jobs.append((None, filename, h))
+            keyname = algorithm.key(h)
+            kwargs = {'refresh': refresh}
+            if journal:
+                kwargs.update(journal=journal.filename, multipart=journal.multipart.get(keyname))
+            tasks.append((os.path.getsize(filename), (len(jobs), upload_file, (filename, keyname), kwargs)))
+        jobs.append((None, filename, h))
 
         # Add the object to the local manifest so we don't try and
         # upload it again
         object_list.add(h)
 
+    # Only upload the chunks we don't have already
+    chunks_by_hash = {}
+    chunklists = set(chunklist_name(h) for h in chunk_jobs)
+    chunk_states = {}
+    for h, (job, filename) in chunk_jobs.items():
+        name = chunklist_name(h)
+        stored = name in object_list or name in done
+        if job:
+            chunks_by_hash[h] = result(job, config.MAX_UPLOAD_TIME)
+            if isinstance(chunks_by_hash[h], tuple):
+                # From load_chunks, which also says if the list was stored
+                chunks_by_hash[h], stored = chunks_by_hash[h]
+            if journal:
+                journal.record_chunks(h, chunks_by_hash[h])
+        else:
+            chunks_by_hash[h] = journal.chunks[h]
+        # Store the chunk list so later uploads don't need to chunk the file
+        # again, and keep it fresh like the chunks
+        if name not in done:
+            if not stored:
+                tasks.append((0, (name, store_chunklist, (algorithm.key(name), chunks_by_hash[h]), None)))
+                object_list.add(name)
+            elif refresh and scheduler.should_refresh(name):
+                tasks.append((0, (name, store_chunklist, (algorithm.key(name), chunks_by_hash[h]),
+                                  {'refresh': True})))
+        for offset, ch, size in chunk_offsets(chunks_by_hash[h]):
+            keyname = algorithm.key(ch)
+            if ch in done:
+                chunk_states.setdefault(ch, done[ch])
+                continue
+            if ch in object_list:
+                if refresh and scheduler.should_refresh(ch):
+                    tasks.append((0, (ch, refresh_file, (filename, keyname), {'chunk': (offset, size)})))
+                chunk_states.setdefault(ch, 'skipped')
+                continue
+            tasks.append((size, (ch, upload_file, (filename, keyname), {'refresh': refresh,
+                                                                        'chunk': (offset, size)})))
+            object_list.add(ch)
+
+    # Start the biggest uploads first so the run doesn't end with one big
+    # file uploading on its own
+    start = time.time()
+    chunk_uploads = []
+
+    def recorder(h):
+        def callback(state):
+            journal.record_state(h, state)
+        return callback
+
+    for size, (i, func, args, kwargs) in schedule(tasks, njobs, largest_first):
+        callback = None
+        if journal:
+            # Record results as they come in, so an interruption doesn't lose
+            # any that finished
+            h = jobs[i][2] if isinstance(i, int) else i
+            callback = recorder(h)
+        job = submitter.submit(func, args, kwargs, nbytes=size, callback=callback)
+        if isinstance(i, int):
+            jobs[i] = (job,) + jobs[i][1:]
+        else:
+            chunk_uploads.append((job, i))
+
     retval = []
+    # Objects we know are in the bucket that weren't in the object list
+    to_publish = set()
+    # An earlier run may not have got as far as publishing what it uploaded
+    to_publish.update(h for h, state in done.items()
+                      if state in ("uploaded", "refreshed", "checked") and h not in journal.published)
     stats = defaultdict(int)
     size_by_state = defaultdict(int)
-    m = Manifest()
+    for job, ch in chunk_uploads:
+        state = result(job, config.MAX_UPLOAD_TIME)
+        if ch not in chunklists:
+            chunk_states[ch] = state
+        if state in ("uploaded", "refreshed", "checked"):
+            to_publish.add(ch)
+        if state in ("uploaded", "refreshed"):
+            object_list.last_modified[ch] = int(time.time())
+    chunk_stats = defaultdict(int)
+    for state in chunk_states.values():
+        chunk_stats[state] += 1
+        METRICS.incr("hashsync_chunks_total", state=state)
+
+    m = Manifest(algorithm.name)
     for job, filename, h in jobs:
         if job:
             # Specify a timeout for .get() to allow us to catch
             # KeyboardInterrupt.
-            state = job.get(config.MAX_UPLOAD_TIME)
+            state = result(job, config.MAX_UPLOAD_TIME)
+        elif h in done:
+            state = done[h]
+        elif h in chunks_by_hash:
+            state = 'chunked'
         else:
             state = 'skipped'
 
@@ -140,15 +581,35 @@ def upload_directory(dirname, jobs, dryrun=False):
         st = os.stat(filename)
         perms = st.st_mode & 0o777
         size = st.st_size
-        m.add(h, stripped, perms)
+        m.add(h, stripped, perms, size, chunks_by_hash.get(h))
         retval.append((state, filename, h))
+        # States from an earlier run were published with the rest of its
+        # results above, if they hadn't been already
+        if job and state in ("uploaded", "refreshed", "checked"):
+            to_publish.add(h)
+        if job and state in ("uploaded", "refreshed"):
+            object_list.last_modified[h] = int(time.time())
         stats[state] += 1
         size_by_state[state] += size
+        METRICS.incr("hashsync_files_total", state=state)
+        METRICS.incr("hashsync_file_bytes_total", size, state=state)
 
     # Shut down pool
-    pool.close()
-    pool.join()
+    if own_pool:
+        pool.close()
+        pool.join()
+    if tasks:
+        log.info("transfers took %.2fs", time.time() - start)
 
+    if refresh:
+        scheduler.report()
     log.info("stats: %s", dict(stats))
     log.info("size stats: %s", dict(size_by_state))
+    if chunk_stats:
+        log.info("chunk stats: %s", dict(chunk_stats))
+
+    if publish and not dryrun:
+        object_list.publish(to_publish)
+        if journal:
+            journal.record_published()
     return m
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checking downloaded objects against their hashes
+
+Objects are hashed as they're written rather than read back afterwards:
+HashingWriter hashes a stream on its way to disk, and OrderedHasher hashes a
+file written as ranges in whatever order they finish. An object that doesn't
+match its name is never put in the cache.
+
+KnownFiles remembers the hashes of files copied out of verified cache
+entries, so the next run over the same directory doesn't need to hash them
+again, as long as they haven't changed since.
+"""
+import json
+import os
+import threading
+
+from hashsync.metrics import METRICS
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CorruptObject(Exception):
+    "An object's contents don't match its hash"
+    def __init__(self, keyname, expected, actual):
+        # Keeping every argument in args lets this be pickled, e.g. when it's
+        # raised in a worker process
+        Exception.__init__(self, keyname, expected, actual)
+        self.keyname = keyname
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "{} is corrupt: its contents hash to {}".format(self.keyname, self.actual)
+
+
+class HashingWriter(object):
+    """
+    Wraps a file object, hashing everything written to it
+
+    Retries rewind the file to where they started and write everything again,
+    so seeking back to the start begins a new hash.
+
+    Arguments:
+        fobj (file object): file to write to
+        new_hasher (callable): returns a new hashlib style object, e.g.
+                               HashAlgorithm.hasher
+    """
+    def __init__(self, fobj, new_hasher):
+        self.fobj = fobj
+        self.new_hasher = new_hasher
+        self.hasher = new_hasher()
+        self.start = fobj.tell()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.fobj.write(data)
+
+    def tell(self):
+        return self.fobj.tell()
+
+    def seek(self, offset, whence=0):
+        if (offset, whence) != (self.start, 0):
+            raise IOError("can only seek back to {} while hashing".format(self.start))
+        self.hasher = self.new_hasher()
+        return self.fobj.seek(offset)
+
+    def truncate(self, *args):
+        return self.fobj.truncate(*args)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class OrderedHasher(object):
+    """
+    Hashes a file that's written as ranges in any order, from any thread
+
+    Ranges are hashed as soon as everything before them has been. Ones that
+    arrive early are kept in memory until then, up to max_pending bytes;
+    beyond that they're read back from filename when their turn comes.
+
+    Arguments:
+        hasher: hashlib style object to feed the data to in order
+        filename (str): the file the ranges are written to
+        max_pending (int): most bytes to hold in memory
+    """
+    def __init__(self, hasher, filename, max_pending=config.VERIFY_MAX_PENDING):
+        self.hasher = hasher
+        self.filename = filename
+        self.max_pending = max_pending
+        # How far we've hashed
+        self.offset = 0
+        # Offset to the data of each range that arrived early, or its length
+        # if it's been left on disk
+        self.pending = {}
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+    def update_at(self, offset, data):
+        "Notes that data has been written at offset"
+        with self.lock:
+            if offset != self.offset:
+                if self.pending_bytes + len(data) <= self.max_pending:
+                    self.pending[offset] = data
+                    self.pending_bytes += len(data)
+                else:
+                    self.pending[offset] = len(data)
+                return
+            self.hasher.update(data)
+            self.offset += len(data)
+            while self.offset in self.pending:
+                data = self.pending.pop(self.offset)
+                if isinstance(data, int):
+                    self._reread(data)
+                    continue
+                self.pending_bytes -= len(data)
+                self.hasher.update(data)
+                self.offset += len(data)
+
+    def _reread(self, size):
+        METRICS.incr("hashsync_verify_reread_bytes_total", size)
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            while size:
+                block = f.read(min(size, 1024 ** 2))
+                if not block:
+                    raise IOError("{} is shorter than expected".format(self.filename))
+                self.hasher.update(block)
+                self.offset += len(block)
+                size -= len(block)
+
+    def hexdigest(self):
+        if self.pending:
+            raise ValueError("ranges before {} haven't been written".format(min(self.pending)))
+        return self.hasher.hexdigest()
+
+
+def _stat(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class KnownFiles(object):
+    """
+    Hashes of files in a directory that don't need hashing again, kept in
+    filename. A file's hash is only used while its size, mtime and inode are
+    the same as when it was recorded.
+
+    Arguments:
+        filename (str): where the hashes are kept
+        algorithm (str): the hash algorithm; hashes recorded with another
+                         one are ignored
+    """
+    def __init__(self, filename, algorithm):
+        self.filename = filename
+        self.algorithm = algorithm
+        # Absolute filename to [size, mtime_ns, inode, hash]
+        self.old = {}
+        self.new = {}
+        # Filenames whose old entries are out of date
+        self.seen = set()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = json.loads(f.read().decode('utf8'))
+        except IOError:
+            return
+        except ValueError:
+            log.warning("ignoring unreadable %s", self.filename)
+            return
+        if data.get('algorithm') == self.algorithm:
+            self.old = data['files']
+
+    def hasher(self, hash_file):
+        """
+        Returns a wrapper around hash_file that reuses the recorded hashes of
+        files that haven't changed
+        """
+        def wrapper(filename):
+            path = os.path.abspath(filename)
+            self.seen.add(path)
+            entry = self.old.get(path)
+            if entry and entry[:3] == _stat(path):
+                METRICS.incr("hashsync_hash_skipped_total")
+                self.new[path] = entry
+                return entry[3]
+            self.new.pop(path, None)
+            return hash_file(filename)
+        return wrapper
+
+    def add(self, filename, h):
+        "Records that filename, as it is now, has hash h"
+        path = os.path.abspath(filename)
+        self.seen.add(path)
+        self.new[path] = _stat(path) + [h]
+
+    def discard(self, filename):
+        "Forgets filename, e.g. because it's been removed"
+        path = os.path.abspath(filename)
+        self.seen.add(path)
+        self.new.pop(path, None)
+
+    def save(self):
+        files = dict((p, e) for p, e in self.old.items() if p not in self.seen)
+        files.update(self.new)
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpname = "{}.tmp{}".format(self.filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(json.dumps({'algorithm': self.algorithm, 'files': files}).encode('utf8'))
+        os.rename(tmpname, self.filename)
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keeping a bucket in sync with a directory as it changes, using Linux inotify
+
+Every directory in the tree is watched. Each path that's created, written,
+chmodded, moved or deleted is noted, and once no more events have arrived
+for it in a while (the debounce time), the changed files are hashed and
+uploaded with upload_directory, and deleted ones dropped from the tree. An
+updated manifest of the whole tree is produced every so often while there
+are changes. Between changes we just sleep in select(), so watching costs
+next to nothing. The worker pool and the object list are kept for the whole
+session rather than set up again for every batch of changes; the object
+list is reloaded once it's WATCH_OBJECTLIST_TTL seconds old.
+
+Files that fail to upload are tried again with the next batch, up to
+WATCH_MAX_ATTEMPTS times in a row. Files we aren't allowed to read, or that
+have gone away, are given up on straight away; they're picked up again if
+they change.
+
+inotify is used through ctypes, so nothing needs installing, but it only
+works on Linux. If the kernel's event queue overflows, the whole tree is
+scanned again.
+"""
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+import select
+import struct
+import time
+
+from hashsync.connection import get_bucket
+from hashsync.hashing import get_algorithm, repository_algorithm
+from hashsync.manifest import Manifest
+from hashsync.metrics import METRICS
+from hashsync.objectlist import ShardedObjectList
+from hashsync.storage import StorageError
+from hashsync.transfer import upload_directory, _init_worker
+from hashsync.utils import strip_leading
+from hashsync import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def available():
+    "Returns True if inotify can be used here"
+    try:
+        return hasattr(_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class Inotify(object):
+    """
+    A minimal wrapper around an inotify file descriptor
+    """
+    def __init__(self):
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        "Starts watching path, returning its watch descriptor"
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                raise OSError(e, "too many watches; raise fs.inotify.max_user_watches")
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for events
+
+        Returns:
+            a list of (wd, mask, cookie, name) tuples; name is a str, empty
+            for events about the watched directory itself
+        """
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, n = struct.unpack_from(EVENT_HEADER, data, i)
+                i += EVENT_HEADER_SIZE
+                name = os.fsdecode(data[i:i + n].rstrip(b'\0'))
+                i += n
+                events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DirectoryWatcher(object):
+    """
+    Watches every directory under dirname, turning inotify events into the
+    paths that changed
+
+    Arguments:
+        dirname (str): top of the tree to watch
+        inotify (Inotify): defaults to a new one
+    """
+    def __init__(self, dirname, inotify=None):
+        self.dirname = dirname
+        self.inotify = inotify or Inotify()
+        # Watch descriptor to directory path, and back
+        self.dirs = {}
+        self.wds = {}
+        self.overflowed = False
+
+    def watch(self, top):
+        """
+        Watches top and every directory under it
+
+        Returns:
+            every file under top
+        """
+        files = []
+        for root, dirs, names in os.walk(top):
+            try:
+                wd = self.inotify.add_watch(root)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                # Gone already
+                continue
+            old = self.dirs.get(wd)
+            if old is not None and old != root:
+                self.wds.pop(old, None)
+            self.dirs[wd] = root
+            self.wds[root] = wd
+            files.extend(os.path.join(root, f) for f in names)
+        return files
+
+    def unwatch(self, top):
+        "Stops watching top and every directory under it"
+        for path, wd in list(self.wds.items()):
+            if path == top or path.startswith(top + os.sep):
+                self.inotify.rm_watch(wd)
+                del self.wds[path]
+                self.dirs.pop(wd, None)
+
+    def changes(self, timeout=None):
+        """
+        Waits up to timeout seconds for changes
+
+        Returns:
+            a list of paths that were changed, created or deleted. Paths of
+            new directories are followed by every file in them. If the event
+            queue overflowed, overflowed is set and changes may be missing.
+        """
+        paths = []
+        for wd, mask, cookie, name in self.inotify.read(timeout):
+            METRICS.incr("hashsync_watch_events_total")
+            if mask & IN_Q_OVERFLOW:
+                log.warning("inotify queue overflowed")
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                path = self.dirs.pop(wd, None)
+                if path is not None and self.wds.get(path) == wd:
+                    del self.wds[path]
+                continue
+            root = self.dirs.get(wd)
+            if root is None or not name:
+                # Events about a watched directory itself show up as events
+                # in its parent too
+                continue
+            path = os.path.join(root, name)
+            paths.append(path)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Anything written before the watch was added won't get
+                    # events of its own
+                    paths.extend(self.watch(path))
+                elif mask & IN_MOVED_FROM:
+                    self.unwatch(path)
+        return paths
+
+    def close(self):
+        self.inotify.close()
+
+
+class PendingChanges(object):
+    """
+    Paths waiting for writes to them to settle down
+
+    Arguments:
+        debounce (float): a path is ready once it's gone this many seconds
+                          without changing
+    """
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.paths = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path, now):
+        self.paths[path] = now
+
+    def next_ready(self):
+        "Returns when the next path will be ready, or None if nothing's pending"
+        if not self.paths:
+            return None
+        return min(self.paths.values()) + self.debounce
+
+    def pop_ready(self, now):
+        "Removes and returns the paths that are ready, sorted"
+        ready = sorted(p for p, t in self.paths.items() if now - t >= self.debounce)
+        for p in ready:
+            del self.paths[p]
+        return ready
+
+
+class ManifestTree(object):
+    """
+    The files of a directory along with their hashes, updated a few at a time
+
+    Arguments:
+        algorithm (str): hash algorithm of the manifests this is built from
+    """
+    def __init__(self, algorithm="sha1"):
+        self.algorithm = algorithm
+        # Relative filename to (hash, perms, size, chunks)
+        self.entries = {}
+        self.dirty = False
+
+    def update(self, manifest):
+        "Adds or replaces the files in manifest"
+        self.algorithm = manifest.algorithm
+        for h, filename, perms in manifest.files:
+            self.entries[filename] = (h, perms, manifest.sizes.get(h), manifest.chunks.get(h))
+        if manifest.files:
+            self.dirty = True
+
+    def remove(self, filename):
+        "Removes filename, or everything under it if it was a directory"
+        prefix = filename + "/"
+        gone = [f for f in self.entries if f == filename or f.startswith(prefix)]
+        for f in gone:
+            del self.entries[f]
+        if gone:
+            self.dirty = True
+
+    def manifest(self):
+        "Returns a Manifest of every file"
+        m = Manifest(self.algorithm)
+        for filename in sorted(self.entries):
+            h, perms, size, chunks = self.entries[filename]
+            m.add(h, filename, perms, size, chunks)
+        self.dirty = False
+        return m
+
+
+def watch_directory(dirname, jobs, emit, interval=config.WATCH_INTERVAL, debounce=config.WATCH_DEBOUNCE, stop=None,
+                    **kwargs):
+    """
+    Uploads dirname, then keeps uploading the files in it that change
+
+    Arguments:
+        dirname (str): directory to upload and watch
+        jobs (int): how many uploads to do in parallel
+        emit (callable): called with a hashsync.manifest.Manifest of the
+                         whole tree after the first upload, and then at most
+                         every interval seconds while the tree is changing
+        interval (float): least time between manifests
+        debounce (float): how long a file has to go without changing before
+                          it's uploaded
+        stop (threading.Event): watching stops once this is set; by default
+                                we watch forever
+        kwargs: passed on to upload_directory
+    """
+    if not kwargs.get('dryrun'):
+        bucket = get_bucket()
+        kwargs['algorithm'] = get_algorithm(kwargs.get('algorithm') or repository_algorithm(bucket)).name
+    # (time loaded, ShardedObjectList), or None to load it for the next batch
+    loaded = [None]
+
+    def upload(**extra):
+        if not kwargs.get('dryrun'):
+            if loaded[0] is None or time.time() - loaded[0][0] > config.WATCH_OBJECTLIST_TTL:
+                object_list = ShardedObjectList(bucket, get_algorithm(kwargs['algorithm']).objectlist_keyname)
+                object_list.load()
+                loaded[0] = (time.time(), object_list)
+            extra['object_list'] = loaded[0][1]
+        try:
+            return upload_directory(dirname, jobs, pool=pool, **dict(kwargs, **extra))
+        except Exception:
+            # Whatever the upload added to the object list may not have been
+            # uploaded
+            if loaded[0] is not None:
+                loaded[0][1].forget_added()
+            raise
+
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+    watcher = DirectoryWatcher(dirname)
+    try:
+        # Start watching before the first upload so nothing written during
+        # it is missed
+        watcher.watch(dirname)
+        tree = ManifestTree()
+        tree.update(upload())
+        emit(tree.manifest())
+        last_emit = time.time()
+
+        pending = PendingChanges(debounce)
+        # Path to how many times in a row uploading it has failed
+        failures = {}
+        while not (stop and stop.is_set()):
+            now = time.time()
+            deadlines = [pending.next_ready()]
+            if tree.dirty:
+                deadlines.append(last_emit + interval)
+            deadlines = [d for d in deadlines if d is not None]
+            timeout = max(min(deadlines) - now, 0) if deadlines else None
+            if stop:
+                # Check for being stopped every so often
+                timeout = 1.0 if timeout is None else min(timeout, 1.0)
+
+            changed = watcher.changes(timeout)
+            now = time.time()
+            for path in changed:
+                pending.add(path, now)
+            if watcher.overflowed:
+                watcher.overflowed = False
+                log.info("rescanning %s", dirname)
+                for path in watcher.watch(dirname):
+                    pending.add(path, now)
+                for filename in tree.entries:
+                    pending.add(os.path.join(dirname, filename), now)
+
+            ready = pending.pop_ready(now)
+            if ready:
+                files = [p for p in ready if os.path.isfile(p)]
+                for p in ready:
+                    if not os.path.lexists(p):
+                        tree.remove(strip_leading(dirname, p))
+                if files:
+                    log.info("%i files changed", len(files))
+                    try:
+                        tree.update(upload(filenames=files))
+                    except (IOError, OSError, StorageError) as e:
+                        # Most likely a file changed or went away while we
+                        # were uploading it; look at them all again
+                        log.warning("couldn't upload changes (%s); trying again", e)
+                        for p in files:
+                            if p == getattr(e, 'filename', None) and e.errno in (errno.EACCES, errno.ENOENT):
+                                log.warning("giving up on %s until it changes again", p)
+                                continue
+                            failures[p] = failures.get(p, 0) + 1
+                            if failures[p] >= config.WATCH_MAX_ATTEMPTS:
+                                log.warning("giving up on %s after %i attempts until it changes again", p, failures[p])
+                                del failures[p]
+                                continue
+                            pending.add(p, now)
+                    else:
+                        for p in files:
+                            failures.pop(p, None)
+                METRICS.incr("hashsync_watch_batches_total")
+
+            if tree.dirty and time.time() - last_emit >= interval:
+                emit(tree.manifest())
+                last_emit = time.time()
+
+        if tree.dirty:
+            emit(tree.manifest())
+    finally:
+        watcher.close()
+        pool.close()
+        pool.join()
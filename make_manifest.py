@@ -1,102 +1,431 @@
 #!/usr/bin/env python
-from collections import defaultdict
+import os
+from itertools import groupby
+from operator import attrgetter
 import time
-import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 
-from hashsync.utils import parse_date
-from hashsync.objectlist import ObjectList
-from hashsync.connection import connect, get_bucket
-from hashsync import config
+from hashsync.objectlist import ShardedObjectList
+from hashsync.hashing import ALGORITHMS
+from hashsync.chunking import CHUNKLIST_SUFFIX
+from hashsync.reachable import HashSet, mark_manifests
+from hashsync.listing import Checkpoint, hex_prefixes, map_prefixes
+from hashsync.connection import connect, connect_url, get_bucket
+from hashsync.storage import StorageError
+from hashsync.metrics import METRICS
+from hashsync.throttle import AdaptiveRateLimiter, AdaptiveConcurrency
+from hashsync.retry import RETRY_CODES, THROTTLE_CODES
+from hashsync import config, profiling
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def delete_objects(keys):
-    log.info("Deleting %i keys", len(keys))
-    # Sleep a bit to work around request limits
-    time.sleep(5)
-    get_bucket().delete_keys(keys)
+def delete_objects(keys, limiter, stats, max_attempts=config.DELETE_MAX_ATTEMPTS, concurrency=None):
+    """
+    Deletes a batch of keys, retrying keys that fail with retryable errors.
+
+    Arguments:
+        keys (list): (keyname, version_id) tuples to delete
+        limiter (hashsync.throttle.AdaptiveRateLimiter): limits how often we
+                 send delete requests; it is told about every success or
+                 throttle
+        stats (DeleteStats): counters to update
+        max_attempts (int): how many times to try each key
+        concurrency (hashsync.throttle.AdaptiveConcurrency): optional limit
+                    on how many delete requests are in flight; it is told
+                    how each request went
+    """
+    bucket = get_bucket()
+    for attempt in range(1, max_attempts + 1):
+        limiter.acquire()
+        log.debug("Deleting %i keys", len(keys))
+        if concurrency:
+            concurrency.acquire()
+        start = time.time()
+        try:
+            result = bucket.delete(keys)
+        except Exception as e:
+            overloaded = isinstance(e, StorageError) and e.status in (500, 503)
+            if concurrency:
+                concurrency.release(throttled=overloaded)
+            if not overloaded:
+                raise
+            log.warning("delete of %i keys failed: %s %s", len(keys), e.status, e.code)
+            limiter.throttled()
+            stats.add(retried=len(keys))
+            continue
+
+        stats.add(deleted=len(result.deleted))
+
+        retry = []
+        throttled = False
+        for name, version_id, code, message in result.errors:
+            if code in RETRY_CODES:
+                retry.append((name, version_id))
+                throttled = throttled or code in THROTTLE_CODES
+            else:
+                log.error("couldn't delete %s %s: %s %s", name, version_id, code, message)
+                stats.add(failed=1)
+
+        if throttled:
+            limiter.throttled()
+        else:
+            limiter.succeeded()
+        if concurrency:
+            concurrency.release(time.time() - start, len(keys), throttled)
+
+        if not retry:
+            return
+        stats.add(retried=len(retry))
+        keys = retry
+
+    log.error("giving up deleting %i keys after %i attempts", len(keys), max_attempts)
+    stats.add(failed=len(keys))
+
+
+class DeleteStats(object):
+    """
+    Thread safe counters of how many keys have been deleted
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.deleted = 0
+        self.retried = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, deleted=0, retried=0, failed=0):
+        with self.lock:
+            self.deleted += deleted
+            self.retried += retried
+            self.failed += failed
+        METRICS.incr("hashsync_keys_deleted_total", deleted)
+        METRICS.incr("hashsync_keys_delete_retried_total", retried)
+        METRICS.incr("hashsync_keys_delete_failed_total", failed)
+
+    def report(self, limiter):
+        elapsed = max(time.time() - self.start, 0.001)
+        log.info("deleted %i keys in %.1fs (%.1f keys/s); %i retried, %i failed; delete rate is %.2f requests/s",
+                 self.deleted, elapsed, self.deleted / elapsed, self.retried, self.failed, limiter.rate)
 
 
 class Reaper(object):
-    def __init__(self, max_objects=1000):
+    """
+    Deletes keys in batches from a pool of threads
+
+    Arguments:
+        max_objects (int): how many keys to delete per request
+        max_pending (int): how many batches can be queued up
+        jobs (int): how many delete requests to have in flight; with
+                    adaptive, the most to have in flight
+        adaptive (bool): adjust how many delete requests are in flight
+                         depending on latency and throttling
+    """
+    def __init__(self, max_objects=1000, max_pending=64, jobs=8, adaptive=False):
         self.max_objects = max_objects
-        self.pool = multiprocessing.Pool(8)
+        # Limit how many batches can be waiting to be deleted so that we
+        # don't buffer up the whole listing when deletes fall behind
+        self.max_pending = max_pending
+        # Threads rather than processes, so that all the deletes share one
+        # rate limiter
+        self.pool = ThreadPool(jobs, initializer=profiling.init_thread)
+        self.limiter = AdaptiveRateLimiter(config.DELETE_RATE, config.DELETE_MIN_RATE, config.DELETE_MAX_RATE)
+        self.concurrency = AdaptiveConcurrency(1, 1, jobs) if adaptive else None
+        self.stats = DeleteStats()
         self.to_delete = []
         self.jobs = []
+        self.batches = 0
+        # delete() is called from the listing threads
+        self.lock = threading.Lock()
 
     def delete(self, key):
-        self.to_delete.append(key)
-        if len(self.to_delete) >= self.max_objects:
-            job = self.pool.apply_async(delete_objects, (self.to_delete,))
+        with self.lock:
+            self.to_delete.append(key)
+            if len(self.to_delete) >= self.max_objects:
+                self.flush()
+
+    def flush(self):
+        if self.to_delete:
+            # Forget about finished batches, and wait for the oldest ones if
+            # too many are still pending
+            pending = []
+            for job in self.jobs:
+                if job.ready():
+                    job.get()
+                else:
+                    pending.append(job)
+            self.jobs = pending
+            while len(self.jobs) >= self.max_pending:
+                self.jobs.pop(0).get(86400)
+
+            job = self.pool.apply_async(delete_objects, (self.to_delete, self.limiter, self.stats),
+                                        {'concurrency': self.concurrency})
             self.jobs.append(job)
             self.to_delete = []
+            METRICS.set_gauge("hashsync_queue_depth", len(self.jobs), queue="delete")
+
+            self.batches += 1
+            if self.batches % 100 == 0:
+                self.stats.report(self.limiter)
+
+    def drain(self):
+        "Sends the keys queued so far, and waits until they've been deleted"
+        with self.lock:
+            self.flush()
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.get(86400)
 
     def stop(self):
+        with self.lock:
+            self.flush()
+
         for job in self.jobs:
             job.get(86400)
 
         self.pool.close()
         self.pool.join()
+        self.stats.report(self.limiter)
 
 
-def delete_old_keys(too_old):
-    now = time.time()
+def newest_versions(prefix, reaper):
+    """
+    Lists all versions of the keys starting with prefix, and queues all but
+    the newest version of each key for deletion with reaper.
 
+    Listings return all the versions of a key together, so this is done in a
+    single pass holding only the versions of the current key in memory.
+
+    Yields:
+        (keyname, last_modified, version_id) of the newest version of each key
+    """
     bucket = get_bucket()
 
-    object_list = ObjectList(bucket)
-    object_list.load()
+    for keyname, versions in groupby(bucket.list_versions(prefix=prefix), attrgetter('name')):
+        versions = sorted((o.last_modified, o.version_id) for o in versions if not o.is_delete_marker)
+        if not versions:
+            continue
 
-    new_object_list = ObjectList(bucket)
+        # Delete all but the newest version
+        for d, v in versions[:-1]:
+            reaper.delete((keyname, v))
 
-    objects_by_key = defaultdict(list)
-    bucket = get_bucket()
-    log.info("Listing objects; deleting old keys...")
-    reaper = Reaper()
+        d, v = versions[-1]
+        yield keyname, d, v
 
-    for o in bucket.list_versions():
-        if hasattr(o, 'DeleteMarker'):
-            continue
-        if o.key.startswith("objectlist"):
-            continue
 
-        d = parse_date(o.last_modified)
-        h = o.key.split("/")[-1]
-        objects_by_key[o.key].append((d, o.version_id))
+def reap_prefix(prefix, object_list, reaper, too_old, now):
+    """
+    Deletes duplicate versions of the keys starting with prefix, as well as
+    objects that haven't been modified in config.PURGE_TIME and aren't in
+    object_list.
+
+    Returns:
+        sorted list of (hash, last_modified) for objects that are new enough
+        to be put in the object list
+    """
+    live = set()
+    for keyname, d, v in newest_versions(prefix, reaper):
+        h = keyname.split("/")[-1]
         if d >= too_old:
-            new_object_list.add(h)
+            live.add((h, d))
+        elif h not in object_list and d <= (now - config.PURGE_TIME):
+            # Delete old objects
+            reaper.delete((keyname, v))
+
+    return sorted(live)
+
+
+def sweep_prefix(prefix, object_list, reaper, reachable, cutoff):
+    """
+    Deletes duplicate versions of the keys starting with prefix, as well as
+    objects that aren't reachable from any manifest, were last modified
+    before cutoff, and aren't in object_list.
+
+    Objects in object_list may have been skipped by uploads that are still
+    running, so they're only deleted once a later run has dropped them from
+    the object list.
+
+    The chunk list of a chunked file counts as reachable if the file is.
+    Keys whose names aren't hashes are left alone.
+
+    Returns:
+        sorted list of (hash, last_modified) for objects that should be put
+        in the object list
+    """
+    live = set()
+    for keyname, d, v in newest_versions(prefix, reaper):
+        h = keyname.split("/")[-1]
+        # Chunk lists are kept for as long as their file is
+        marked = h[:-len(CHUNKLIST_SUFFIX)] if h.endswith(CHUNKLIST_SUFFIX) else h
+        if not reachable.valid(marked):
+            log.warning("not sweeping %s; its name isn't a hash", keyname)
             continue
+        if marked in reachable or d > cutoff:
+            live.add((h, d))
+        elif h not in object_list:
+            reaper.delete((keyname, v))
 
-        if h not in object_list and d <= (now - config.PURGE_TIME):
-            # Delete old objects
-            reaper.delete((o.key, o.version_id))
+    return sorted(live)
 
-    #  Delete duplicate versions of objects?
-    log.info("deleting duplicate keys...")
-    for key, versions in objects_by_key.iteritems():
-        versions.sort()
-        # Delete all but the newest
-        for d, v in versions[:-1]:
-            reaper.delete((key, v))
+
+def reap_bucket(reap, jobs=16, prefix_width=1, checkpoint=None, reaper=None, algorithms=None):
+    """
+    Runs reap(prefix, object_list, reaper, algorithm) over the object
+    namespace of each hash algorithm, split up by the first prefix_width hex
+    digits of the hash. The prefixes are processed in parallel.
+
+    Arguments:
+        reap (callable): function that deletes objects under a prefix with
+                         the given Reaper, and returns (hash, last_modified)
+                         for the objects to keep in the object list
+        jobs (int): how many prefixes to list in parallel
+        prefix_width (int): how many hex digits to split the listing up by
+        checkpoint (hashsync.listing.Checkpoint): where to record finished
+                   prefixes, so an interrupted run can be resumed; optional.
+                   A prefix is only recorded once the deletes it queued have
+                   been sent.
+        reaper (Reaper): reaper to delete keys with; defaults to Reaper()
+        algorithms (list): hashsync.hashing.HashAlgorithm namespaces to
+                           collect; defaults to all of them
+
+    Returns:
+        A list of hashsync.objectlist.ShardedObjectList of the objects
+        returned by reap, one per algorithm that has objects
+    """
+    bucket = get_bucket()
+    if algorithms is None:
+        algorithms = [ALGORITHMS[name] for name in sorted(ALGORITHMS)]
+
+    object_lists = {}
+    new_object_lists = {}
+    prefixes = {}
+    for algorithm in algorithms:
+        object_list = object_lists[algorithm.name] = ShardedObjectList(bucket, algorithm.objectlist_keyname)
+        object_list.load()
+
+        new_object_list = new_object_lists[algorithm.name] = ShardedObjectList(bucket, algorithm.objectlist_keyname)
+        # Every object in the deltas we just loaded was uploaded or refreshed
+        # before our listing started, so the listing will see them; the new
+        # list can safely replace those deltas when it's saved.
+        new_object_list.deltas.update(object_list.deltas)
+
+        for p in hex_prefixes(prefix_width):
+            prefixes[algorithm.prefix + p] = algorithm
+
+    log.info("Listing objects; deleting old keys...")
+    if reaper is None:
+        reaper = Reaper()
+
+    def run(prefix):
+        algorithm = prefixes[prefix]
+        live = reap(prefix, object_lists[algorithm.name], reaper, algorithm)
+        if checkpoint:
+            reaper.drain()
+        return live
+
+    for prefix, live in map_prefixes(run, sorted(prefixes), jobs, checkpoint):
+        new_object_list = new_object_lists[prefixes[prefix].name]
+        for h, d in live:
+            new_object_list.add(h, d)
 
     reaper.stop()
 
-    return new_object_list
+    # Leave the object lists of algorithms that have never been used alone
+    return [new_object_lists[a.name] for a in algorithms
+            if a.name == "sha1" or new_object_lists[a.name].objects or object_lists[a.name].objects]
+
+
+def delete_old_keys(too_old, jobs=16, prefix_width=1, checkpoint=None, reaper=None, now=None):
+    """
+    Deletes old objects and duplicate object versions from the bucket.
+
+    Arguments:
+        too_old (int): objects modified before this timestamp are left out of
+                       the new object list
+        jobs, prefix_width, checkpoint, reaper: see reap_bucket
+        now (float): when the run started, e.g. Checkpoint.begin(); defaults
+                     to the current time
+
+    Returns:
+        A list of hashsync.objectlist.ShardedObjectList of the objects newer
+        than too_old
+    """
+    if now is None:
+        now = time.time()
+
+    def reap(prefix, object_list, reaper, algorithm):
+        return reap_prefix(prefix, object_list, reaper, too_old, now)
+
+    return reap_bucket(reap, jobs, prefix_width, checkpoint, reaper)
+
+
+def sweep_unreachable(reachable, grace=config.GC_GRACE_TIME, jobs=16, prefix_width=1, checkpoint=None,
+                      reaper=None, now=None):
+    """
+    Deletes objects that aren't reachable from any manifest and are older
+    than the grace period, as well as duplicate object versions.
+
+    Arguments:
+        reachable (dict): hash algorithm name to hashsync.reachable.HashSet
+                  of the hashes referenced by the manifests we're keeping
+        grace (int): objects modified less than this many seconds ago are
+                     never deleted
+        jobs, prefix_width, checkpoint, reaper: see reap_bucket
+        now (float): when the run started, e.g. Checkpoint.begin(); defaults
+                     to the current time
+
+    Returns:
+        A list of hashsync.objectlist.ShardedObjectList of the reachable
+        objects and the objects within the grace period
+    """
+    if now is None:
+        now = time.time()
+    cutoff = now - grace
+
+    def sweep(prefix, object_list, reaper, algorithm):
+        marked = reachable.get(algorithm.name) or HashSet(algorithm.digest_size)
+        return sweep_prefix(prefix, object_list, reaper, marked, cutoff)
+
+    return reap_bucket(sweep, jobs, prefix_width, checkpoint, reaper)
 
 
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-r", "--region", dest="region", required=True)
-    parser.add_argument("-b", "--bucket", dest="bucket_name", required=True)
+    parser.add_argument("-r", "--region", dest="region")
+    parser.add_argument("-b", "--bucket", dest="bucket_name")
+    parser.add_argument("-u", "--url", dest="url",
+                        help="storage backend URL to use instead of --region and --bucket, "
+                        "e.g. s3://bucket?region=us-east-1 or file:///path")
     parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const=logging.WARN, default=logging.INFO)
     parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const=logging.DEBUG)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="how many prefixes to list in parallel", default=16)
+    parser.add_argument("--prefix-width", dest="prefix_width", type=int, default=1,
+                        help="number of hex digits to split the listing up by; 1 gives 16 prefixes, 2 gives 256")
+    parser.add_argument("--checkpoint-dir", dest="checkpoint_dir",
+                        help="record finished prefixes here so an interrupted run can be resumed; checkpoints "
+                        "from a run with different arguments, or from more than a day ago, are discarded")
+    parser.add_argument("--reachable-from", dest="manifests", nargs="+", metavar="MANIFEST",
+                        help="delete objects that aren't referenced by any of these manifests instead of deleting objects by age")
+    parser.add_argument("--grace", dest="grace", type=int, default=config.GC_GRACE_TIME,
+                        help="with --reachable-from, never delete objects modified less than this many seconds ago")
+    parser.add_argument("--delete-jobs", dest="delete_jobs", type=int, default=8,
+                        help="how many delete requests to have in flight")
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=False,
+                        help="adjust how many delete requests are in flight, up to --delete-jobs, based on latency "
+                        "and throttling")
+    parser.add_argument("--metrics-json", dest="metrics_json", help="write metrics to this file as JSON")
+    parser.add_argument("--metrics-prom", dest="metrics_prom", help="write metrics to this file in the Prometheus text format")
+    parser.add_argument("--profile", dest="profile", metavar="DIR",
+                        help="profile this process and its workers, writing the profiles and a merged report to DIR")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true", default=False,
+                        help="with --profile, also take tracemalloc snapshots")
     parser.add_argument("cutoff", type=int, nargs="?",
-                        help="cutoff time (timestamp); objects older than this will be considered for deletion; defaults to one week ago",
-                        default=time.time() - 7 * 86400)
+                        help="cutoff time (timestamp); objects older than this will be considered for deletion; defaults to one week ago")
 
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel, format="%(asctime)s - %(message)s")
@@ -104,12 +433,44 @@ def main():
     # TODO: Add -v -v support to set this to DEBUG?
     logging.getLogger('boto').setLevel(logging.INFO)
 
-    connect(args.region, args.bucket_name)
+    if args.profile:
+        profiling.start(args.profile, memory=args.profile_memory)
+
+    if args.url:
+        connect_url(args.url)
+    elif args.region and args.bucket_name:
+        connect(args.region, args.bucket_name)
+    else:
+        parser.error("either --url or --region and --bucket are required")
+
+    now = time.time()
+    checkpoint = None
+    if args.checkpoint_dir:
+        checkpoint = Checkpoint(args.checkpoint_dir)
+        # A resumed run carries on with the start time, and so the cutoffs,
+        # of the run it's resuming
+        manifests = [[os.path.abspath(m), os.path.getsize(m), os.path.getmtime(m)] for m in args.manifests or []]
+        now = checkpoint.begin({'url': args.url, 'region': args.region, 'bucket': args.bucket_name,
+                                'cutoff': args.cutoff, 'manifests': manifests, 'grace': args.grace,
+                                'prefix_width': args.prefix_width})
+    too_old = args.cutoff if args.cutoff is not None else now - 7 * 86400
+    reaper = Reaper(jobs=args.delete_jobs, adaptive=args.adaptive)
+
+    if args.manifests:
+        reachable = mark_manifests(args.manifests)
+        object_lists = sweep_unreachable(reachable, args.grace, args.jobs, args.prefix_width, checkpoint, reaper,
+                                         now)
+    else:
+        object_lists = delete_old_keys(too_old, args.jobs, args.prefix_width, checkpoint, reaper, now)
+    for object_list in object_lists:
+        object_list.save()
 
-    too_old = args.cutoff
+    if checkpoint:
+        checkpoint.clear()
 
-    object_list = delete_old_keys(too_old)
-    object_list.save()
+    METRICS.log_summary()
+    METRICS.write(args.metrics_json, args.metrics_prom)
+    profiling.stop()
 
 if __name__ == '__main__':
     main()
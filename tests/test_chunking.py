@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_chunking
+----------------------------------
+
+Tests for `hashsync.chunking` module.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from hashsync.chunking import iter_chunks, chunk_file, chunk_offsets, assemble, encode_chunklist, decode_chunklist
+
+SIZES = dict(min_size=1024, avg_size=4096, max_size=16384)
+
+
+def random_data(n, seed=0):
+    r = random.Random(seed)
+    return bytes(bytearray(r.getrandbits(8) for _ in range(n)))
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sizes(self):
+        data = random_data(200000)
+        chunks = list(iter_chunks(BytesIO(data), **SIZES))
+        self.assertEqual(b"".join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 1024)
+            self.assertLessEqual(len(chunk), 16384)
+        # Sizes should be somewhere around the average
+        mean = len(data) / len(chunks)
+        self.assertGreater(mean, 2048)
+        self.assertLess(mean, 8192)
+
+    def test_unchunkable(self):
+        # Data without any boundaries is cut at max_size
+        chunks = list(iter_chunks(BytesIO(b"\0" * 40000), **SIZES))
+        self.assertEqual([len(c) for c in chunks], [16384, 16384, 7232])
+        self.assertEqual(list(iter_chunks(BytesIO(b""), **SIZES)), [])
+
+    def test_insert(self):
+        data = random_data(200000)
+        edited = data[:100000] + b"inserted" + data[100000:]
+        before = set(iter_chunks(BytesIO(data), **SIZES))
+        after = list(iter_chunks(BytesIO(edited), **SIZES))
+        # Only the chunks around the edit change
+        changed = [c for c in after if c not in before]
+        self.assertLessEqual(len(changed), 2)
+
+    def test_chunk_file(self):
+        data = random_data(50000)
+        filename = os.path.join(self.tmpdir, "data")
+        with open(filename, 'wb') as f:
+            f.write(data)
+        chunks = chunk_file(filename, **SIZES)
+        self.assertEqual(sum(size for _, size in chunks), len(data))
+
+        chunk_files = []
+        for offset, h, size in chunk_offsets(chunks):
+            self.assertEqual(hashlib.sha1(data[offset:offset + size]).hexdigest(), h)
+            chunk_files.append(os.path.join(self.tmpdir, h))
+            with open(chunk_files[-1], 'wb') as f:
+                f.write(data[offset:offset + size])
+
+        dst = BytesIO()
+        assemble(chunk_files, dst)
+        self.assertEqual(dst.getvalue(), data)
+
+        # Chunks can be read from within another file too
+        dst = BytesIO()
+        assemble([(filename, offset, size) for offset, h, size in chunk_offsets(chunks)], dst)
+        self.assertEqual(dst.getvalue(), data)
+
+        self.assertEqual(decode_chunklist(encode_chunklist(chunks)), chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
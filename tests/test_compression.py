@@ -14,6 +14,7 @@ import os
 from io import BytesIO, UnsupportedOperation
 
 from hashsync.compression import compress_stream, decompress_stream, compress_file, maybe_compress, gzip_compress, gzip_decompress
+from hashsync.compression import compress_segmented, read_segment_index, decompress_member
 
 HELLO_WORLD = b'\x1f\x8b\x08\x00\x9b\xff\x74\x54\x00\x03\xcb\x48\xcd\xc9\xc9\x57\x28\xcf\x2f\xca\x49\x01\x00\x85\x11\x4a\x0d\x0b\x00\x00\x00'
 
@@ -85,6 +86,28 @@ class TestCompression(unittest.TestCase):
         data = gzip_decompress(HELLO_WORLD)
         self.assertEqual(data, b'hello world')
 
+    def test_compress_segmented(self):
+        data = b"".join(str(i).encode() for i in range(100000))
+        dst = BytesIO()
+        # The last member picks up anything past the expected size
+        compress_segmented(BytesIO(data), dst, len(data) - 10, segment_size=100000)
+        compressed_data = dst.getvalue()
+        # It's still an ordinary gzip stream
+        self.assertEqual(gzip_decompress(compressed_data), data)
+
+        size, segment_size, offsets = read_segment_index(compressed_data[:70000])
+        self.assertEqual(size, len(data))
+        self.assertEqual(segment_size, 100000)
+        self.assertEqual(len(offsets), 5)
+        ends = offsets[1:] + [len(compressed_data)]
+        members = [decompress_member(compressed_data[start:end]) for start, end in zip(offsets, ends)]
+        self.assertEqual([len(m) for m in members[:4]], [100000] * 4)
+        self.assertEqual(b"".join(members), data)
+
+    def test_segment_index_missing(self):
+        self.assertIsNone(read_segment_index(HELLO_WORLD))
+        self.assertIsNone(read_segment_index(b"not gzip"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_daemon
+----------------------------------
+
+Tests for `daemon.py` and `client.py`.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from client import DaemonError, request
+from daemon import Daemon, HashCache, listen
+from hashsync.connection import connect_url
+from hashsync.metrics import METRICS
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.hashed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def hash_file(self, filename):
+        self.hashed.append(os.path.basename(filename))
+        with open(filename, 'rb') as f:
+            return f.read().decode("utf8")
+
+    def write(self, name, data):
+        with open(os.path.join(self.tmpdir, name), 'wb') as f:
+            f.write(data)
+        return os.path.join(self.tmpdir, name)
+
+    def test_hasher(self):
+        cache = HashCache(2)
+        hasher = cache.hasher(self.hash_file)
+        a = self.write("a", b"a")
+        b = self.write("b", b"b")
+        self.assertEqual(hasher(a), "a")
+        self.assertEqual(hasher(b), "b")
+        self.assertEqual(hasher(a), "a")
+        self.assertEqual(self.hashed, ["a", "b"])
+
+        # Changed files are hashed again
+        os.utime(b, ns=(0, 0))
+        self.assertEqual(hasher(b), "b")
+        self.assertEqual(self.hashed, ["a", "b", "b"])
+
+        # The least recently used file is forgotten first
+        c = self.write("c", b"c")
+        hasher(c)
+        hasher(b)
+        hasher(a)
+        self.assertEqual(self.hashed, ["a", "b", "b", "c", "a"])
+        self.assertEqual(len(cache), 2)
+
+
+class TestListen(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_listen(self):
+        sock = listen(self.path)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode) & 0o077, 0)
+            # Only one daemon can listen at once
+            self.assertRaises(IOError, listen, self.path)
+        finally:
+            sock.close()
+
+        # But a socket nobody's listening on is replaced
+        sock = listen(self.path)
+        sock.close()
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        connect_url("file://" + self.path("store"))
+        self.pool = multiprocessing.Pool(2)
+        self.daemon = Daemon(self.pool, 2, self.path("cache"))
+        self.socket = self.path("sock")
+        self.thread = threading.Thread(target=self.daemon.serve, args=(self.socket,))
+        self.thread.start()
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            request(self.socket, "stop")
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+        METRICS.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *bits):
+        return os.path.join(self.tmpdir, *bits)
+
+    def write(self, name, data):
+        filename = self.path("src", name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def read(self, *bits):
+        with open(self.path(*bits), 'rb') as f:
+            return f.read()
+
+    def test_sync(self):
+        self.write("a", b"a" * 1000)
+        self.write("sub/b", b"b" * 1000)
+        logs = []
+        result = request(self.socket, "upload", {"dirname": self.path("src"), "output": self.path("m.gz"),
+                                                 "journal": self.path("m.gz.journal")}, logs.append)
+        self.assertEqual(result, {"files": 2})
+        self.assertTrue(logs)
+        self.assertFalse(os.path.exists(self.path("m.gz.journal")))
+
+        result = request(self.socket, "download", {"pairs": [(self.path("m.gz"), self.path("dst"))],
+                                                   "metrics_json": self.path("metrics.json")})
+        self.assertEqual(result, {"objects": 2})
+        self.assertEqual(self.read("dst", "a"), b"a" * 1000)
+        self.assertEqual(self.read("dst", "sub", "b"), b"b" * 1000)
+        self.assertTrue(os.path.exists(self.path("metrics.json")))
+
+        # The second time round, the object list and the hashes are reused,
+        # and everything's in the cache
+        self.write("c", b"c")
+        self.assertEqual(request(self.socket, "upload", {"dirname": self.path("src"), "output": self.path("m.gz")}),
+                         {"files": 3})
+        self.assertEqual(METRICS.counters[("hashsync_hash_skipped_total", ())], 2)
+        self.assertEqual(METRICS.counters[("hashsync_daemon_objectlist_total", (("state", "warm"),))], 1)
+        self.assertEqual(request(self.socket, "download", {"pairs": [(self.path("m.gz"), self.path("dst2"))],
+                                                           "include": ["sub"]}),
+                         {"objects": 0})
+        self.assertEqual(os.listdir(self.path("dst2")), ["sub"])
+
+        status = request(self.socket, "status")
+        self.assertEqual(status["requests"], 5)
+        self.assertEqual(list(status["hash_caches"].values()), [3])
+
+    def test_errors(self):
+        self.assertRaises(DaemonError, request, self.socket, "download",
+                          {"pairs": [(self.path("missing.gz"), self.path("dst"))]})
+        self.assertRaises(DaemonError, request, self.socket, "frobnicate")
+        self.assertRaises(DaemonError, request, self.socket, "status", {"loglevel": "bogus"})
+        self.assertRaises(DaemonError, request, self.socket, "status", {"loglevel": "getLogger"})
+        self.assertRaises(DaemonError, request, self.socket, "upload", ["not", "a", "dict"])
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket)
+            sock.sendall(b'["not a request"]\n')
+            reply = json.loads(sock.makefile('rb').readline().decode("utf8"))
+        finally:
+            sock.close()
+        self.assertFalse(reply["ok"])
+        # The daemon carries on after a failed request
+        request(self.socket, "status")
+
+    def test_stop(self):
+        request(self.socket, "stop")
+        self.thread.join(10)
+        self.assertFalse(os.path.exists(self.socket))
+        self.assertRaises(socket.error, request, self.socket, "status")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_download
+----------------------------------
+
+Tests for planning downloads in `download.py`.
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from download import DownloadPlan, FileCache, download_key, mkdirs
+from hashsync.connection import connect_url
+from hashsync.hashing import get_algorithm
+from hashsync.manifest import Manifest
+from hashsync.metrics import METRICS
+from hashsync.verify import CorruptObject
+
+
+class TestDownloadPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.plan = DownloadPlan(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *bits):
+        return os.path.join(self.tmpdir, *bits)
+
+    def manifest(self, files, algorithm="sha1"):
+        a = get_algorithm(algorithm)
+        m = Manifest(algorithm)
+        for filename, data in files:
+            m.add(a.hash_data(data), filename, 0o644, len(data))
+        return m
+
+    def download(self, keyname, data):
+        cache, h = self.plan.objects[keyname]
+        mkdirs(os.path.dirname(cache.makepath(h)))
+        with open(cache.makepath(h), 'wb') as f:
+            f.write(data)
+        self.plan.materialize(keyname)
+
+    def read(self, *bits):
+        with open(self.path(*bits), 'rb') as f:
+            return f.read()
+
+    def test_shared_objects(self):
+        sha1 = get_algorithm("sha1")
+        self.plan.add(self.manifest([("a", b"shared"), ("b", b"one")]), self.path("one"))
+        self.plan.add(self.manifest([("c", b"shared"), ("d", b"two")]), self.path("two"))
+        self.plan.add(self.manifest([("e", b"shared")], "sha256"), self.path("three"))
+
+        keys = sorted(k for _, k in self.plan.tasks)
+        shared = sha1.key(sha1.hash_data(b"shared"))
+        # Objects hashed with another algorithm are separate objects
+        self.assertEqual(keys, sorted([shared, sha1.key(sha1.hash_data(b"one")), sha1.key(sha1.hash_data(b"two")),
+                                       get_algorithm("sha256").key(get_algorithm("sha256").hash_data(b"shared"))]))
+        self.assertEqual(sorted(d for d, _ in self.plan.files[shared]), [self.path("one", "a"), self.path("two", "c")])
+
+        self.download(shared, b"shared")
+        self.assertEqual(self.read("one", "a"), b"shared")
+        self.assertEqual(self.read("two", "c"), b"shared")
+
+    def test_cached(self):
+        sha1 = get_algorithm("sha1")
+        self.plan.add(self.manifest([("a", b"data")]), self.path("one"))
+        self.download(sha1.key(sha1.hash_data(b"data")), b"data")
+
+        # Once it's in the cache, another destination gets it from there
+        plan = DownloadPlan(self.path("cache"))
+        plan.add(self.manifest([("b", b"data"), ("empty", b"")]), self.path("two"))
+        self.assertEqual(plan.tasks, [])
+        self.assertEqual(self.read("two", "b"), b"data")
+        self.assertEqual(self.read("two", "empty"), b"")
+
+    def test_known_files(self):
+        sha1 = get_algorithm("sha1")
+        plan = DownloadPlan(self.path("cache"), verify=True)
+        m = self.manifest([("a", b"data"), ("b", b"other")])
+        plan.add(m, self.path("dest"))
+        self.plan = plan
+        for _, keyname in plan.tasks:
+            self.download(keyname, b"data" if keyname == sha1.key(sha1.hash_data(b"data")) else b"other")
+        plan.finish()
+
+        # Files copied from verified objects aren't hashed again
+        METRICS.reset()
+        with open(self.path("dest", "b"), 'wb') as f:
+            f.write(b"changed")
+        plan = DownloadPlan(self.path("cache"), verify=True)
+        plan.add(m, self.path("dest"))
+        self.assertEqual(METRICS.counters[("hashsync_hash_skipped_total", ())], 1)
+        self.assertEqual(METRICS.histograms[("hashsync_stage_seconds", (("stage", "hash"),))][-1], 1)
+        self.assertEqual(self.read("dest", "b"), b"other")
+
+    def test_permissions(self):
+        m = Manifest()
+        sha1 = get_algorithm("sha1")
+        m.add(sha1.hash_data(b"data"), "dir/a", 0o755, 4)
+        self.plan.add(m, self.path("dest"))
+        self.download(self.plan.tasks[0][1], b"data")
+        self.plan.finish()
+        self.assertEqual(os.stat(self.path("dest", "dir", "a")).st_mode & 0o777, 0o755)
+
+        # Only the permissions changed, so there's nothing to download
+        m = Manifest()
+        m.add(sha1.hash_data(b"data"), "dir/a", 0o600, 4)
+        plan = DownloadPlan(self.path("cache"))
+        plan.add(m, self.path("dest"))
+        self.assertEqual(plan.tasks, [])
+        plan.finish()
+        self.assertEqual(os.stat(self.path("dest", "dir", "a")).st_mode & 0o777, 0o600)
+
+    def chunked(self, chunks):
+        "Returns a manifest of one file made of chunks"
+        sha1 = get_algorithm("sha1")
+        data = b"".join(chunks)
+        m = Manifest()
+        m.add(sha1.hash_data(data), "big", 0o644, len(data), [(sha1.hash_data(c), len(c)) for c in chunks])
+        return m
+
+    def assemble(self, plan, data):
+        for _, keyname in plan.tasks:
+            self.download(keyname, data[keyname])
+        for keyname, chunks in plan.to_assemble.items():
+            cache, h = plan.objects[keyname]
+            cache.assemble(h, chunks)
+            plan.materialize(keyname)
+        plan.drop_chunks()
+
+    def test_chunked(self):
+        sha1 = get_algorithm("sha1")
+        chunks = [b"one", b"two", b"three"]
+        data = dict((sha1.key(sha1.hash_data(c)), c) for c in chunks + [b"four"])
+        self.plan.add(self.chunked(chunks), self.path("dest"))
+        self.assertEqual(len(self.plan.tasks), 3)
+        self.assemble(self.plan, data)
+        self.assertEqual(self.read("dest", "big"), b"onetwothree")
+
+        # The assembled file holds the chunks, so they aren't kept as well
+        cache = self.plan.cache(sha1)
+        self.assertIn(sha1.hash_data(b"onetwothree"), cache)
+        for c in chunks:
+            self.assertNotIn(sha1.hash_data(c), cache)
+
+        # But they're still used for other files
+        self.plan = plan = DownloadPlan(self.path("cache"))
+        plan.add(self.chunked([b"one", b"four", b"three"]), self.path("dest"))
+        self.assertEqual([k for _, k in plan.tasks], [sha1.key(sha1.hash_data(b"four"))])
+        self.assemble(plan, data)
+        self.assertEqual(self.read("dest", "big"), b"onefourthree")
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = connect_url("memory://test_download")
+        self.sha1 = get_algorithm("sha1")
+        self.dst = os.path.join(self.tmpdir, "object")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_download(self):
+        keyname = self.sha1.key(self.sha1.hash_data(b"data"))
+        self.bucket.put(keyname, gzip.compress(b"data"), content_encoding="gzip")
+        download_key(keyname, self.dst, 1, "sha1")
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_corrupt(self):
+        keyname = self.sha1.key(self.sha1.hash_data(b"data"))
+        self.bucket.put(keyname, b"garbage")
+        self.assertRaises(CorruptObject, download_key, keyname, self.dst, 1, "sha1")
+        # Nothing is left in the cache
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        # Without checking, the object is taken as it is
+        download_key(keyname, self.dst, 1)
+        self.assertTrue(os.path.exists(self.dst))
+
+    def test_corrupt_cache(self):
+        h = self.sha1.hash_data(b"data")
+        cache = FileCache(self.tmpdir, verify=True)
+        mkdirs(os.path.dirname(cache.makepath(h)))
+        with open(cache.makepath(h), 'wb') as f:
+            f.write(b"garbage")
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertRaises(CorruptObject, cache.copy_from_cache, h, dest)
+        self.assertNotIn(h, cache)
+        self.assertFalse(os.path.exists(dest))
+
+        with open(cache.makepath(h), 'wb') as f:
+            f.write(b"data")
+        cache.copy_from_cache(h, dest)
+        self.assertEqual(FileCache(self.tmpdir).verified, set([h]))
+
+
+if __name__ == '__main__':
+    unittest.main()
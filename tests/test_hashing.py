@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_hashing
+----------------------------------
+
+Tests for `hashsync.hashing` module.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from hashsync.hashing import (HashAlgorithm, TreeHash, get_algorithm, ALGORITHMS, repository_algorithm,
+                              set_repository_algorithm)
+from hashsync.storage import MemoryBackend
+from hashsync.utils import sha1sum, SHA1SUM_ZERO
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "data")
+        self.data = os.urandom(100000)
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sha1(self):
+        # sha1 objects are named as they always have been
+        a = get_algorithm("sha1")
+        self.assertEqual(a.hash_file(self.filename), sha1sum(self.filename))
+        self.assertEqual(a.zero, SHA1SUM_ZERO)
+        self.assertEqual(a.key(SHA1SUM_ZERO), "objects/" + SHA1SUM_ZERO)
+        self.assertEqual(a.objectlist_keyname, "objectlist")
+
+    def test_namespace(self):
+        a = get_algorithm("sha1-tree")
+        self.assertEqual(a.key("abcd"), "objects-sha1-tree/abcd")
+        self.assertEqual(a.objectlist_keyname, "objectlist-sha1-tree")
+        # Listing sha1 objects by hex prefix mustn't find other namespaces
+        for name, a in ALGORITHMS.items():
+            if name != "sha1":
+                self.assertFalse(a.key("abcd").startswith("objects/"))
+
+    def test_sha256(self):
+        a = get_algorithm("sha256")
+        self.assertEqual(a.hash_file(self.filename), hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(a.digest_size, 32)
+
+    @unittest.skipUnless("blake2b-256" in ALGORITHMS, "blake2b isn't available")
+    def test_blake2b(self):
+        a = get_algorithm("blake2b-256")
+        self.assertEqual(a.hash_file(self.filename), hashlib.blake2b(self.data, digest_size=32).hexdigest())
+        self.assertEqual(len(a.zero), 64)
+
+    def test_tree_hash(self):
+        threaded = TreeHash("t", "sha1", leaf_size=4096, jobs=4)
+        serial = TreeHash("t", "sha1", leaf_size=4096, jobs=1)
+        h = threaded.hash_file(self.filename)
+        self.assertEqual(h, serial.hash_file(self.filename))
+        self.assertEqual(h, threaded.hash_data(self.data))
+        self.assertNotEqual(h, sha1sum(self.filename))
+        # The leaf size is part of the hash
+        self.assertNotEqual(h, TreeHash("t", "sha1", leaf_size=8192).hash_file(self.filename))
+
+    def test_hasher(self):
+        for name, a in sorted(ALGORITHMS.items()) + [("t", TreeHash("t", "sha1", leaf_size=4096))]:
+            h = a.hasher()
+            # Updates that don't line up with leaves
+            for i in range(0, len(self.data), 3000):
+                h.update(self.data[i:i + 3000])
+            self.assertEqual(h.hexdigest(), a.hash_data(self.data), name)
+            self.assertEqual(a.hasher().hexdigest(), a.zero, name)
+
+    def test_tree_hash_empty(self):
+        a = TreeHash("t", "sha1", leaf_size=4096, jobs=4)
+        open(self.filename, 'wb').close()
+        self.assertEqual(a.hash_file(self.filename), a.zero)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, get_algorithm, "md4")
+        self.assertIsInstance(get_algorithm("sha1"), HashAlgorithm)
+
+    def test_repository_algorithm(self):
+        bucket = MemoryBackend()
+        self.assertEqual(repository_algorithm(bucket), "sha1")
+        set_repository_algorithm(bucket, "sha256")
+        self.assertEqual(repository_algorithm(bucket), "sha256")
+        self.assertRaises(ValueError, set_repository_algorithm, bucket, "md4")
+        self.assertEqual(repository_algorithm(bucket), "sha256")
+
+
+if __name__ == '__main__':
+    unittest.main()
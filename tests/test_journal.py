@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_journal
+----------------------------------
+
+Tests for `hashsync.journal` module.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from io import BytesIO
+
+from hashsync.journal import UploadJournal
+from hashsync.storage import MemoryBackend, StorageError
+from hashsync.transfer import _put_multipart
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def reopen(self, **settings):
+        j = UploadJournal(self.filename)
+        resumed = j.begin(**settings)
+        self.addCleanup(j.close)
+        return j, resumed
+
+    def test_resume(self):
+        j, resumed = self.reopen(dirname="/src", algorithm="sha1")
+        self.assertFalse(resumed)
+        j.record_state("a" * 40, "uploaded")
+        j.record_chunks("b" * 40, [("c" * 40, 10), ("d" * 40, 5)])
+        j.start_multipart("objects/e", "upload1", 16)
+        j.record_part("objects/e", "upload1", 1, "etag1")
+        j.start_multipart("objects/f", "upload2", 16)
+        j.finish_multipart("objects/f")
+        j.close()
+
+        j, resumed = self.reopen(dirname="/src", algorithm="sha1")
+        self.assertTrue(resumed)
+        self.assertEqual(j.states, {"a" * 40: "uploaded"})
+        self.assertEqual(j.chunks, {"b" * 40: [("c" * 40, 10), ("d" * 40, 5)]})
+        self.assertEqual(j.multipart, {"objects/e": {"upload_id": "upload1", "part_size": 16, "parts": {1: "etag1"}}})
+
+    def test_different_upload(self):
+        j, _ = self.reopen(dirname="/src", algorithm="sha1")
+        j.record_state("a" * 40, "uploaded")
+        j.close()
+
+        j, resumed = self.reopen(dirname="/src", algorithm="sha256")
+        self.assertFalse(resumed)
+        self.assertEqual(j.states, {})
+
+    def test_different_upload_aborts(self):
+        # Multipart uploads in a discarded journal are aborted
+        b = MemoryBackend()
+        j, _ = self.reopen(store=b, dirname="/src", bucket=b.name)
+        j.start_multipart("objects/e", b.start_multipart("objects/e"), 16)
+        j.start_multipart("objects/f", "gone", 16)
+        j.close()
+
+        j, resumed = self.reopen(store=b, dirname="/other", bucket=b.name)
+        self.assertFalse(resumed)
+        self.assertEqual(b.uploads, {})
+        self.assertEqual(j.multipart, {})
+
+        # Unless they're in a different bucket
+        j.start_multipart("objects/e", b.start_multipart("objects/e"), 16)
+        j.close()
+        self.reopen(store=MemoryBackend("other"), dirname="/src", bucket="other")
+        self.assertEqual(len(b.uploads), 1)
+
+    def test_discard(self):
+        b = MemoryBackend()
+        j, _ = self.reopen(dirname="/src", bucket=b.name)
+        j.start_multipart("objects/e", b.start_multipart("objects/e"), 16)
+        j.close()
+
+        UploadJournal(self.filename).discard(b)
+        self.assertEqual(b.uploads, {})
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_recent_states(self):
+        j, _ = self.reopen(dirname="/src")
+        j.record_state("a" * 40, "uploaded")
+        j.close()
+        with open(self.filename, 'ab') as f:
+            old = {'type': 'state', 'hash': "b" * 40, 'state': 'uploaded', 'time': time.time() - 7200}
+            f.write(json.dumps(old).encode('utf8') + b'\n')
+            # Recorded before states had times
+            f.write(b'{"type":"state","hash":"' + b"c" * 40 + b'","state":"checked"}\n')
+
+        j, _ = self.reopen(dirname="/src")
+        self.assertEqual(len(j.states), 3)
+        self.assertEqual(j.recent_states(3600), {"a" * 40: "uploaded"})
+        self.assertEqual(sorted(j.recent_states(86400)), ["a" * 40, "b" * 40])
+
+    def test_torn_record(self):
+        j, _ = self.reopen(dirname="/src")
+        j.record_state("a" * 40, "uploaded")
+        j.close()
+        with open(self.filename, 'ab') as f:
+            f.write(b'{"type":"state","hash":"bb')
+
+        j, resumed = self.reopen(dirname="/src")
+        self.assertTrue(resumed)
+        self.assertEqual(list(j.states), ["a" * 40])
+
+    def test_published(self):
+        j, _ = self.reopen(dirname="/src")
+        j.record_state("a" * 40, "uploaded")
+        j.record_published()
+        j.record_state("b" * 40, "uploaded")
+        j.close()
+
+        j, _ = self.reopen(dirname="/src")
+        self.assertEqual(j.published, set(["a" * 40]))
+
+    def test_hasher(self):
+        data = os.path.join(self.tmpdir, "data")
+        with open(data, 'wb') as f:
+            f.write(b'hello')
+        calls = []
+
+        def hash_file(filename):
+            calls.append(filename)
+            return "h{}".format(len(calls))
+
+        j, _ = self.reopen(dirname=self.tmpdir)
+        self.assertEqual(j.hasher(hash_file)(data), "h1")
+        j.close()
+
+        j, _ = self.reopen(dirname=self.tmpdir)
+        self.assertEqual(j.hasher(hash_file)(data), "h1")
+        self.assertEqual(len(calls), 1)
+
+        # Changed files are hashed again
+        with open(data, 'wb') as f:
+            f.write(b'hello world')
+        self.assertEqual(j.hasher(hash_file)(data), "h2")
+
+    def test_remove(self):
+        j, _ = self.reopen(dirname="/src")
+        j.remove()
+        self.assertFalse(os.path.exists(self.filename))
+
+
+class TestPutMultipart(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = UploadJournal(os.path.join(self.tmpdir, "journal"))
+        self.journal.begin()
+        self.bucket = MemoryBackend()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        b = self.bucket
+        upload_id = b.start_multipart('objects/abc')
+        self.journal.start_multipart('objects/abc', upload_id, 4)
+        etag = b.put_part('objects/abc', upload_id, 1, b'hell')
+        self.journal.record_part('objects/abc', upload_id, 1, etag)
+
+        resume = UploadJournal(self.journal.filename)
+        resume.load()
+        sent = []
+        put_part = b.put_part
+        b.put_part = lambda name, upload_id, n, data: sent.append(n) or put_part(name, upload_id, n, data)
+        _put_multipart(b, 'objects/abc', BytesIO(b'hello world'), None, False, self.journal,
+                       resume.multipart['objects/abc'])
+        # The first part isn't sent again
+        self.assertEqual(sent, [2, 3])
+        self.assertEqual(b.get('objects/abc'), b'hello world')
+        self.assertEqual(b.head('objects/abc').etag.split('-')[1], '3')
+        self.assertEqual(self.journal.multipart, {})
+
+    def test_restart(self):
+        # An upload that has gone away is started again
+        progress = {'upload_id': 'gone', 'part_size': 4, 'parts': {1: 'etag'}}
+        _put_multipart(self.bucket, 'objects/abc', BytesIO(b'hello world'), None, False, self.journal, progress)
+        self.assertEqual(self.bucket.get('objects/abc'), b'hello world')
+        self.assertEqual(self.bucket.uploads, {})
+
+        # One with a bad part is aborted and started again
+        upload_id = self.bucket.start_multipart('objects/abc')
+        progress = {'upload_id': upload_id, 'part_size': 4, 'parts': {1: 'bad'}}
+        _put_multipart(self.bucket, 'objects/abc', BytesIO(b'hello world'), None, False, self.journal, progress)
+        self.assertEqual(self.bucket.uploads, {})
+
+    def failing_parts(self, error):
+        def put_part(name, upload_id, n, data):
+            raise error
+        self.bucket.put_part = put_part
+
+    def test_abort(self):
+        # Errors that won't go away abort the upload
+        self.failing_parts(StorageError(403, 'AccessDenied'))
+        with self.assertRaises(StorageError):
+            _put_multipart(self.bucket, 'objects/abc', BytesIO(b'hello world'), None, False, self.journal)
+        self.assertEqual(self.bucket.uploads, {})
+        self.assertEqual(self.journal.multipart, {})
+
+        # Others leave it to be resumed
+        self.failing_parts(StorageError(503, 'SlowDown'))
+        with self.assertRaises(StorageError):
+            _put_multipart(self.bucket, 'objects/abc', BytesIO(b'hello world'), None, False, self.journal)
+        self.assertEqual(len(self.bucket.uploads), 1)
+        self.assertEqual(list(self.journal.multipart), ['objects/abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_listing
+----------------------------------
+
+Tests for `hashsync.listing` module.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from hashsync.listing import hex_prefixes, Checkpoint, map_prefixes
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hex_prefixes(self):
+        self.assertEqual(len(hex_prefixes(1)), 16)
+        prefixes = hex_prefixes(2)
+        self.assertEqual(len(prefixes), 256)
+        self.assertEqual(prefixes[0], '00')
+        self.assertEqual(prefixes[-1], 'ff')
+
+    def test_checkpoint(self):
+        c = Checkpoint(os.path.join(self.tmpdir, "checkpoints"))
+        self.assertIsNone(c.get('objects/0'))
+        c.mark('objects/0', ['hash1'])
+        self.assertEqual(c.get('objects/0'), ['hash1'])
+        self.assertIsNone(c.get('objects/1'))
+        c.clear()
+        self.assertIsNone(c.get('objects/0'))
+
+    def test_checkpoint_run(self):
+        dirname = os.path.join(self.tmpdir, "checkpoints")
+        c = Checkpoint(dirname)
+        started = c.begin({'cutoff': 100, 'manifests': ('a',)})
+        c.mark('objects/0', ['hash1'])
+
+        # The same run is resumed, with its original start time
+        c = Checkpoint(dirname)
+        self.assertEqual(c.begin({'cutoff': 100, 'manifests': ['a']}), started)
+        self.assertEqual(c.get('objects/0'), ['hash1'])
+
+        # A different run starts over
+        self.assertGreaterEqual(c.begin({'cutoff': 200, 'manifests': ['a']}), started)
+        self.assertIsNone(c.get('objects/0'))
+
+        # And so does one that's too old to trust
+        c.mark('objects/0', ['hash1'])
+        Checkpoint(dirname).begin({'cutoff': 200, 'manifests': ['a']}, max_age=-1)
+        self.assertIsNone(c.get('objects/0'))
+
+    def test_map_prefixes(self):
+        results = dict(map_prefixes(lambda p: p * 2, ['a', 'b', 'c'], 2))
+        self.assertEqual(results, {'a': 'aa', 'b': 'bb', 'c': 'cc'})
+
+    def test_map_prefixes_resume(self):
+        c = Checkpoint(os.path.join(self.tmpdir, "checkpoints"))
+        c.mark('a', 'from checkpoint')
+
+        called = []
+
+        def func(p):
+            called.append(p)
+            return p
+
+        results = dict(map_prefixes(func, ['a', 'b'], 2, c))
+        self.assertEqual(results, {'a': 'from checkpoint', 'b': 'b'})
+        self.assertEqual(called, ['b'])
+        self.assertEqual(c.get('b'), 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
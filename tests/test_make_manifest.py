@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_make_manifest
+----------------------------------
+
+Tests for deleting objects in `make_manifest.py`.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from collections import defaultdict
+
+import make_manifest
+from make_manifest import (DeleteStats, Reaper, delete_objects, delete_old_keys, newest_versions, reap_bucket,
+                           sweep_unreachable)
+from hashsync import config, connection
+from hashsync.hashing import get_algorithm
+from hashsync.listing import Checkpoint
+from hashsync.manifest import Manifest
+from hashsync.objectlist import ShardedObjectList
+from hashsync.reachable import mark_manifests
+from hashsync.storage import DeleteResult, MemoryBackend, ObjectInfo, StorageError
+from hashsync.throttle import AdaptiveConcurrency, AdaptiveRateLimiter
+
+DAY = 86400
+
+
+class VersionedBackend(MemoryBackend):
+    """
+    A MemoryBackend whose objects can have older versions, and whose deletes
+    can be made to fail
+    """
+    def __init__(self):
+        MemoryBackend.__init__(self)
+        # Name to the (last_modified, version_id) of its older versions
+        self.old_versions = defaultdict(list)
+        # Name to the error codes to fail deletes of it with, one per attempt
+        self.delete_errors = defaultdict(list)
+        # Exceptions to raise from delete requests, one per request
+        self.delete_raises = []
+        self.listed = []
+
+    def list_versions(self, prefix=''):
+        self.listed.append(prefix)
+        for info in self.list(prefix):
+            for d, v in self.old_versions.get(info.name, []):
+                yield ObjectInfo(info.name, info.size, last_modified=d, version_id=v)
+            info.version_id = 'current'
+            yield info
+
+    def delete(self, keys):
+        result = DeleteResult()
+        with self.lock:
+            if self.delete_raises:
+                raise self.delete_raises.pop(0)
+            for key in keys:
+                name, version_id = key if isinstance(key, tuple) else (key, None)
+                if self.delete_errors.get(name):
+                    result.errors.append((name, version_id, self.delete_errors[name].pop(0), "failed"))
+                    continue
+                if version_id in ('current', None):
+                    self.objects.pop(name, None)
+                else:
+                    self.old_versions[name] = [o for o in self.old_versions[name] if o[1] != version_id]
+                result.deleted.append((name, version_id))
+        return result
+
+    def age(self, name, seconds):
+        "Makes name look like it was last modified seconds ago"
+        self.objects[name][1].last_modified = time.time() - seconds
+
+
+class ListReaper(object):
+    "Collects the keys queued for deletion"
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, key):
+        self.deleted.append(key)
+
+
+class MakeManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = VersionedBackend()
+        self.old_bucket = connection.BUCKET
+        connection.BUCKET = self.bucket
+        # Don't wait between delete requests
+        self.patch(config, "DELETE_RATE", 1000.0)
+        self.patch(config, "DELETE_MAX_RATE", 1000.0)
+        self.sha1 = get_algorithm("sha1")
+
+    def tearDown(self):
+        connection.BUCKET = self.old_bucket
+        shutil.rmtree(self.tmpdir)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def put(self, data, age=0):
+        "Stores an object with the given contents and age, returning its hash"
+        h = self.sha1.hash_data(data)
+        self.bucket.put(self.sha1.key(h), data)
+        self.bucket.age(self.sha1.key(h), age)
+        return h
+
+    def limiter(self):
+        return AdaptiveRateLimiter(1000.0, 1.0, 1000.0)
+
+
+class TestDeleteObjects(MakeManifestTest):
+    def test_newest_versions(self):
+        h = self.put(b"a")
+        key = self.sha1.key(h)
+        self.bucket.old_versions[key] = [(time.time() - 2 * DAY, 'v1'), (time.time() - DAY, 'v2')]
+        other = self.put(b"b")
+        reaper = ListReaper()
+
+        newest = list(newest_versions("objects/", reaper))
+        self.assertEqual(sorted((k, v) for k, d, v in newest),
+                         sorted([(key, 'current'), (self.sha1.key(other), 'current')]))
+        # Only the older versions are deleted
+        self.assertEqual(sorted(reaper.deleted), [(key, 'v1'), (key, 'v2')])
+
+    def test_retries(self):
+        stats = DeleteStats()
+        limiter = self.limiter()
+        concurrency = AdaptiveConcurrency(4, 1, 4)
+        keys = [(self.sha1.key(self.put(data)), 'current') for data in (b"a", b"b", b"c")]
+        # Throttled keys are tried again, and slow us down
+        self.bucket.delete_errors[keys[0][0]] = ['SlowDown']
+        # Keys that fail for other reasons are given up on straight away
+        self.bucket.delete_errors[keys[1][0]] = ['AccessDenied']
+
+        delete_objects(keys, limiter, stats, concurrency=concurrency)
+        self.assertEqual((stats.deleted, stats.retried, stats.failed), (2, 1, 1))
+        self.assertNotIn(keys[0][0], self.bucket.objects)
+        self.assertIn(keys[1][0], self.bucket.objects)
+        self.assertLess(limiter.rate, 1000.0)
+        self.assertLess(concurrency.limit, 4)
+        self.assertEqual(concurrency.in_flight, 0)
+
+    def test_give_up(self):
+        stats = DeleteStats()
+        key = (self.sha1.key(self.put(b"a")), 'current')
+        self.bucket.delete_errors[key[0]] = ['SlowDown'] * 10
+
+        delete_objects([key], self.limiter(), stats, max_attempts=3)
+        self.assertEqual((stats.deleted, stats.retried, stats.failed), (0, 3, 1))
+        self.assertIn(key[0], self.bucket.objects)
+
+    def test_overloaded(self):
+        stats = DeleteStats()
+        limiter = self.limiter()
+        key = (self.sha1.key(self.put(b"a")), 'current')
+        # Whole requests failing with 503s are retried too
+        self.bucket.delete_raises = [StorageError(503, 'ServiceUnavailable')]
+        delete_objects([key], limiter, stats)
+        self.assertEqual((stats.deleted, stats.retried, stats.failed), (1, 1, 0))
+        self.assertLess(limiter.rate, 1000.0)
+
+        # But other errors aren't
+        self.bucket.delete_raises = [StorageError(403, 'AccessDenied')]
+        self.assertRaises(StorageError, delete_objects, [key], limiter, stats)
+
+
+class TestReapBucket(MakeManifestTest):
+    def setUp(self):
+        MakeManifestTest.setUp(self)
+        self.cwd = os.getcwd()
+        # Object lists are cached in the current directory
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        MakeManifestTest.tearDown(self)
+
+    def object_list(self):
+        object_list = ShardedObjectList(self.bucket)
+        object_list.load()
+        return object_list
+
+    def test_delete_old_keys(self):
+        new = self.put(b"new", DAY)
+        expired = self.put(b"expired", 10 * DAY)
+        listed = self.put(b"listed", 40 * DAY)
+        old = self.put(b"old", 40 * DAY)
+        # Objects in the object list are protected
+        ShardedObjectList(self.bucket).publish([listed])
+
+        object_lists = delete_old_keys(time.time() - 7 * DAY, jobs=4, reaper=Reaper(jobs=2))
+        self.assertNotIn(self.sha1.key(old), self.bucket.objects)
+        for h in (new, expired, listed):
+            self.assertIn(self.sha1.key(h), self.bucket.objects)
+
+        # Only new objects go in the new object list
+        self.assertEqual(object_lists[0].objects, set([new]))
+        object_lists[0].save()
+        self.assertEqual(self.object_list().objects, set([new]))
+
+    def test_checkpoint(self):
+        hashes = [self.put(data, 40 * DAY) for data in (b"a", b"b", b"c", b"d", b"e", b"f", b"g", b"h")]
+        new = self.put(b"new")
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, "checkpoints"))
+        now = checkpoint.begin({})
+        too_old = now - 7 * DAY
+        bucket = self.bucket
+        key = self.sha1.key
+
+        class CheckedCheckpoint(Checkpoint):
+            def mark(self, prefix, result):
+                # The prefix's deletes have been sent by the time it's marked
+                for h in hashes:
+                    if key(h).startswith(prefix):
+                        assert key(h) not in bucket.objects, prefix
+                Checkpoint.mark(self, prefix, result)
+
+        checkpoint = CheckedCheckpoint(checkpoint.dirname)
+
+        # Fail partway through
+        failing = self.sha1.prefix + hashes[0][0]
+        list_versions = self.bucket.list_versions
+
+        def broken_list_versions(prefix=''):
+            if prefix == failing:
+                raise StorageError(500, 'InternalError')
+            return list_versions(prefix)
+        self.bucket.list_versions = broken_list_versions
+
+        def reap(prefix, object_list, reaper, algorithm):
+            return make_manifest.reap_prefix(prefix, object_list, reaper, too_old, now)
+        with self.assertRaises(StorageError):
+            reap_bucket(reap, jobs=1, checkpoint=checkpoint, reaper=Reaper(jobs=1))
+        listed = self.bucket.listed
+        done = [p for p in listed if checkpoint.get(p) is not None]
+        self.assertTrue(done)
+        self.assertNotIn(failing, done)
+
+        # Resuming only lists what's left
+        self.bucket.list_versions = list_versions
+        self.bucket.listed = []
+        object_lists = reap_bucket(reap, jobs=1, checkpoint=checkpoint, reaper=Reaper(jobs=1))
+        self.assertFalse(set(done) & set(self.bucket.listed))
+        self.assertEqual(set(done) | set(self.bucket.listed), set(listed + [failing]))
+        for h in hashes:
+            self.assertNotIn(self.sha1.key(h), self.bucket.objects)
+        # Results recorded before the interruption still count
+        self.assertEqual(object_lists[0].objects, set([new]))
+
+    def test_sweep_unreachable(self):
+        referenced = self.put(b"referenced", 40 * DAY)
+        unreferenced = self.put(b"unreferenced", 40 * DAY)
+        in_grace = self.put(b"in grace", DAY)
+        # Keys that aren't hashes are left alone
+        self.bucket.put("objects/0-not-a-hash", b"x")
+        self.bucket.age("objects/0-not-a-hash", 40 * DAY)
+
+        m = Manifest()
+        m.add(referenced, u'file', 0o644)
+        filename = os.path.join(self.tmpdir, "manifest")
+        with open(filename, 'wb') as f:
+            m.save(f)
+        reachable = mark_manifests([filename])
+
+        object_lists = sweep_unreachable(reachable, grace=7 * DAY, jobs=4, reaper=Reaper(jobs=2))
+        self.assertNotIn(self.sha1.key(unreferenced), self.bucket.objects)
+        for h in (referenced, in_grace):
+            self.assertIn(self.sha1.key(h), self.bucket.objects)
+        self.assertIn("objects/0-not-a-hash", self.bucket.objects)
+        self.assertEqual(object_lists[0].objects, set([referenced, in_grace]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ test_manifest
 Tests for `hashsync.manifest` module.
 """
 
+import json
 import unittest
 
 from io import BytesIO
@@ -21,6 +22,19 @@ class TestManifest(unittest.TestCase):
 
         self.assertEqual(m.files, [('hashhashhash', 'dirname/filename', 0o644)])
 
+    def test_under(self):
+        m = Manifest()
+        for i, f in enumerate(['src/b', 'src.txt', 'src', 'src/a/c', 'srcs/d', 'a']):
+            m.add('hash%i' % i, f, 0o644)
+        self.assertEqual([f for _, f, _ in m.under('src')], ['src/b', 'src', 'src/a/c'])
+        self.assertEqual([f for _, f, _ in m.under('src/a')], ['src/a/c'])
+        self.assertEqual(m.under('missing'), [])
+        self.assertEqual(len(m.under('')), 6)
+
+        # The index is rebuilt as files are added
+        m.add('hash6', 'src/e', 0o644)
+        self.assertEqual([f for _, f, _ in m.under('src')], ['src/b', 'src', 'src/a/c', 'src/e'])
+
     def test_load(self):
         manifest_data = BytesIO(b'''
 [
@@ -51,6 +65,67 @@ class TestManifest(unittest.TestCase):
         self.assertEqual(data, b"""\
 [["hash1","dirname/\\u2603",420]]""")
 
+    def test_sizes(self):
+        m = Manifest()
+        m.add('hash1', u'dirname/foo', 0o644, 123)
+        m.add('hash2', u'dirname/bar', 0o755)
+
+        dst = BytesIO()
+        m.save(dst, version=2)
+        dst.seek(0)
+
+        m2 = Manifest()
+        m2.load(dst)
+        # Sizes are kept separately so files stay hash, filename, perms
+        self.assertEqual(m2.files, m.files)
+        self.assertEqual(m2.sizes, {'hash1': 123})
+
+    def test_format(self):
+        m = Manifest()
+        m.add('hash1', u'dirname/foo', 0o644, 123)
+
+        # Format 1 is what older download.py can read: just hash, filename
+        # and perms
+        dst = BytesIO()
+        m.save(dst, version=1)
+        self.assertEqual([len(e) for e in json.loads(dst.getvalue().decode("utf8"))], [3])
+
+        # Chunks can't be left out, so they need format 2
+        m.add('hash2', u'dirname/big', 0o644, 30, [('chunk1', 10), ('chunk2', 20)])
+        self.assertEqual(m.format_needed(), 2)
+        dst = BytesIO()
+        m.save(dst, version=1)
+        self.assertEqual([len(e) for e in json.loads(dst.getvalue().decode("utf8"))], [4, 5])
+
+    def test_chunks(self):
+        m = Manifest()
+        m.add('hash1', u'dirname/big', 0o644, 30, [('chunk1', 10), ('chunk2', 20)])
+        m.add('hash1', u'dirname/big2', 0o644, 30, [('chunk1', 10), ('chunk2', 20)])
+
+        dst = BytesIO()
+        m.save(dst)
+        # The chunks are only listed once
+        self.assertEqual(dst.getvalue().count(b'chunk1'), 1)
+        dst.seek(0)
+
+        m2 = Manifest()
+        m2.load(dst)
+        self.assertEqual(m2.files, m.files)
+        self.assertEqual(m2.chunks, {'hash1': [('chunk1', 10), ('chunk2', 20)]})
+
+    def test_algorithm(self):
+        m = Manifest("sha1-tree")
+        m.add('hash1', u'dirname/foo', 0o644, 123)
+
+        dst = BytesIO()
+        m.save(dst)
+        dst.seek(0)
+
+        m2 = Manifest()
+        m2.load(dst)
+        self.assertEqual(m2.algorithm, "sha1-tree")
+        self.assertEqual(m2.files, m.files)
+
     def test_spaces(self):
         m = Manifest()
         m.add('hash1', u'dirname/file with space.txt', 0o755)
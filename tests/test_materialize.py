@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_materialize
+----------------------------------
+
+Tests for `hashsync.materialize` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hashsync.materialize import Materializer
+from hashsync.metrics import METRICS
+
+
+class TestMaterializer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        METRICS.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *bits):
+        return os.path.join(self.tmpdir, *bits)
+
+    def mode(self, *bits):
+        return os.stat(self.path(*bits)).st_mode & 0o777
+
+    def test_make_dirs(self):
+        m = Materializer()
+        m.exists(self.tmpdir)
+        os.mkdir(self.path("a"))
+        m.make_dirs([self.path("a", "b", "c", "f1"), self.path("a", "b", "f2"), self.path("a", "f3"),
+                     self.path("d", "f4"), self.path("f5")])
+        self.assertTrue(os.path.isdir(self.path("a", "b", "c")))
+        self.assertTrue(os.path.isdir(self.path("d")))
+        # Each missing directory is made once; a/ already existed
+        self.assertEqual(METRICS.counters[("hashsync_mkdir_total", ())], 3)
+
+        # Directories we've made aren't looked at again
+        m.make_dirs([self.path("a", "b", "c", "f6")])
+        self.assertEqual(METRICS.counters[("hashsync_mkdir_total", ())], 3)
+
+    def test_permissions(self):
+        m = Materializer()
+        for f in ["same", "changed", "new", "new_exec"]:
+            with open(self.path(f), 'wb'):
+                pass
+            os.chmod(self.path(f), m.new_mode)
+        m.existing(self.path("same"), m.new_mode)
+        m.existing(self.path("changed"), 0o600)
+        m.created(self.path("new"), m.new_mode)
+        m.created(self.path("new_exec"), 0o755)
+        # Only files whose mode is wrong are chmodded
+        self.assertEqual(sorted(m.chmods), [self.path("changed"), self.path("new_exec")])
+
+        m.apply()
+        self.assertEqual(self.mode("changed"), 0o600)
+        self.assertEqual(self.mode("new_exec"), 0o755)
+        self.assertEqual(self.mode("same"), m.new_mode)
+        self.assertEqual(m.chmods, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_metrics
+----------------------------------
+
+Tests for `hashsync.metrics` module.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from hashsync.metrics import METRICS, Metrics, InstrumentedBackend, QueueDepth, collect
+from hashsync.storage import MemoryBackend, NotFound
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counters(self):
+        m = Metrics()
+        m.incr("requests", op="get")
+        m.incr("requests", 2, op="get")
+        m.incr("requests", op="put")
+        d = m.to_dict()
+        self.assertEqual(d['counters'], {'requests{op="get"}': 3, 'requests{op="put"}': 1})
+
+    def test_histogram(self):
+        m = Metrics()
+        m.observe("latency", 0.001)
+        m.observe("latency", 0.2)
+        m.observe("latency", 1000)
+        h = m.to_dict()['histograms']['latency']
+        self.assertEqual(h['count'], 3)
+        self.assertAlmostEqual(h['sum'], 1000.201)
+        self.assertEqual(h['buckets']['0.005'], 1)
+        self.assertEqual(h['buckets']['0.25'], 1)
+        # Values larger than the largest bucket are only counted in +Inf
+        self.assertEqual(sum(h['buckets'].values()), 2)
+
+    def test_gauge_max(self):
+        m = Metrics()
+        m.set_gauge("depth", 5)
+        m.set_gauge("depth", 2)
+        self.assertEqual(m.to_dict()['gauges'], {'depth': 2, 'depth_max': 5})
+
+    def test_merge(self):
+        a = Metrics()
+        b = Metrics()
+        a.incr("n")
+        a.observe("t", 1)
+        a.set_gauge("depth", 3)
+        b.incr("n", 2)
+        b.observe("t", 2)
+        b.set_gauge("depth", 7)
+        b.set_gauge("depth", 1)
+        a.merge(b.snapshot())
+        d = a.to_dict()
+        self.assertEqual(d['counters'], {'n': 3})
+        self.assertEqual(d['histograms']['t']['count'], 2)
+        self.assertEqual(d['histograms']['t']['sum'], 3)
+        self.assertEqual(d['gauges']['depth_max'], 7)
+
+    def test_prometheus(self):
+        m = Metrics()
+        m.incr("hashsync_requests_total", op="get")
+        m.observe("hashsync_request_seconds", 0.5, op="get")
+        text = m.to_prometheus()
+        lines = text.splitlines()
+        self.assertIn('# TYPE hashsync_requests_total counter', lines)
+        self.assertIn('hashsync_requests_total{op="get"} 1.0', lines)
+        self.assertIn('# TYPE hashsync_request_seconds histogram', lines)
+        self.assertIn('hashsync_request_seconds_bucket{op="get",le="0.25"} 0', lines)
+        self.assertIn('hashsync_request_seconds_bucket{op="get",le="0.5"} 1', lines)
+        self.assertIn('hashsync_request_seconds_bucket{op="get",le="+Inf"} 1', lines)
+        self.assertIn('hashsync_request_seconds_count{op="get"} 1', lines)
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            m = Metrics()
+            m.incr("n")
+            json_file = os.path.join(tmpdir, "metrics.json")
+            prom_file = os.path.join(tmpdir, "metrics.prom")
+            m.write(json_file, prom_file)
+            with open(json_file) as f:
+                self.assertEqual(json.load(f)['counters'], {'n': 1})
+            with open(prom_file) as f:
+                self.assertIn("n 1", f.read())
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["metrics.json", "metrics.prom"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_collect(self):
+        def work(x):
+            METRICS.incr("work")
+            return x * 2
+
+        METRICS.incr("before")
+        retval, snapshot = collect(work, 21)
+        self.assertEqual(retval, 42)
+        self.assertEqual(snapshot['counters'], {("work", ()): 1})
+
+    def test_queue_depth(self):
+        METRICS.reset()
+        q = QueueDepth()
+        q.submitted()
+        q.submitted()
+        q.done()
+        gauges = METRICS.to_dict()['gauges']
+        self.assertEqual(gauges['hashsync_queue_depth'], 1)
+        self.assertEqual(gauges['hashsync_queue_depth_max'], 2)
+
+
+class TestInstrumentedBackend(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.backend = InstrumentedBackend(MemoryBackend())
+
+    def test_requests(self):
+        b = self.backend
+        b.put('objects/a', b'hello')
+        b.put('objects/b', BytesIO(b'hello world'))
+        self.assertEqual(b.get('objects/a'), b'hello')
+        dst = BytesIO()
+        b.get_to_file('objects/b', dst)
+        self.assertEqual(dst.getvalue(), b'hello world')
+        self.assertRaises(NotFound, b.get, 'objects/missing')
+        self.assertEqual(len(list(b.list('objects/'))), 2)
+
+        d = METRICS.to_dict()
+        counters = d['counters']
+        self.assertEqual(counters['hashsync_requests_total{op="put"}'], 2)
+        self.assertEqual(counters['hashsync_requests_total{op="get"}'], 3)
+        self.assertEqual(counters['hashsync_requests_total{op="list"}'], 1)
+        self.assertEqual(counters['hashsync_request_errors_total{op="get"}'], 1)
+        self.assertEqual(counters['hashsync_bytes_total{direction="out"}'], 16)
+        self.assertEqual(counters['hashsync_bytes_total{direction="in"}'], 16)
+        self.assertEqual(counters['hashsync_listed_total{op="list"}'], 2)
+        self.assertEqual(d['histograms']['hashsync_request_seconds{op="get"}']['count'], 3)
+        self.assertEqual(d['histograms']['hashsync_stage_seconds{stage="network"}']['count'], 6)
+
+    def test_passthrough(self):
+        self.assertIs(self.backend.objects, self.backend.backend.objects)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,16 +7,45 @@ test_objectlist
 Tests for `hashsync.objectlist` module.
 """
 
+import os
 import unittest
+import shutil
+import tempfile
 
-import boto
-import moto
-
-from hashsync.objectlist import ObjectList
+from hashsync.objectlist import ObjectList, ShardedObjectList
 from hashsync.compression import gzip_decompress, gzip_compress
+from hashsync.storage import MemoryBackend
+
+
+class CountingBackend(MemoryBackend):
+    "A MemoryBackend that records which keys were downloaded and written"
+    def __init__(self):
+        MemoryBackend.__init__(self)
+        self.fetched = []
+        self.written = []
+
+    def get(self, name):
+        self.fetched.append(name)
+        return MemoryBackend.get(self, name)
+
+    def put(self, name, data, **kwargs):
+        self.written.append(name)
+        return MemoryBackend.put(self, name, data, **kwargs)
 
 
 class TestObjectList(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = MemoryBackend()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_list(self):
+        o = ObjectList(self.bucket)
+        o.cache_file = os.path.join(self.tmpdir, "objectlist")
+        return o
+
     def test_add(self):
         o = ObjectList(None)
         o.add("hash1")
@@ -26,46 +55,235 @@ class TestObjectList(unittest.TestCase):
         self.assertIn("hash2", o)
         self.assertNotIn("hash3", o)
 
-    @moto.mock_s3
     def test_save(self):
-        conn = boto.connect_s3()
-        bucket = conn.create_bucket('test-bucket')
-
-        o = ObjectList(bucket)
+        o = self.make_list()
         o.add("hash1")
         o.save()
 
-        key = bucket.get_key(o.keyname)
-        data = key.get_contents_as_string()
-        data = gzip_decompress(data)
-
+        self.assertEqual(self.bucket.head(o.keyname).content_encoding, 'gzip')
+        data = gzip_decompress(self.bucket.get(o.keyname))
         self.assertEqual(data, b'hash1')
 
-    @moto.mock_s3
     def test_load(self):
-        conn = boto.connect_s3()
-        bucket = conn.create_bucket('test-bucket')
-        key = bucket.new_key('objectlist')
-        key.set_contents_from_string(b'hash1\nhash2\n')
+        self.bucket.put('objectlist', b'hash1\nhash2\n')
 
-        o = ObjectList(bucket)
+        o = self.make_list()
         o.load()
 
         self.assertIn('hash1', o)
         self.assertIn('hash2', o)
         self.assertNotIn("hash3", o)
 
-    @moto.mock_s3
     def test_load_compressed(self):
-        conn = boto.connect_s3()
-        bucket = conn.create_bucket('test-bucket')
-        key = bucket.new_key('objectlist')
-        key.set_metadata('Content-Encoding', 'gzip')
-        key.set_contents_from_string(gzip_compress(b'hash1\nhash2\n'))
+        self.bucket.put('objectlist', gzip_compress(b'hash1\nhash2\n'), content_encoding='gzip')
 
-        o = ObjectList(bucket)
+        o = self.make_list()
         o.load()
 
         self.assertIn('hash1', o)
         self.assertIn('hash2', o)
         self.assertNotIn("hash3", o)
+
+    def test_load_missing(self):
+        o = self.make_list()
+        self.assertEqual(o.load(), set())
+
+    def test_load_cache(self):
+        self.bucket.put('objectlist', b'hash1\n')
+        self.make_list().load()
+
+        # The cached copy is used while the key is unchanged
+        self.bucket.objects['objectlist'] = (b'hash2\n', self.bucket.head('objectlist'))
+        o = self.make_list()
+        o.load()
+        self.assertIn('hash1', o)
+
+        # and not once it's changed
+        self.bucket.put('objectlist', b'hash2\n')
+        o = self.make_list()
+        o.load()
+        self.assertIn('hash2', o)
+        self.assertNotIn('hash1', o)
+
+
+class TestShardedObjectList(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.bucket = CountingBackend()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def make_list(self):
+        o = ShardedObjectList(self.bucket, shard_width=1)
+        o.cache_dir = self.cache_dir
+        o.cache_file = os.path.join(self.cache_dir, "objectlist")
+        return o
+
+    def keys(self):
+        return sorted(info.name for info in self.bucket.list())
+
+    def test_save_load(self):
+        o = self.make_list()
+        o.add("aaaa")
+        o.add("abcd")
+        o.add("bbbb")
+        o.save()
+
+        self.assertEqual(self.keys(), ['objectlist/shards/a', 'objectlist/shards/b'])
+        data = gzip_decompress(self.bucket.get('objectlist/shards/a'))
+        self.assertEqual(data, b'aaaa\nabcd')
+
+        o = self.make_list()
+        o.load()
+        self.assertIn('abcd', o)
+        self.assertIn('bbbb', o)
+        self.assertNotIn('cccc', o)
+
+    def test_save_unchanged(self):
+        o = self.make_list()
+        o.add("aaaa")
+        o.add("bbbb")
+        o.save()
+
+        # Only the shards whose contents changed are written
+        o = self.make_list()
+        o.load()
+        o.add("bcde")
+        self.bucket.written = []
+        o.save()
+        self.assertEqual(self.bucket.written, ['objectlist/shards/b'])
+        self.assertEqual(gzip_decompress(self.bucket.get('objectlist/shards/b')), b'bbbb\nbcde')
+
+    def test_load_cached(self):
+        o = self.make_list()
+        o.add("aaaa")
+        o.add("bbbb")
+        o.save()
+
+        # Shards we wrote ourselves are already cached
+        self.bucket.fetched = []
+        o = self.make_list()
+        o.load()
+        self.assertEqual(self.bucket.fetched, [])
+        self.assertIn('aaaa', o)
+
+        # Shards that changed since are downloaded again
+        other = self.make_list()
+        other.cache_dir = os.path.join(self.cache_dir, "other")
+        other.load()
+        other.add("bcde")
+        other.save()
+        self.bucket.fetched = []
+        o = self.make_list()
+        o.load()
+        self.assertEqual(self.bucket.fetched, ['objectlist/shards/b'])
+        self.assertIn('bcde', o)
+
+    def test_last_modified(self):
+        o = self.make_list()
+        o.add("aaaa", 100)
+        o.add("bbbb")
+        o.save()
+        o.add("aaaa", 200)
+        o.publish(["aaaa"])
+
+        o = self.make_list()
+        o.load()
+        # The newest timestamp wins
+        self.assertEqual(o.last_modified, {"aaaa": 200})
+        self.assertIn("bbbb", o)
+
+    def test_forget_added(self):
+        o = self.make_list()
+        o.add("aaaa")
+        o.save()
+
+        o = self.make_list()
+        o.load()
+        o.add("aaaa", 100)
+        o.add("bbbb", 100)
+        o.publish(["bbbb"])
+        o.add("cccc", 100)
+        # Only what hasn't been published is dropped
+        o.forget_added()
+        self.assertEqual(o.objects, set(["aaaa", "bbbb"]))
+        self.assertNotIn("cccc", o.last_modified)
+        self.assertIsNone(o.publish())
+
+    def test_load_unsharded(self):
+        self.bucket.put('objectlist', b'hash1\nhash2\n')
+
+        o = self.make_list()
+        o.load()
+        self.assertIn('hash1', o)
+
+    def test_load_unsharded_with_deltas(self):
+        self.bucket.put('objectlist', b'hash1\nhash2\n')
+
+        # Uploads publish deltas before anything has written shards
+        o = self.make_list()
+        o.load()
+        o.add("hash3")
+        delta = o.publish()
+
+        o = self.make_list()
+        o.load()
+        self.assertIn('hash1', o)
+        self.assertIn('hash3', o)
+        self.assertEqual(o.deltas, set([delta]))
+
+        # Saving writes shards and removes the unsharded list
+        o.save()
+        self.assertNotIn('objectlist', self.keys())
+        o = self.make_list()
+        o.load()
+        self.assertEqual(o.objects, set(['hash1', 'hash2', 'hash3']))
+
+    def test_publish(self):
+        o = self.make_list()
+        o.add("aaaa")
+        o.save()
+
+        o = self.make_list()
+        o.load()
+        o.add("bbbb")
+        delta = o.publish()
+        self.assertTrue(delta.startswith('objectlist/deltas/'))
+        self.assertIsNone(o.publish())
+
+        o = self.make_list()
+        o.load()
+        self.assertIn('aaaa', o)
+        self.assertIn('bbbb', o)
+        self.assertEqual(o.deltas, set([delta]))
+
+        # Saving folds the delta into the shards
+        o.save()
+        self.assertIsNone(self.bucket.head(delta))
+        self.assertIsNotNone(self.bucket.head('objectlist/shards/b'))
+        self.assertEqual(o.deltas, set())
+
+        o = self.make_list()
+        o.load()
+        self.assertEqual(o.objects, set(['aaaa', 'bbbb']))
+
+    def test_save_keeps_new_deltas(self):
+        o = self.make_list()
+        o.load()
+
+        # A delta published after we loaded isn't removed by our save
+        other = self.make_list()
+        other.add("cccc")
+        delta = other.publish()
+        o.add("aaaa")
+        o.save()
+        self.assertIsNotNone(self.bucket.head(delta))
+
+        o = self.make_list()
+        o.load()
+        self.assertEqual(o.objects, set(['aaaa', 'cccc']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_pathfilter
+----------------------------------
+
+Tests for `hashsync.pathfilter` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hashsync.manifest import Manifest
+from hashsync.pathfilter import PathFilter, literal_prefix
+
+FILES = ["README", "docs/index.txt", "src/a.c", "src/lib/b.c", "src/lib/b.h", "src.txt", "src-old/c.c"]
+
+
+class TestPathFilter(unittest.TestCase):
+    def setUp(self):
+        self.manifest = Manifest()
+        for i, f in enumerate(FILES):
+            self.manifest.add("%040x" % i, f, 0o644)
+
+    def selected(self, include=None, exclude=None):
+        return [f for _, f, _ in PathFilter(include, exclude).select(self.manifest)]
+
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix("src/lib/*.c"), "src/lib")
+        self.assertEqual(literal_prefix("*.c"), "")
+        self.assertEqual(literal_prefix("src"), "src")
+
+    def test_everything(self):
+        self.assertFalse(PathFilter())
+        self.assertEqual(self.selected(), FILES)
+        self.assertEqual(self.selected(["/"]), FILES)
+
+    def test_directory(self):
+        # Files that only share a prefix with the directory aren't included
+        self.assertEqual(self.selected(["src/"]), ["src/a.c", "src/lib/b.c", "src/lib/b.h"])
+        self.assertEqual(self.selected(["src/lib/b.h"]), ["src/lib/b.h"])
+
+    def test_globs(self):
+        self.assertEqual(self.selected(["*.c"]), ["src/a.c", "src/lib/b.c", "src-old/c.c"])
+        self.assertEqual(self.selected(["src/lib/*.h", "docs"]), ["docs/index.txt", "src/lib/b.h"])
+        self.assertEqual(self.selected(["src*"], ["*.h", "src-old"]), ["src/a.c", "src/lib/b.c", "src.txt"])
+
+    def test_roots(self):
+        self.assertEqual(PathFilter(["src/lib/*.c", "src", "docs/*"]).roots(), ["docs", "src"])
+        self.assertEqual(PathFilter(["src", "*.txt"]).roots(), [""])
+        self.assertEqual(PathFilter(exclude=["src"]).roots(), [""])
+
+    def test_traverse(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for f in FILES:
+            path = os.path.join(tmpdir, f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fp:
+                fp.write(b'data')
+
+        seen = []
+
+        def action(filename):
+            seen.append(filename)
+            return len(filename)
+
+        found = list(PathFilter(["src", "README"], ["src/lib/*.h"]).traverse(tmpdir, action))
+        expected = [os.path.join(tmpdir, f) for f in ["README", "src/a.c", "src/lib/b.c"]]
+        self.assertEqual([f for f, _ in found], expected)
+        # Only the selected files are passed to action
+        self.assertEqual(seen, expected)
+
+        # Excluded directories aren't walked
+        self.assertEqual([f for f, _ in PathFilter(exclude=["src"]).traverse(tmpdir, os.path.basename)],
+                         [os.path.join(tmpdir, f) for f in ["README", "src.txt", "docs/index.txt", "src-old/c.c"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
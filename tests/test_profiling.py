@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_profiling
+----------------------------------
+
+Tests for `hashsync.profiling` module.
+"""
+
+import multiprocessing
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from hashsync import profiling
+
+
+def square(x):
+    return x * x
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiling.PROFILER = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_workers(self):
+        # Profiles left by an earlier run aren't merged
+        old = profiling.Profiler(self.tmpdir, run_id="old")
+        old.start()
+        old.dump()
+
+        profiling.start(self.tmpdir, memory=True)
+        run_id = profiling.PROFILER.run_id
+        pool = multiprocessing.Pool(2, initializer=profiling.init_worker)
+        self.assertEqual(pool.map(square, range(10)), [x * x for x in range(10)])
+        pool.close()
+        pool.join()
+
+        threads = ThreadPool(2, initializer=profiling.init_thread)
+        threads.map(square, range(10))
+        threads.close()
+        threads.join()
+        profiling.stop()
+
+        files = os.listdir(self.tmpdir)
+        self.assertEqual(len([f for f in files if f.startswith(run_id + "-worker-") and f.endswith(".prof")]), 2)
+        self.assertEqual(len([f for f in files if f.startswith(run_id + "-main-") and f.endswith(".tracemalloc")]), 1)
+        self.assertIn("merged.prof", files)
+        with open(os.path.join(self.tmpdir, "report.txt")) as f:
+            report = f.read()
+        self.assertIn("merged from 3 processes", report)
+        self.assertIn("Top allocations", report)
+        # Calls in worker processes and threads are all counted
+        stats = pstats.Stats(os.path.join(self.tmpdir, "merged.prof")).stats
+        calls = [v[1] for k, v in stats.items() if k[2] == "square"]
+        self.assertEqual(calls, [20])
+        self.assertIsNone(profiling.PROFILER)
+        import tracemalloc
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_disabled(self):
+        # Without start(), the initializers do nothing
+        profiling.init_worker()
+        profiling.init_thread()
+        profiling.stop()
+        self.assertIsNone(profiling.PROFILER)
+
+
+if __name__ == '__main__':
+    unittest.main()
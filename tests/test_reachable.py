@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_reachable
+----------------------------------
+
+Tests for `hashsync.reachable` module.
+"""
+
+import unittest
+import binascii
+import hashlib
+import os
+import shutil
+import tempfile
+
+from hashsync.reachable import HashSet, mark_manifests
+from hashsync.manifest import Manifest
+
+
+def make_hash(i):
+    return hashlib.sha1(str(i).encode("ascii")).hexdigest()
+
+
+class TestHashSet(unittest.TestCase):
+    def test_contains(self):
+        s = HashSet(batch_size=7)
+        for i in range(100):
+            s.add(make_hash(i))
+        # Duplicates are only stored once
+        s.add(make_hash(0))
+
+        self.assertEqual(len(s), 100)
+        self.assertEqual(len(s.data), 100 * 20)
+        for i in range(100):
+            self.assertIn(make_hash(i), s)
+        self.assertNotIn(make_hash(100), s)
+
+    def test_runs(self):
+        s = HashSet(batch_size=1)
+        for i in reversed(range(50)):
+            s.add(make_hash(i))
+        # Runs are merged as they're added, rather than kept one per batch
+        self.assertLessEqual(len(s.runs), 6)
+        self.assertEqual(len(s), 50)
+        self.assertEqual(len(s.runs), 1)
+        digests = sorted(binascii.unhexlify(make_hash(i)) for i in range(50))
+        self.assertEqual(bytes(s.data), b''.join(digests))
+
+    def test_invalid(self):
+        s = HashSet()
+        # Strings that aren't hashes are skipped rather than stopping a sweep
+        for h in ('not a hash', make_hash(0)[:-2], u'README', make_hash(0)):
+            s.add(h)
+        self.assertEqual(len(s), 1)
+        self.assertFalse(s.valid('not a hash'))
+        self.assertFalse(s.valid(make_hash(0)[:-2]))
+        self.assertTrue(s.valid(make_hash(1)))
+        self.assertNotIn('not a hash', s)
+        self.assertNotIn(make_hash(0)[:-2], s)
+        self.assertIn(make_hash(0), s)
+
+    def test_empty(self):
+        s = HashSet()
+        self.assertEqual(len(s), 0)
+        self.assertNotIn(make_hash(0), s)
+
+
+class TestMarkManifests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mark_manifests(self):
+        filenames = []
+        for i in range(2):
+            m = Manifest()
+            m.add(make_hash(i), u'file{}'.format(i), 0o644)
+            filename = os.path.join(self.tmpdir, 'manifest{}'.format(i))
+            with open(filename, 'wb') as f:
+                m.save(f)
+            filenames.append(filename)
+
+        reachable = mark_manifests(filenames)["sha1"]
+        self.assertIn(make_hash(0), reachable)
+        self.assertIn(make_hash(1), reachable)
+        self.assertNotIn(make_hash(2), reachable)
+
+    def test_mark_chunks(self):
+        m = Manifest()
+        m.add(make_hash(0), u'big', 0o644, 30, [(make_hash(1), 10), (make_hash(2), 20)])
+        filename = os.path.join(self.tmpdir, 'manifest')
+        with open(filename, 'wb') as f:
+            m.save(f)
+
+        reachable = mark_manifests([filename])["sha1"]
+        self.assertIn(make_hash(1), reachable)
+        self.assertIn(make_hash(2), reachable)
+
+    def test_mark_algorithms(self):
+        filenames = []
+        for i, algorithm in enumerate(["sha1", "sha256"]):
+            m = Manifest(algorithm)
+            m.add(hashlib.new(algorithm, b'x').hexdigest(), u'file', 0o644)
+            filename = os.path.join(self.tmpdir, 'manifest{}'.format(i))
+            with open(filename, 'wb') as f:
+                m.save(f)
+            filenames.append(filename)
+
+        # Each algorithm's hashes are kept apart
+        reachable = mark_manifests(filenames)
+        self.assertEqual(sorted(reachable), ["sha1", "sha256"])
+        self.assertIn(hashlib.sha256(b'x').hexdigest(), reachable["sha256"])
+        self.assertNotIn(hashlib.sha1(b'x').hexdigest(), reachable["sha256"])
+        self.assertIn(hashlib.sha1(b'x').hexdigest(), reachable["sha1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
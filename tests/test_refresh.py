@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_refresh
+----------------------------------
+
+Tests for `hashsync.refresh` module.
+"""
+
+import unittest
+
+from hashsync.refresh import RefreshScheduler, refresh_offset
+
+DAY = 86400
+
+
+class TestRefreshScheduler(unittest.TestCase):
+    def test_offset(self):
+        self.assertEqual(refresh_offset('00000000' + '0' * 32, DAY), 0)
+        self.assertEqual(refresh_offset('80000000' + '0' * 32, DAY), DAY // 2)
+        self.assertLess(refresh_offset('f' * 40, DAY), DAY)
+
+    def test_due(self):
+        early = '0' * 40
+        late = 'f' * 40
+        last_modified = {early: 0, late: 0}
+        s = RefreshScheduler(last_modified, now=1.5 * DAY, mintime=DAY, window=DAY)
+
+        # early objects are due as soon as they're mintime old; late ones
+        # just before mintime + window
+        self.assertTrue(s.is_due(early))
+        self.assertFalse(s.is_due(late))
+        self.assertFalse(s.is_due('1' * 40))
+
+        s.now = 2 * DAY
+        self.assertTrue(s.is_due(late))
+
+    def test_max_per_run(self):
+        hashes = ['{:040x}'.format(i) for i in range(5)]
+        last_modified = dict((h, 0) for h in hashes)
+        s = RefreshScheduler(last_modified, now=10 * DAY, mintime=DAY, window=DAY, max_per_run=3)
+
+        scheduled = [h for h in hashes if s.should_refresh(h)]
+        self.assertEqual(scheduled, hashes[:3])
+        # Objects are only scheduled once
+        self.assertFalse(s.should_refresh(hashes[0]))
+        self.assertEqual(len(s.deferred), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
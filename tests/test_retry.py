@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_retry
+----------------------------------
+
+Tests for `hashsync.retry` module.
+"""
+
+import threading
+import time
+import unittest
+
+from io import BytesIO
+
+from hashsync.metrics import METRICS
+from hashsync.retry import RetryingBackend, TransferPolicy, RequestTimeout, LatencyTracker, is_retryable
+from hashsync.storage import MemoryBackend, NotFound, StorageError
+
+
+class FlakyBackend(MemoryBackend):
+    """
+    A memory backend whose requests can be made to fail or stall. failures
+    and stalls are lists of what to do for each call; True fails or stalls
+    that call.
+    """
+    def __init__(self):
+        MemoryBackend.__init__(self)
+        self.failures = []
+        self.stalls = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _misbehave(self):
+        with self.lock:
+            n = self.calls
+            self.calls += 1
+        if n < len(self.failures) and self.failures[n]:
+            raise StorageError(503, 'ServiceUnavailable')
+        if n < len(self.stalls) and self.stalls[n]:
+            time.sleep(0.5)
+
+    def get_to_file(self, name, fobj):
+        self._misbehave()
+        MemoryBackend.get_to_file(self, name, fobj)
+
+    def head(self, name):
+        self._misbehave()
+        return MemoryBackend.head(self, name)
+
+    def put(self, name, data, **kwargs):
+        self._misbehave()
+        return MemoryBackend.put(self, name, data, **kwargs)
+
+
+class SlowBackend(MemoryBackend):
+    """
+    A memory backend that reads file bodies a chunk at a time, sleeping
+    after each chunk, and takes delay seconds over bodies given as bytes.
+    stall is how long to sleep after the first chunk instead.
+    """
+    def __init__(self, chunk=100, sleep=0.05, stall=None, delay=0):
+        MemoryBackend.__init__(self)
+        self.chunk = chunk
+        self.sleep = sleep
+        self.stall = stall
+        self.delay = delay
+
+    def put(self, name, data, **kwargs):
+        if isinstance(data, bytes):
+            time.sleep(self.delay)
+            return MemoryBackend.put(self, name, data, **kwargs)
+        body = []
+        while True:
+            block = data.read(self.chunk)
+            if not block:
+                break
+            body.append(block)
+            time.sleep(self.stall if self.stall and len(body) == 1 else self.sleep)
+        return MemoryBackend.put(self, name, b"".join(body), **kwargs)
+
+
+class TestRetryingBackend(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.flaky = FlakyBackend()
+        self.flaky.put('objects/a', b'hello world')
+        self.flaky.calls = 0
+
+    def backend(self, **kwargs):
+        kwargs.setdefault('backoff', 0.001)
+        return RetryingBackend(self.flaky, TransferPolicy(**kwargs))
+
+    def counter(self, name, op):
+        return METRICS.to_dict()['counters'].get('{}{{op="{}"}}'.format(name, op), 0)
+
+    def test_retry(self):
+        b = self.backend()
+        self.flaky.failures = [True, True]
+        self.assertEqual(b.get('objects/a'), b'hello world')
+        self.assertEqual(self.flaky.calls, 3)
+        self.assertEqual(self.counter("hashsync_retries_total", "get"), 2)
+
+    def test_give_up(self):
+        b = self.backend(max_attempts=3)
+        self.flaky.failures = [True] * 5
+        self.assertRaises(StorageError, b.get, 'objects/a')
+        self.assertEqual(self.flaky.calls, 3)
+
+    def test_not_found(self):
+        b = self.backend()
+        self.assertRaises(NotFound, b.get, 'objects/missing')
+        self.assertEqual(self.counter("hashsync_retries_total", "get"), 0)
+
+    def test_no_timeout(self):
+        # Without timeouts or hedging, requests run in the calling thread
+        b = self.backend(timeout=None)
+        self.flaky.failures = [True]
+        self.assertEqual(b.get('objects/a'), b'hello world')
+
+    def test_timeout(self):
+        b = self.backend(timeout=0.1)
+        self.flaky.stalls = [True]
+        dst = BytesIO()
+        b.get_to_file('objects/a', dst)
+        self.assertEqual(self.counter("hashsync_timeouts_total", "get"), 1)
+        # Wait for the abandoned request to finish; it mustn't write to dst
+        time.sleep(0.6)
+        self.assertEqual(dst.getvalue(), b'hello world')
+
+    def test_timeout_gives_up(self):
+        b = self.backend(timeout=0.05, max_attempts=2)
+        self.flaky.stalls = [True, True]
+        self.assertRaises(RequestTimeout, b.head, 'objects/a')
+
+    def test_slow_large_body(self):
+        # Taking longer than the timeout is fine as long as data keeps moving
+        slow = SlowBackend()
+        b = RetryingBackend(slow, TransferPolicy(timeout=0.2, max_attempts=1))
+        start = time.time()
+        b.put('objects/big', BytesIO(b'x' * 1000))
+        self.assertGreater(time.time() - start, 0.4)
+        self.assertEqual(slow.get('objects/big'), b'x' * 1000)
+        self.assertEqual(self.counter("hashsync_timeouts_total", "put"), 0)
+
+    def test_stalled_body(self):
+        slow = SlowBackend(stall=0.5)
+        b = RetryingBackend(slow, TransferPolicy(timeout=0.1, max_attempts=1))
+        self.assertRaises(RequestTimeout, b.put, 'objects/big', BytesIO(b'x' * 1000))
+
+    def test_body_size_allowance(self):
+        # Bodies we can't watch get time in proportion to their size
+        slow = SlowBackend(delay=0.3)
+        b = RetryingBackend(slow, TransferPolicy(timeout=0.1, max_attempts=1, min_rate=1000))
+        b.put('objects/big', b'x' * 1000)
+        b = RetryingBackend(slow, TransferPolicy(timeout=0.1, max_attempts=1, min_rate=100000))
+        self.assertRaises(RequestTimeout, b.put, 'objects/big', b'x' * 1000)
+
+    def test_put_file_retry(self):
+        b = self.backend()
+        self.flaky.failures = [True]
+        b.put('objects/b', BytesIO(b'some data'))
+        self.assertEqual(self.flaky.get('objects/b'), b'some data')
+
+    def test_hedge(self):
+        b = self.backend(hedge=True, hedge_min_samples=5)
+        for i in range(5):
+            b.get('objects/a')
+        self.flaky.calls = 0
+        self.flaky.stalls = [True]
+        dst = BytesIO()
+        start = time.time()
+        b.get_to_file('objects/a', dst)
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(dst.getvalue(), b'hello world')
+        self.assertEqual(self.counter("hashsync_hedges_total", "get"), 1)
+        self.assertEqual(self.counter("hashsync_hedge_wins_total", "get"), 1)
+        time.sleep(0.6)
+        self.assertEqual(dst.getvalue(), b'hello world')
+
+    def test_no_hedge_before_samples(self):
+        b = self.backend(hedge=True, hedge_min_samples=5)
+        self.flaky.stalls = [True]
+        self.assertEqual(b.get('objects/a'), b'hello world')
+        self.assertEqual(self.counter("hashsync_hedges_total", "get"), 0)
+
+
+class TestHelpers(unittest.TestCase):
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(StorageError(503, 'ServiceUnavailable')))
+        self.assertTrue(is_retryable(StorageError(400, 'RequestTimeout')))
+        self.assertTrue(is_retryable(IOError("connection reset")))
+        self.assertFalse(is_retryable(StorageError(403, 'AccessDenied')))
+        self.assertFalse(is_retryable(NotFound('objects/a')))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_quantile(self):
+        t = LatencyTracker()
+        self.assertIsNone(t.quantile(0.5))
+        for i in range(100):
+            t.add(i)
+        self.assertEqual(t.quantile(0.99), 99)
+        self.assertEqual(t.quantile(0.5), 50)
+        self.assertIsNone(t.quantile(0.5, min_samples=200))
+
+    def test_delay(self):
+        p = TransferPolicy(backoff=1, max_backoff=5)
+        for attempt in range(1, 10):
+            self.assertLessEqual(p.delay(attempt), min(5, 2 ** (attempt - 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
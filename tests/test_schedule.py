@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_schedule
+----------------------------------
+
+Tests for `hashsync.schedule` module.
+"""
+
+import unittest
+
+from hashsync.schedule import lpt_order, estimate_makespan, schedule
+
+
+class TestSchedule(unittest.TestCase):
+    def test_lpt_order(self):
+        tasks = [(size, name) for name, size in enumerate([5, 100, 1, 200, 2, 300, 3, 4])]
+        ordered = lpt_order(tasks, 2, small_size=10, batch_size=2)
+        # The two biggest start right away; small tasks are interleaved two
+        # at a time after the remaining large one
+        self.assertEqual([size for size, _ in ordered], [300, 200, 100, 5, 4, 3, 2, 1])
+
+    def test_lpt_order_interleaves(self):
+        tasks = [(100, 'a'), (100, 'b'), (100, 'c'), (1, 'd'), (1, 'e'), (1, 'f')]
+        ordered = lpt_order(tasks, 1, small_size=10, batch_size=1)
+        self.assertEqual([name for _, name in ordered], ['a', 'b', 'd', 'c', 'e', 'f'])
+
+    def test_estimate_makespan(self):
+        self.assertEqual(estimate_makespan([1, 1, 1, 1], 2, overhead=0), 2)
+        self.assertEqual(estimate_makespan([1, 1, 4], 2, overhead=1), 7)
+        # Starting the big one first overlaps it with the rest
+        self.assertEqual(estimate_makespan([4, 1, 1], 2, overhead=1), 5)
+
+    def test_schedule(self):
+        tasks = [(1, 'a'), (2, 'b'), (3, 'c')]
+        self.assertEqual(schedule(tasks, 2, largest_first=False), tasks)
+        self.assertEqual(schedule(tasks, 2), [(3, 'c'), (2, 'b'), (1, 'a')])
+        self.assertEqual(schedule([], 2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_segments
+----------------------------------
+
+Tests for `hashsync.segments` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from hashsync.compression import compress_segmented, gzip_compress
+from hashsync.segments import plan_ranges, download_ranges, download_gzip_segments
+from hashsync.storage import MemoryBackend
+
+
+class TestSegments(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dst = os.path.join(self.tmpdir, "dst")
+        self.bucket = MemoryBackend()
+        self.data = os.urandom(250000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_dst(self):
+        with open(self.dst, 'rb') as f:
+            return f.read()
+
+    def test_plan_ranges(self):
+        self.assertEqual(plan_ranges(10, 4), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(plan_ranges(8, 4), [(0, 3), (4, 7)])
+        self.assertEqual(plan_ranges(0, 4), [])
+
+    def test_download_ranges(self):
+        self.bucket.put('objects/a', self.data)
+        download_ranges(self.bucket, 'objects/a', self.dst, len(self.data), segment_size=30000, jobs=4)
+        self.assertEqual(self.read_dst(), self.data)
+
+    def test_download_gzip_segments(self):
+        compressed = BytesIO()
+        compress_segmented(BytesIO(self.data), compressed, len(self.data), segment_size=30000)
+        self.bucket.put('objects/a', compressed.getvalue(), content_encoding='gzip')
+        self.assertTrue(download_gzip_segments(self.bucket, 'objects/a', self.dst, compressed.tell(), jobs=4))
+        self.assertEqual(self.read_dst(), self.data)
+
+    def test_not_segmented(self):
+        compressed = gzip_compress(self.data)
+        self.bucket.put('objects/a', compressed, content_encoding='gzip')
+        self.assertFalse(download_gzip_segments(self.bucket, 'objects/a', self.dst, len(compressed)))
+        self.assertFalse(os.path.exists(self.dst))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_storage
+----------------------------------
+
+Tests for `hashsync.storage` module.
+"""
+
+import unittest
+import shutil
+import tempfile
+import time
+
+from io import BytesIO
+
+from hashsync.retry import is_retryable
+from hashsync.storage import BotoBackend, LocalBackend, MemoryBackend, NotFound, StorageError, open_backend, parse_size
+
+
+class BackendTests(object):
+    "Tests that every backend should pass"
+    def make_backend(self, **kwargs):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.backend = self.make_backend()
+
+    def test_put_get(self):
+        b = self.backend
+        b.put('objects/abc', b'hello world', content_encoding='gzip')
+
+        self.assertEqual(b.get('objects/abc'), b'hello world')
+        info = b.head('objects/abc')
+        self.assertEqual(info.name, 'objects/abc')
+        self.assertEqual(info.size, 11)
+        self.assertEqual(info.content_encoding, 'gzip')
+        self.assertEqual(info.etag, '5eb63bbbe01eeed093cb22bb8f5acdc3')
+        self.assertAlmostEqual(info.last_modified, time.time(), delta=60)
+
+    def test_put_file(self):
+        b = self.backend
+        b.put('objects/abc', BytesIO(b'hello world'))
+        dst = BytesIO()
+        b.get_to_file('objects/abc', dst)
+        self.assertEqual(dst.getvalue(), b'hello world')
+        self.assertIsNone(b.head('objects/abc').content_encoding)
+
+    def test_missing(self):
+        b = self.backend
+        self.assertIsNone(b.head('objects/missing'))
+        self.assertRaises(NotFound, b.get, 'objects/missing')
+        self.assertRaises(NotFound, b.copy, 'objects/missing')
+        self.assertRaises(NotFound, b.get_range, 'objects/missing', 0, 1)
+
+    def test_get_range(self):
+        b = self.backend
+        b.put('objects/abc', b'hello world')
+        self.assertEqual(b.get_range('objects/abc', 0, 4), b'hello')
+        self.assertEqual(b.get_range('objects/abc', 6, 100), b'world')
+
+    def test_list(self):
+        b = self.backend
+        for name in ('objects/b', 'objects/a', 'objectlist/shards/a', 'other'):
+            b.put(name, b'data')
+
+        self.assertEqual([i.name for i in b.list('objects/')], ['objects/a', 'objects/b'])
+        self.assertEqual([i.name for i in b.list_versions('objects/')], ['objects/a', 'objects/b'])
+        self.assertEqual(len(list(b.list())), 4)
+
+    def test_copy(self):
+        b = self.backend
+        b.put('objects/abc', b'hello world', content_encoding='gzip')
+        before = b.head('objects/abc').last_modified
+        time.sleep(0.01)
+        b.copy('objects/abc')
+        info = b.head('objects/abc')
+        self.assertGreater(info.last_modified, before)
+        self.assertEqual(info.content_encoding, 'gzip')
+
+    def test_delete(self):
+        b = self.backend
+        b.put('objects/a', b'data')
+        b.put('objects/b', b'data')
+        result = b.delete(['objects/a', ('objects/b', 'null')])
+        self.assertEqual(result.deleted, [('objects/a', None), ('objects/b', 'null')])
+        self.assertEqual(result.errors, [])
+        self.assertEqual(list(b.list()), [])
+
+    def test_multipart(self):
+        b = self.backend
+        upload_id = b.start_multipart('objects/abc', content_encoding='gzip')
+        # Parts can arrive in any order
+        e2 = b.put_part('objects/abc', upload_id, 2, b'world')
+        e1 = b.put_part('objects/abc', upload_id, 1, b'hello ')
+        self.assertIsNone(b.head('objects/abc'))
+        b.complete_multipart('objects/abc', upload_id, [(1, e1), (2, e2)])
+
+        self.assertEqual(b.get('objects/abc'), b'hello world')
+        info = b.head('objects/abc')
+        self.assertEqual(info.content_encoding, 'gzip')
+        self.assertTrue(info.etag.endswith('-2'))
+        # The upload is gone once it's completed
+        self.assertRaises(NotFound, b.put_part, 'objects/abc', upload_id, 3, b'!')
+
+    def test_multipart_invalid(self):
+        b = self.backend
+        upload_id = b.start_multipart('objects/abc')
+        e1 = b.put_part('objects/abc', upload_id, 1, b'hello')
+        with self.assertRaises(StorageError) as cm:
+            b.complete_multipart('objects/abc', upload_id, [(1, e1), (2, e1)])
+        self.assertEqual(cm.exception.code, 'InvalidPart')
+        self.assertRaises(NotFound, b.put_part, 'objects/other', upload_id, 1, b'x')
+
+        b.abort_multipart('objects/abc', upload_id)
+        self.assertRaises(NotFound, b.complete_multipart, 'objects/abc', upload_id, [(1, e1)])
+        self.assertEqual(list(b.list()), [])
+
+    def test_latency(self):
+        b = self.make_backend(latency=0.05)
+        start = time.time()
+        b.head('objects/abc')
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_bandwidth(self):
+        b = self.make_backend(bandwidth=1000)
+        start = time.time()
+        b.put('objects/abc', b'x' * 100)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+
+class TestLocalBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        BackendTests.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_backend(self, **kwargs):
+        return LocalBackend(self.tmpdir, **kwargs)
+
+    def test_prefix_is_not_an_object(self):
+        self.backend.put('objectlist/shards/a', b'data')
+        self.assertIsNone(self.backend.head('objectlist'))
+
+
+class TestMemoryBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, **kwargs):
+        return MemoryBackend(**kwargs)
+
+
+class _ErrorKey(object):
+    "A boto key whose reads all fail with an S3 error"
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+    def get_contents_as_string(self, headers=None):
+        from boto.exception import S3ResponseError
+        raise S3ResponseError(self.status, self.reason)
+
+
+class _ErrorBucket(object):
+    name = "test"
+
+    def __init__(self, status, reason):
+        self.key = _ErrorKey(status, reason)
+
+    def new_key(self, name):
+        return self.key
+
+    get_key = new_key
+
+
+class TestBotoBackend(unittest.TestCase):
+    def test_get_range_errors(self):
+        b = BotoBackend(_ErrorBucket(503, "Slow Down"))
+        with self.assertRaises(StorageError) as cm:
+            b.get_range('objects/abc', 0, 4)
+        self.assertEqual(cm.exception.status, 503)
+        self.assertTrue(is_retryable(cm.exception))
+        self.assertRaises(StorageError, b.get, 'objects/abc')
+
+        b = BotoBackend(_ErrorBucket(404, "Not Found"))
+        self.assertRaises(NotFound, b.get_range, 'objects/abc', 0, 4)
+
+
+class TestOpenBackend(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('10K'), 10240)
+        self.assertEqual(parse_size('1.5m'), 1.5 * 1024 ** 2)
+
+    def test_file(self):
+        b = open_backend('file:///tmp/hashsync-test?latency=0.1&bandwidth=10M')
+        self.assertIsInstance(b, LocalBackend)
+        self.assertEqual(b.root, '/tmp/hashsync-test')
+        self.assertEqual(b.latency, 0.1)
+        self.assertEqual(b.bandwidth, 10 * 1024 ** 2)
+
+    def test_memory(self):
+        b = open_backend('memory://test-open')
+        self.assertIsInstance(b, MemoryBackend)
+        # The same URL gives the same store
+        self.assertIs(open_backend('memory://test-open'), b)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, open_backend, 'ftp://example.com/')
+
+
+if __name__ == '__main__':
+    unittest.main()
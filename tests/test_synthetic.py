@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_synthetic
+----------------------------------
+
+Tests for `hashsync.synthetic` module.
+"""
+
+import unittest
+import random
+import shutil
+import tempfile
+
+from hashsync.synthetic import generate_tree, file_contents, file_size
+from hashsync.compression import gzip_compress
+from hashsync.utils import traverse_directory, sha1sum
+
+
+class TestSynthetic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reproducible(self):
+        hashes = []
+        for d in ('a', 'b'):
+            dirname = "{}/{}".format(self.tmpdir, d)
+            generate_tree(dirname, files=20, mean_size=1000, seed=42)
+            hashes.append([h for _, h in traverse_directory(dirname, sha1sum)])
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(len(hashes[0]), 20)
+
+    def test_duplication(self):
+        generate_tree(self.tmpdir, files=100, mean_size=100, distribution="fixed", duplication=0.5)
+        hashes = [h for _, h in traverse_directory(self.tmpdir, sha1sum)]
+        unique = len(set(hashes))
+        self.assertLess(unique, 80)
+        self.assertGreater(unique, 20)
+
+    def test_compressibility(self):
+        rng = random.Random(0)
+        random_data = file_contents(rng, 10000, 0)
+        text_data = file_contents(rng, 10000, 1)
+        self.assertEqual(len(random_data), 10000)
+        self.assertGreater(len(gzip_compress(random_data)), 10000)
+        self.assertLess(len(gzip_compress(text_data)), 1000)
+
+    def test_file_size(self):
+        rng = random.Random(0)
+        self.assertEqual(file_size(rng, "fixed", 100), 100)
+        sizes = [file_size(rng, "lognormal", 1000) for _ in range(10000)]
+        mean = sum(sizes) / len(sizes)
+        self.assertGreater(mean, 500)
+        self.assertLess(mean, 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
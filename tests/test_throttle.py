@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_throttle
+----------------------------------
+
+Tests for `hashsync.throttle` module.
+"""
+
+import threading
+import unittest
+import time
+
+from hashsync.throttle import AdaptiveRateLimiter, AdaptiveConcurrency
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def test_aimd(self):
+        r = AdaptiveRateLimiter(10, 1, 12, increase=1, decrease=0.5)
+        r.succeeded()
+        self.assertEqual(r.rate, 11)
+        r.succeeded()
+        r.succeeded()
+        self.assertEqual(r.rate, 12)
+
+        r.throttled()
+        self.assertEqual(r.rate, 6)
+        r.throttled()
+        r.throttled()
+        r.throttled()
+        self.assertEqual(r.rate, 1)
+
+    def test_acquire(self):
+        r = AdaptiveRateLimiter(100, 1, 100, burst=1)
+        start = time.time()
+        for _ in range(6):
+            r.acquire()
+        elapsed = time.time() - start
+        # The first token is available immediately; the rest come every 10ms
+        self.assertGreaterEqual(elapsed, 0.04)
+        self.assertLess(elapsed, 1)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def run_window(self, c, latency=0.01, throttled=False):
+        "Runs one window's worth of requests through c"
+        n = int(c.limit)
+        for _ in range(n):
+            c.acquire()
+        for _ in range(n):
+            c.release(latency, 1000, throttled)
+
+    def test_slow_start(self):
+        c = AdaptiveConcurrency(1, 1, 20)
+        limits = []
+        for _ in range(6):
+            self.run_window(c)
+            limits.append(int(c.limit))
+        self.assertEqual(limits, [2, 4, 8, 16, 20, 20])
+
+    def test_throttled(self):
+        c = AdaptiveConcurrency(16, 1, 32)
+        c.acquire()
+        c.release(throttled=True)
+        self.assertEqual(c.limit, 8)
+        self.assertFalse(c.slow_start)
+        # After slow start, the limit goes up by one per window
+        self.run_window(c)
+        self.assertEqual(c.limit, 9)
+
+    def test_latency(self):
+        c = AdaptiveConcurrency(8, 2, 32)
+        self.run_window(c, latency=0.01)
+        self.assertEqual(c.limit, 16)
+        self.run_window(c, latency=0.1)
+        self.assertEqual(c.limit, 8)
+
+    def test_min_limit(self):
+        c = AdaptiveConcurrency(4, 3, 8)
+        for _ in range(3):
+            c.acquire()
+            c.last_decrease = 0
+            c.release(throttled=True)
+        self.assertEqual(c.limit, 3)
+
+    def test_acquire_blocks(self):
+        c = AdaptiveConcurrency(2, 1, 2)
+        c.acquire()
+        c.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            c.acquire()
+            acquired.set()
+        t = threading.Thread(target=acquire)
+        t.start()
+        self.assertFalse(acquired.wait(0.05))
+        c.release(0.01)
+        self.assertTrue(acquired.wait(1))
+        t.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_transfer
+----------------------------------
+
+Tests for `hashsync.transfer` module.
+"""
+
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from hashsync import config, transfer
+from hashsync.chunking import chunk_file, chunklist_name, decode_chunklist
+from hashsync.connection import connect_url
+from hashsync.hashing import get_algorithm
+from hashsync.journal import UploadJournal
+from hashsync.metrics import result
+from hashsync.objectlist import ShardedObjectList, decode_objects
+from hashsync.storage import StorageError
+from hashsync.throttle import AdaptiveConcurrency
+from hashsync.transfer import JobSubmitter, upload_directory
+
+
+def failing_chunk_file(filename, algorithm="sha1"):
+    raise AssertionError("{} was chunked again".format(filename))
+
+
+real_upload_file = transfer.upload_file
+
+
+def failing_upload_file(filename, keyname, *args, **kwargs):
+    if filename.endswith("bad"):
+        raise StorageError(403, 'AccessDenied')
+    return real_upload_file(filename, keyname, *args, **kwargs)
+
+
+def echo(value):
+    return value
+
+
+def fail(e):
+    raise e
+
+
+def failing_callback(value):
+    raise ValueError(value)
+
+
+class TestJobSubmitter(unittest.TestCase):
+    def setUp(self):
+        self.pool = multiprocessing.Pool(1)
+        self.concurrency = AdaptiveConcurrency(4, 1, 4)
+        self.submitter = JobSubmitter(self.pool, self.concurrency)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def test_failing_callback(self):
+        job = self.submitter.submit(echo, ("a",), callback=failing_callback)
+        # The error comes back to whoever waits for the job
+        self.assertRaises(ValueError, result, job, 10)
+        self.assertEqual(self.concurrency.in_flight, 0)
+        self.assertEqual(self.submitter.queue.depth, 0)
+
+        # and the pool carries on working
+        results = []
+        job = self.submitter.submit(echo, ("b",), callback=results.append)
+        self.assertEqual(result(job, 10), "b")
+        self.assertEqual(results, ["b"])
+
+    def test_failed(self):
+        # Jobs that fail for other reasons don't count as throttling
+        job = self.submitter.submit(fail, (ValueError("broken"),))
+        self.assertRaises(ValueError, result, job, 10)
+        self.assertEqual(self.concurrency.limit, 4)
+        self.assertEqual(self.concurrency.in_flight, 0)
+
+        job = self.submitter.submit(fail, (StorageError(503, 'SlowDown'),))
+        self.assertRaises(StorageError, result, job, 10)
+        self.assertLess(self.concurrency.limit, 4)
+
+
+class TestUploadDirectory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = connect_url("file://" + self.path("store"))
+        os.mkdir(self.path("src"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *bits):
+        return os.path.join(self.tmpdir, *bits)
+
+    def write(self, name, data):
+        with open(self.path("src", name), 'wb') as f:
+            f.write(data)
+
+    def object_list(self):
+        object_list = ShardedObjectList(self.bucket)
+        object_list.load()
+        return object_list
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def deltas(self):
+        "Returns the hashes in each delta of the object list, by delta name"
+        object_list = ShardedObjectList(self.bucket)
+        deltas = {}
+        for info in self.bucket.list(object_list.delta_prefix):
+            entries = decode_objects(self.bucket.get(info.name))
+            deltas[info.name] = set(e.split(" ")[0] for e in entries)
+        return deltas
+
+    def new_deltas(self, before):
+        "Returns the hashes published since the deltas in before"
+        return [hashes for name, hashes in self.deltas().items() if name not in before]
+
+    def test_publish(self):
+        sha1 = get_algorithm("sha1")
+        self.write("new", b"new")
+        self.write("empty", b"")
+        # Objects found in the bucket are published too
+        self.write("present", b"present")
+        present = sha1.hash_data(b"present")
+        self.bucket.put(sha1.key(present), b"present")
+        # but objects already in the object list aren't
+        self.write("listed", b"listed")
+        listed = sha1.hash_data(b"listed")
+        self.bucket.put(sha1.key(listed), b"listed")
+        ShardedObjectList(self.bucket).publish([listed])
+
+        before = self.deltas()
+        upload_directory(self.path("src"), 1)
+        self.assertEqual(self.new_deltas(before), [set([sha1.hash_data(b"new"), present])])
+
+        # Uploading the same files again has nothing to publish
+        before = self.deltas()
+        upload_directory(self.path("src"), 1)
+        self.assertEqual(self.new_deltas(before), [])
+
+    def test_publish_failed(self):
+        sha1 = get_algorithm("sha1")
+        good = sha1.hash_data(b"good data")
+        bad = sha1.hash_data(b"bad")
+        self.write("good", b"good data")
+        self.write("bad", b"bad")
+        journal = self.path("journal")
+
+        # A failed upload publishes nothing, even what it did upload
+        self.patch(transfer, "upload_file", failing_upload_file)
+        self.assertRaises(StorageError, upload_directory, self.path("src"), 1, journal=UploadJournal(journal))
+        self.assertEqual(self.deltas(), {})
+        finished = UploadJournal(journal)
+        finished.load()
+        self.assertEqual(finished.recent_states(3600), {good: "uploaded"})
+
+        # Resuming it publishes what the failed run uploaded along with the
+        # rest
+        transfer.upload_file = real_upload_file
+        upload_directory(self.path("src"), 1, journal=UploadJournal(journal))
+        self.assertEqual(self.new_deltas({}), [set([good, bad])])
+
+        # and once that's published, it isn't published again
+        before = self.deltas()
+        upload_directory(self.path("src"), 1, journal=UploadJournal(journal))
+        self.assertEqual(self.new_deltas(before), [])
+
+    def test_chunklist(self):
+        self.patch(config, "CHUNKED_MINSIZE", 1024 * 1024)
+        rand = random.Random(0)
+        self.write("big", bytes(bytearray(rand.getrandbits(8) for _ in range(3 * 1024 * 1024))))
+
+        m = upload_directory(self.path("src"), 1, chunked=True)
+        h = m.files[0][0]
+        chunks = m.chunks[h]
+        self.assertGreater(len(chunks), 1)
+        # The chunk list is stored and published along with the chunks
+        self.assertEqual(decode_chunklist(self.bucket.get("objects/" + chunklist_name(h))), chunks)
+        object_list = self.object_list()
+        self.assertIn(chunklist_name(h), object_list)
+        for ch, _ in chunks:
+            self.assertIn(ch, object_list)
+        self.assertNotIn(h, object_list)
+
+        # Uploading it again uses the stored chunk list rather than chunking
+        # the file
+        self.patch(transfer, "chunk_file", failing_chunk_file)
+        m = upload_directory(self.path("src"), 1, chunked=True)
+        self.assertEqual(m.chunks[h], chunks)
+
+        # A chunk list that has gone away is stored again
+        self.bucket.delete(["objects/" + chunklist_name(h)])
+        transfer.chunk_file = chunk_file
+        m = upload_directory(self.path("src"), 1, chunked=True)
+        self.assertEqual(m.chunks[h], chunks)
+        self.assertEqual(decode_chunklist(self.bucket.get("objects/" + chunklist_name(h))), chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
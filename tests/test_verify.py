@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_verify
+----------------------------------
+
+Tests for `hashsync.verify` module.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from hashsync.verify import CorruptObject, HashingWriter, OrderedHasher, KnownFiles
+
+
+class TestCorruptObject(unittest.TestCase):
+    def test_pickle(self):
+        # It has to survive being raised in a worker process
+        e = pickle.loads(pickle.dumps(CorruptObject("objects/abc", "abc", "def")))
+        self.assertEqual((e.keyname, e.expected, e.actual), ("objects/abc", "abc", "def"))
+        self.assertEqual(str(e), "objects/abc is corrupt: its contents hash to def")
+
+
+class TestHashingWriter(unittest.TestCase):
+    def test_write(self):
+        out = BytesIO()
+        w = HashingWriter(out, hashlib.sha1)
+        w.write(b'hello ')
+        w.write(b'world')
+        self.assertEqual(w.hexdigest(), hashlib.sha1(b'hello world').hexdigest())
+        self.assertEqual(out.getvalue(), b'hello world')
+
+    def test_retry(self):
+        # Going back to the start, as retries do, starts the hash again
+        out = BytesIO()
+        w = HashingWriter(out, hashlib.sha1)
+        w.write(b'garbage')
+        w.seek(0)
+        w.truncate()
+        w.write(b'data')
+        self.assertEqual(w.hexdigest(), hashlib.sha1(b'data').hexdigest())
+        self.assertRaises(IOError, w.seek, 2)
+
+
+class TestOrderedHasher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "data")
+        self.data = os.urandom(1000)
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, order, max_pending):
+        h = OrderedHasher(hashlib.sha1(), self.filename, max_pending)
+        for start in order:
+            h.update_at(start, self.data[start:start + 100])
+        self.assertEqual(h.hexdigest(), hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(h.pending_bytes, 0)
+
+    def test_out_of_order(self):
+        self.check([900, 100, 0, 300, 200, 500, 400, 700, 800, 600], 1000)
+
+    def test_reread(self):
+        # Ranges that don't fit in memory are read back from the file
+        self.check([900, 100, 0, 300, 200, 500, 400, 700, 800, 600], 150)
+
+    def test_missing(self):
+        h = OrderedHasher(hashlib.sha1(), self.filename)
+        h.update_at(100, self.data[100:200])
+        self.assertRaises(ValueError, h.hexdigest)
+
+
+class TestKnownFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.record = os.path.join(self.tmpdir, "known", "dest")
+        self.filename = os.path.join(self.tmpdir, "a")
+        with open(self.filename, 'wb') as f:
+            f.write(b'a')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse(self):
+        calls = []
+
+        def hash_file(filename):
+            calls.append(filename)
+            return "hashed"
+
+        known = KnownFiles(self.record, "sha1")
+        known.add(self.filename, "recorded")
+        known.save()
+
+        known = KnownFiles(self.record, "sha1")
+        known.load()
+        self.assertEqual(known.hasher(hash_file)(self.filename), "recorded")
+        self.assertEqual(calls, [])
+        known.save()
+
+        # Hashes are kept for the next run too
+        known = KnownFiles(self.record, "sha1")
+        known.load()
+        self.assertEqual(known.hasher(hash_file)(self.filename), "recorded")
+
+        # But not once the file changes
+        with open(self.filename, 'wb') as f:
+            f.write(b'changed')
+        self.assertEqual(known.hasher(hash_file)(self.filename), "hashed")
+        known.save()
+        known = KnownFiles(self.record, "sha1")
+        known.load()
+        self.assertEqual(known.old, {})
+
+    def test_algorithm(self):
+        known = KnownFiles(self.record, "sha1")
+        known.add(self.filename, "recorded")
+        known.save()
+        known = KnownFiles(self.record, "sha256")
+        known.load()
+        self.assertEqual(known.old, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
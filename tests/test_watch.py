@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_watch
+----------------------------------
+
+Tests for `hashsync.watch` module.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from hashsync import config, watch
+from hashsync.connection import connect_url
+from hashsync.manifest import Manifest
+from hashsync.storage import StorageError
+from hashsync.watch import DirectoryWatcher, ManifestTree, PendingChanges, available, watch_directory
+
+
+class TestPendingChanges(unittest.TestCase):
+    def test_debounce(self):
+        p = PendingChanges(2)
+        self.assertIsNone(p.next_ready())
+        p.add("a", 10)
+        p.add("b", 11)
+        self.assertEqual(p.next_ready(), 12)
+        self.assertEqual(p.pop_ready(11), [])
+        # Another write puts it off again
+        p.add("a", 11.5)
+        self.assertEqual(p.pop_ready(13), ["b"])
+        self.assertEqual(p.pop_ready(14), ["a"])
+        self.assertEqual(len(p), 0)
+
+
+class TestManifestTree(unittest.TestCase):
+    def test_update(self):
+        t = ManifestTree()
+        m = Manifest()
+        m.add("a" * 40, "dir/a", 0o644, 1)
+        m.add("b" * 40, "dir/sub/b", 0o600, 2)
+        m.add("c" * 40, "dirt", 0o644, 3)
+        t.update(m)
+        self.assertTrue(t.dirty)
+
+        m = Manifest()
+        m.add("d" * 40, "dir/a", 0o644, 4)
+        t.update(m)
+        t.remove("dir/sub")
+        m = t.manifest()
+        self.assertFalse(t.dirty)
+        self.assertEqual(m.files, [("d" * 40, "dir/a", 0o644), ("c" * 40, "dirt", 0o644)])
+        self.assertEqual(m.sizes["d" * 40], 4)
+
+        # Removing a directory doesn't touch files that just share a prefix
+        t.remove("dir")
+        self.assertEqual(list(t.entries), ["dirt"])
+
+
+@unittest.skipUnless(available(), "inotify isn't available")
+class TestDirectoryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.watcher = DirectoryWatcher(self.tmpdir)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, *bits):
+        return os.path.join(self.tmpdir, *bits)
+
+    def write(self, filename, data=b'data'):
+        with open(self.path(filename), 'wb') as f:
+            f.write(data)
+
+    def changes(self):
+        return set(self.watcher.changes(0.5))
+
+    def test_changes(self):
+        os.mkdir(self.path("sub"))
+        self.write("a")
+        self.assertEqual(self.watcher.watch(self.tmpdir), [self.path("a")])
+
+        self.write("b")
+        self.write("sub/c")
+        os.chmod(self.path("a"), 0o600)
+        self.assertEqual(self.changes(), set([self.path("a"), self.path("b"), self.path("sub", "c")]))
+
+        os.rename(self.path("b"), self.path("sub", "b"))
+        os.unlink(self.path("a"))
+        self.assertEqual(self.changes(), set([self.path("a"), self.path("b"), self.path("sub", "b")]))
+
+    def test_new_directories(self):
+        self.watcher.watch(self.tmpdir)
+        outside = tempfile.mkdtemp()
+        with open(os.path.join(outside, "a"), 'wb') as f:
+            f.write(b'data')
+        os.rename(outside, self.path("moved"))
+        self.assertEqual(self.changes(), set([self.path("moved"), self.path("moved", "a")]))
+
+        # The new directory is watched too
+        self.write("moved/b")
+        self.assertEqual(self.changes(), set([self.path("moved", "b")]))
+
+        # And stops being watched when it's moved away
+        os.rename(self.path("moved"), outside)
+        try:
+            self.assertEqual(self.changes(), set([self.path("moved")]))
+            self.assertNotIn(self.path("moved"), self.watcher.wds)
+        finally:
+            shutil.rmtree(outside)
+
+
+@unittest.skipUnless(available(), "inotify isn't available")
+class TestWatchDirectory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, "a"), 'wb') as f:
+            f.write(b'a')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_watch(self):
+        manifests = []
+        stop = threading.Event()
+        t = threading.Thread(target=watch_directory, args=(self.tmpdir, 1, manifests.append),
+                             kwargs={'interval': 0, 'debounce': 0.1, 'stop': stop, 'dryrun': True})
+        t.start()
+        try:
+            deadline = time.time() + 10
+            while not manifests and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual([f for _, f, _ in manifests[-1].files], ["a"])
+
+            with open(os.path.join(self.tmpdir, "b"), 'wb') as f:
+                f.write(b'b')
+            os.unlink(os.path.join(self.tmpdir, "a"))
+            # The changes may be picked up in one go or two
+            while [f for _, f, _ in manifests[-1].files] != ["b"] and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            t.join()
+        self.assertEqual([f for _, f, _ in manifests[-1].files], ["b"])
+
+    def test_session(self):
+        # Every batch is uploaded with the same pool and object list
+        store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store)
+        connect_url("file://" + store)
+        calls = []
+
+        def upload_directory(dirname, jobs, **kwargs):
+            calls.append((kwargs['pool'], kwargs['object_list']))
+            return real_upload_directory(dirname, jobs, **kwargs)
+        real_upload_directory = watch.upload_directory
+        watch.upload_directory = upload_directory
+        self.addCleanup(setattr, watch, 'upload_directory', real_upload_directory)
+
+        manifests = []
+        stop = threading.Event()
+        t = threading.Thread(target=watch_directory, args=(self.tmpdir, 1, manifests.append),
+                             kwargs={'interval': 0, 'debounce': 0.1, 'stop': stop})
+        t.start()
+        try:
+            deadline = time.time() + 10
+            for name in ("b", "c"):
+                n = len(calls)
+                while len(calls) == n and time.time() < deadline:
+                    time.sleep(0.05)
+                with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                    f.write(name.encode('ascii'))
+            while len(calls) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            t.join()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(set(id(pool) for pool, _ in calls)), 1)
+        self.assertEqual(len(set(id(object_list) for _, object_list in calls)), 1)
+        self.assertEqual(sorted(f for _, f, _ in manifests[-1].files), ["a", "b", "c"])
+        for h, _, _ in manifests[-1].files:
+            self.assertIn(h, calls[0][1])
+
+    def test_retries(self):
+        store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store)
+        connect_url("file://" + store)
+        self.addCleanup(setattr, config, 'WATCH_MAX_ATTEMPTS', config.WATCH_MAX_ATTEMPTS)
+        config.WATCH_MAX_ATTEMPTS = 3
+        locked = os.path.join(self.tmpdir, "locked")
+        broken = os.path.join(self.tmpdir, "broken")
+        calls = []
+
+        def upload_directory(dirname, jobs, filenames=None, **kwargs):
+            calls.append((filenames, kwargs['object_list']))
+            # Files we can't read are given up on straight away, and others
+            # after a few attempts
+            if filenames and locked in filenames:
+                raise IOError(errno.EACCES, "Permission denied", locked)
+            if filenames and broken in filenames:
+                raise StorageError(500, 'InternalError')
+            return real_upload_directory(dirname, jobs, filenames=filenames, **kwargs)
+        real_upload_directory = watch.upload_directory
+        watch.upload_directory = upload_directory
+        self.addCleanup(setattr, watch, 'upload_directory', real_upload_directory)
+
+        def attempts(path):
+            return len([f for f, _ in calls if f and path in f])
+
+        def wait_for(condition, settle=0.5):
+            deadline = time.time() + 10
+            while not condition() and time.time() < deadline:
+                time.sleep(0.05)
+            # Give any more attempts a chance to happen
+            time.sleep(settle)
+
+        manifests = []
+        stop = threading.Event()
+        t = threading.Thread(target=watch_directory, args=(self.tmpdir, 1, manifests.append),
+                             kwargs={'interval': 0, 'debounce': 0.1, 'stop': stop})
+        t.start()
+        try:
+            wait_for(lambda: calls, 0)
+            with open(locked, 'wb') as f:
+                f.write(b'locked')
+            wait_for(lambda: attempts(locked))
+            with open(broken, 'wb') as f:
+                f.write(b'broken')
+            wait_for(lambda: attempts(broken) >= 3)
+            with open(os.path.join(self.tmpdir, "c"), 'wb') as f:
+                f.write(b'c')
+            wait_for(lambda: "c" in [f for _, f, _ in manifests[-1].files], 0)
+        finally:
+            stop.set()
+            t.join()
+        self.assertEqual(attempts(locked), 1)
+        self.assertEqual(attempts(broken), 3)
+        self.assertEqual(sorted(f for _, f, _ in manifests[-1].files), ["a", "c"])
+        # Failures don't make us load the object list again
+        self.assertEqual(len(set(id(object_list) for _, object_list in calls)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
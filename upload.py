@@ -1,24 +1,63 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from hashsync.connection import connect
+import gzip
+import os
+import sys
+
+from hashsync.connection import connect, connect_url, get_bucket
 from hashsync.transfer import upload_directory
+from hashsync.metrics import METRICS
+from hashsync.retry import TransferPolicy
+from hashsync.hashing import ALGORITHMS, set_repository_algorithm
+from hashsync.journal import UploadJournal
+from hashsync import watch
+from hashsync import config, profiling
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def write_manifest(manifest, output, compress, version=None):
+    """
+    Writes manifest to the file output, or to stdout if output is '-'. Files
+    are written under a temporary name and renamed into place, so nobody
+    reading the manifest sees half of it. version is the manifest format to
+    write; see hashsync.manifest.Manifest.save.
+    """
+    if output == '-':
+        output_file = sys.stdout
+        if compress:
+            output_file = gzip.GzipFile(fileobj=output_file, mode='wb')
+        manifest.save(output_file, version)
+        return
+
+    tmpname = "{}.tmp{}".format(output, os.getpid())
+    with open(tmpname, 'wb') as f:
+        if compress:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                manifest.save(gz, version)
+        else:
+            manifest.save(f, version)
+    os.rename(tmpname, output)
+
+
 def main():
     import argparse
-    import sys
-    import gzip
 
     parser = argparse.ArgumentParser()
-    # TODO: These aren't required if no-upload is set
-    parser.add_argument("-r", "--region", dest="region", required=True)
-    parser.add_argument("-b", "--bucket", dest="bucket_name", required=True)
+    parser.add_argument("-r", "--region", dest="region")
+    parser.add_argument("-b", "--bucket", dest="bucket_name")
+    parser.add_argument("-u", "--url", dest="url",
+                        help="storage backend URL to use instead of --region and --bucket, "
+                        "e.g. s3://bucket?region=us-east-1 or file:///path")
     parser.add_argument("-q", "--quiet", dest="loglevel", action="store_const", const=logging.WARN, default=logging.INFO)
     parser.add_argument("-v", "--verbose", dest="loglevel", action="store_const", const=logging.DEBUG)
     parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="how many simultaneous uploads to do", default=8)
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=False,
+                        help="adjust how many uploads are in flight, up to --jobs, based on throughput, latency "
+                        "and throttling")
+    parser.add_argument("--min-jobs", dest="min_jobs", type=int, default=1,
+                        help="with --adaptive, the fewest uploads to keep in flight")
     parser.add_argument("-o", "--output", dest="output", help="where to output manifet, use '-' for stdout", default="manifest.gz")
     parser.add_argument("-z", "--compress-manifest", dest="compress_manifest",
                         help="compress manifest output (default if outputting to a file)",
@@ -26,8 +65,55 @@ def main():
     parser.add_argument("--no-compress-manifest", dest="compress_manifest",
                         help="don't compress manifest output (default if outputting to stdout)",
                         action="store_false")
+    parser.add_argument("--manifest-format", dest="manifest_format", type=int, choices=[1, 2],
+                        default=config.MANIFEST_FORMAT,
+                        help="manifest format to write; 2 records file sizes, but download.py from before it can't "
+                        "read it, so upgrade every consumer first. manifests with chunks or hashes other than sha1 "
+                        "are always format 2 (default: %(default)s)")
     parser.add_argument("--no-upload", dest="dryrun", action="store_true", default=False)
+    parser.add_argument("--no-publish", dest="publish", action="store_false", default=True,
+                        help="don't publish new objects to the object list")
+    parser.add_argument("--no-refresh", dest="refresh", action="store_false", default=True,
+                        help="don't refresh old objects; use this if the bucket is cleaned up with make_manifest.py --reachable-from")
+    parser.add_argument("--no-schedule", dest="largest_first", action="store_false", default=True,
+                        help="upload files in directory order rather than largest first")
+    parser.add_argument("--chunked", dest="chunked", action="store_true", default=False,
+                        help="store large files as content-defined chunks, so only the parts that change are "
+                        "uploaded and downloaded")
+    parser.add_argument("--hash", dest="algorithm", choices=sorted(ALGORITHMS),
+                        help="how to identify objects; defaults to the algorithm set for the bucket with "
+                        "--set-default-hash, or {}. *-tree algorithms hash large files using every core".format(
+                            config.HASH_ALGORITHM))
+    parser.add_argument("--set-default-hash", dest="set_default_hash", action="store_true", default=False,
+                        help="record --hash as the algorithm for later uploads to this bucket to use")
+    parser.add_argument("--journal", dest="journal",
+                        help="record progress here, so that running the same upload again after it's interrupted "
+                        "carries on where it left off; defaults to the output file plus .journal. the journal is "
+                        "removed once the manifest is written")
+    parser.add_argument("--no-journal", dest="use_journal", action="store_false", default=True,
+                        help="don't keep a journal. an existing journal is discarded, aborting its unfinished "
+                        "multipart uploads")
+    parser.add_argument("--watch", dest="watch", action="store_true", default=False,
+                        help="after uploading, keep watching the directory with inotify, uploading files as they "
+                        "change and rewriting the manifest")
+    parser.add_argument("--watch-interval", dest="watch_interval", type=float, default=config.WATCH_INTERVAL,
+                        help="with --watch, least number of seconds between rewriting the manifest")
+    parser.add_argument("--debounce", dest="debounce", type=float, default=config.WATCH_DEBOUNCE,
+                        help="with --watch, how many seconds a file has to go without changing before it's uploaded")
     parser.add_argument("--report-dupes", dest="report_dupes", action="store_true", default=False, help="report on duplicate files")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=config.REQUEST_TIMEOUT,
+                        help="seconds to wait for each request before retrying it; 0 waits forever")
+    parser.add_argument("--attempts", dest="attempts", type=int, default=config.REQUEST_MAX_ATTEMPTS,
+                        help="how many times to try each request")
+    parser.add_argument("--hedge", dest="hedge", action="store_true", default=False,
+                        help="send a duplicate request for reads that are slower than almost all recent reads")
+    parser.add_argument("--metrics-json", dest="metrics_json", help="write transfer metrics to this file as JSON")
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        help="write transfer metrics to this file in the Prometheus text format")
+    parser.add_argument("--profile", dest="profile", metavar="DIR",
+                        help="profile this process and its workers, writing the profiles and a merged report to DIR")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true", default=False,
+                        help="with --profile, also take tracemalloc snapshots")
     parser.add_argument("dirname", help="directory to upload")
 
     args = parser.parse_args()
@@ -36,26 +122,75 @@ def main():
     # TODO: Add -v -v support to set this to DEBUG?
     logging.getLogger('boto').setLevel(logging.INFO)
 
-    if not args.dryrun:
-        connect(args.region, args.bucket_name)
+    if args.profile:
+        profiling.start(args.profile, memory=args.profile_memory)
 
-    manifest = upload_directory(args.dirname, args.jobs, dryrun=args.dryrun)
+    policy = TransferPolicy(timeout=args.timeout or None, max_attempts=args.attempts, hedge=args.hedge)
 
-    if args.output == '-':
-        output_file = sys.stdout
+    if args.dryrun:
+        pass
+    elif args.url:
+        connect_url(args.url, policy)
+    elif args.region and args.bucket_name:
+        connect(args.region, args.bucket_name, policy)
     else:
-        output_file = open(args.output, 'wb')
-        # Enable compression by default if we're writing out to a file
-        if args.compress_manifest is None:
-            args.compress_manifest = True
+        parser.error("either --url or --region and --bucket are required")
+
+    if args.set_default_hash:
+        if not args.algorithm or args.dryrun:
+            parser.error("--set-default-hash needs --hash, and can't be used with --no-upload")
+        set_repository_algorithm(get_bucket(), args.algorithm)
+
+    # Enable compression by default if we're writing out to a file
+    compress = args.compress_manifest
+    if compress is None:
+        compress = args.output != '-'
+
+    upload_kwargs = dict(dryrun=args.dryrun, publish=args.publish, refresh=args.refresh, adaptive=args.adaptive,
+                         min_jobs=args.min_jobs, largest_first=args.largest_first, chunked=args.chunked,
+                         algorithm=args.algorithm)
+
+    if args.watch:
+        if args.dryrun or args.output == '-':
+            parser.error("--watch needs to upload, and to write the manifest to a file")
+        if not watch.available():
+            parser.error("--watch needs Linux inotify")
+        try:
+            watch.watch_directory(args.dirname, args.jobs, lambda m: write_manifest(m, args.output, compress, args.manifest_format),
+                                  interval=args.watch_interval, debounce=args.debounce, **upload_kwargs)
+        except KeyboardInterrupt:
+            log.info("stopped watching %s", args.dirname)
+        METRICS.log_summary()
+        METRICS.write(args.metrics_json, args.metrics_prom)
+        profiling.stop()
+        return
+
+    journal = None
+    if not args.dryrun:
+        if args.journal:
+            journal = UploadJournal(args.journal)
+        elif args.output != '-':
+            journal = UploadJournal(args.output + ".journal")
+    if journal and not args.use_journal:
+        # An earlier upload's journal won't be resumed now, so don't leave its
+        # multipart uploads behind
+        if os.path.exists(journal.filename):
+            log.info("discarding %s", journal.filename)
+            journal.discard(get_bucket())
+        journal = None
 
-    if args.compress_manifest:
-        output_file = gzip.GzipFile(fileobj=output_file, mode='wb')
+    manifest = upload_directory(args.dirname, args.jobs, journal=journal, **upload_kwargs)
+    METRICS.log_summary()
+    METRICS.write(args.metrics_json, args.metrics_prom)
 
-    manifest.save(output_file)
+    write_manifest(manifest, args.output, compress, args.manifest_format)
+    if journal:
+        # Only forget our progress once the manifest has been written
+        journal.remove()
 
     if args.report_dupes:
         manifest.report_dupes()
+    profiling.stop()
 
 if __name__ == '__main__':
     main()